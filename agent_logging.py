@@ -0,0 +1,131 @@
+# Leveled logging for the agents, built on the standard logging module. Modules get their logger with
+# get_logger('<module name>') and pass the values as arguments (logger.debug('Loaded: %s', data)), so that messages
+# below the configured level are never formatted. Configured by the "logging" entry of the shared config, e.g.:
+# {
+#   "level": "INFO",
+#   "levels": { "protocol_db": "DEBUG", "toolformers": "WARNING" }, // per module, applies to submodules too
+#   "rateLimit": { "messagesPerSecond": 5, "burst": 20 }, // per message template
+#   "sampleRate": 1.0, // fraction of the messages that pass the rate limit which are written
+#   "maxMessageLength": 10000 // longer messages are truncated
+# }
+# Rate limiting and sampling only apply to INFO and DEBUG messages: warnings and errors are always written.
+# The LOG_LEVEL environment variable overrides "level".
+
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+from request_context import get_query_id
+from runtime_config import get_config, on_reload
+
+ROOT_LOGGER_NAME = 'agent'
+DEFAULT_LEVEL = 'INFO'
+DEFAULT_MAX_MESSAGE_LENGTH = 10000
+
+# Changed by configure()
+CONFIG = {}
+CONFIGURED_LEVELS = set()
+
+def level_number(name):
+    level = logging.getLevelName(str(name).upper())
+    if not isinstance(level, int):
+        raise ValueError(f'Unknown log level: {name}')
+    return level
+
+class RateLimitFilter(logging.Filter):
+    # Token bucket per (logger, message template). Suppressed messages are counted and reported with the next message
+    # that goes through
+    def __init__(self):
+        super().__init__()
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        record.query_id = get_query_id() or '-'
+
+        if record.levelno >= logging.WARNING:
+            return True
+
+        rate_limit = CONFIG.get('rateLimit')
+        if rate_limit is not None:
+            messages_per_second = rate_limit.get('messagesPerSecond', 1)
+            burst = rate_limit.get('burst', messages_per_second)
+            key = (record.name, record.msg)
+            now = time.monotonic()
+
+            with self.lock:
+                tokens, last_time, suppressed = self.buckets.get(key, (burst, now, 0))
+                tokens = min(burst, tokens + (now - last_time) * messages_per_second)
+
+                if tokens < 1:
+                    self.buckets[key] = (tokens, now, suppressed + 1)
+                    return False
+
+                self.buckets[key] = (tokens - 1, now, 0)
+
+            if suppressed > 0:
+                record.suppressed = suppressed
+
+        return random.random() < CONFIG.get('sampleRate', 1)
+
+class AgentFormatter(logging.Formatter):
+    def formatMessage(self, record):
+        max_length = CONFIG.get('maxMessageLength', DEFAULT_MAX_MESSAGE_LENGTH)
+        if max_length is not None and len(record.message) > max_length:
+            record.message = record.message[:max_length] + f'... ({len(record.message) - max_length} characters truncated)'
+
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed > 0:
+            record.message += f' ({suppressed} similar messages suppressed)'
+
+        return super().formatMessage(record)
+
+def _make_handler():
+    handler = logging.StreamHandler(sys.stdout)
+    handler.addFilter(RateLimitFilter())
+    handler.setFormatter(AgentFormatter('%(asctime)s %(levelname)s %(name)s [%(query_id)s] %(message)s'))
+    return handler
+
+ROOT_LOGGER = logging.getLogger(ROOT_LOGGER_NAME)
+ROOT_LOGGER.setLevel(level_number(os.environ.get('LOG_LEVEL', DEFAULT_LEVEL)))
+ROOT_LOGGER.addHandler(_make_handler())
+# Third-party handlers (e.g. installed with logging.basicConfig) don't get the agents' messages
+ROOT_LOGGER.propagate = False
+
+def get_logger(name):
+    return logging.getLogger(f'{ROOT_LOGGER_NAME}.{name}')
+
+def configure(snapshot):
+    # Applies the "logging" entry of a configuration snapshot. Can be passed to runtime_config.on_reload
+    global CONFIG
+
+    config = snapshot['shared'].get('logging', {})
+
+    ROOT_LOGGER.setLevel(level_number(os.environ.get('LOG_LEVEL', config.get('level', DEFAULT_LEVEL))))
+
+    # Modules that are no longer configured inherit the root level again
+    for name in CONFIGURED_LEVELS - set(config.get('levels', {})):
+        get_logger(name).setLevel(logging.NOTSET)
+
+    for name, level in config.get('levels', {}).items():
+        get_logger(name).setLevel(level_number(level))
+
+    CONFIGURED_LEVELS.clear()
+    CONFIGURED_LEVELS.update(config.get('levels', {}))
+
+    CONFIG = config
+
+INITIALIZED = False
+
+def init_logging():
+    # Configures the logging from the current configuration, and again every time the configuration is reloaded
+    global INITIALIZED
+
+    configure(get_config())
+
+    if not INITIALIZED:
+        on_reload(configure)
+        INITIALIZED = True
@@ -4,6 +4,7 @@ sys.path.append('.')
 import dotenv
 dotenv.load_dotenv()
 
+import functools
 import os
 from pathlib import Path
 
@@ -11,14 +12,18 @@ if os.environ.get('STORAGE_PATH') is None:
     os.environ['STORAGE_PATH'] = str(Path().parent / 'storage' / 'protocol_db')
 
 from flask import Flask, request
-import requests as request_manager
 
 import json
 
-from utils import compute_hash, shared_config
+from agent_logging import get_logger, init_logging
+import http_client
+from runtime_config import get_config, on_reload
+from utils import compute_hash
 
 app = Flask(__name__)
 
+logger = get_logger('protocol_db')
+
 OTHER_DBS = []
 
 PROTOCOLS = {}
@@ -58,7 +63,7 @@ def add_protocol():
 
     PROTOCOLS[hashed_protocol] = data
 
-    print('Added protocol:', hashed_protocol)
+    logger.info('Added protocol: %s', hashed_protocol)
     save_memory()
 
     return json.dumps({
@@ -70,9 +75,7 @@ def add_protocol():
 def get_protocol():
     protocol_id = request.args.get('id')
 
-    print('Received request for protocol:', protocol_id)
-    print('Current keys:', PROTOCOLS.keys())
-    print('Do I have the protocol?', protocol_id in PROTOCOLS)
+    logger.debug('Received request for protocol: %s (found: %s)', protocol_id, protocol_id in PROTOCOLS)
     if protocol_id not in PROTOCOLS:
         return json.dumps({
             'status': 'error',
@@ -86,9 +89,7 @@ def get_protocol():
 def get_metadata():
     protocol_id = request.args.get('id')
 
-    print('Received request for metadata:', protocol_id)
-    print('Current keys:', PROTOCOLS.keys())
-    print('Do I have the protocol?', protocol_id in PROTOCOLS)
+    logger.debug('Received request for metadata: %s (found: %s)', protocol_id, protocol_id in PROTOCOLS)
     if protocol_id not in PROTOCOLS:
         return json.dumps({
             'status': 'error',
@@ -103,33 +104,40 @@ def get_metadata():
         }
     })
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return json.dumps({
+        'status': 'success',
+        'httpClient': http_client.get_stats()
+    })
+
 @app.route('/synchronize', methods=['POST'])
 def trigger_share():
     for other_db in OTHER_DBS:
-        print('Checking known protocols of:', other_db)
-        known_protocols = request_manager.get(f'{other_db}/', timeout=shared_config('timeout')).json()
+        logger.debug('Checking known protocols of: %s', other_db)
+        known_protocols = http_client.get(f'{other_db}/').json()
 
         for protocol_id, protocol_data in PROTOCOLS.items():
             if protocol_id not in known_protocols:
-                print('Sharing protocol:', protocol_id)
-                request_manager.post(f'{other_db}/', json=protocol_data, timeout=shared_config('timeout'))
+                logger.info('Sharing protocol %s with %s', protocol_id, other_db)
+                http_client.post(f'{other_db}/', json=protocol_data)
     
     return json.dumps({
         'status': 'success'
     })
 
 def load_config():
-    with open('config.json') as f:
-        config = json.load(f)
-    
-    with open('node_urls.json') as f:
-        node_urls = json.load(f)
-
+    # Bound now: reloads can be triggered by any agent's request (e.g. in the in-process simulation)
     agent_id = os.environ.get('AGENT_ID')
-    db_config = config['protocolDbs'][agent_id]
 
-    for peer_id in db_config['peers']:
-        OTHER_DBS.append(node_urls[peer_id])
+    update_peers(agent_id, get_config())
+    # Peers can be moved without restarting the agent
+    on_reload(functools.partial(update_peers, agent_id))
+
+def update_peers(agent_id, snapshot):
+    db_config = snapshot['protocolDbs'][agent_id]
+
+    OTHER_DBS[:] = [snapshot.node_urls[peer_id] for peer_id in db_config['peers']]
 
 def load_memory():
     PROTOCOLS.clear()
@@ -139,7 +147,7 @@ def load_memory():
     memory_file = storage_path / 'memory.json'
 
     if not memory_file.exists():
-        print('No memory file found, using empty memory')
+        logger.info('No memory file found, using empty memory')
         return
 
     with open(memory_file, 'r') as f:
@@ -147,7 +155,8 @@ def load_memory():
     for protocol_id, protocol_data in memory.items():
         PROTOCOLS[protocol_id] = protocol_data
 
-    print('Loaded memory:', PROTOCOLS)
+    logger.info('Loaded memory with %d protocols.', len(PROTOCOLS))
+    logger.debug('Known protocols: %s', list(PROTOCOLS.keys()))
 
 def save_memory():
     storage_path = Path(os.environ.get('STORAGE_PATH'))
@@ -161,6 +170,7 @@ def save_memory():
         json.dump(PROTOCOLS, f)
 
 def init():
+    init_logging()
     load_config()
     load_memory()
 
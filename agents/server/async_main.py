@@ -0,0 +1,203 @@
+# Async variant of the server agent (same routes as agents/server/main.py), served by aiohttp.
+# Queries are coroutines, so waiting for a model, a tool or another request's lock doesn't hold a thread.
+# The toolformers, tools and routines are synchronous: they run in a bounded thread pool, configured by the
+# "asyncServer" entry of the shared config, e.g. { "syncThreads": 32 }
+# Launched by the supervisor when "asyncServers" is set in the orchestration config, or with:
+# gunicorn --worker-class aiohttp.GunicornWebWorker agents.server.async_main:app
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+# Initializes the agent (configuration, tools and memory)
+import agents.server.main as server
+import agents.server.response_cache as response_cache
+from agents.common.core import Suitability
+from agents.server.memory import PROTOCOL_INFOS, has_implementation, get_num_conversations, increment_num_conversations, get_suitability, set_suitability
+from agent_logging import get_logger
+import http_client
+from request_context import propagate_context
+from utils import use_query_id, shared_config
+import wire_format
+
+logger = get_logger('server.async')
+
+DEFAULT_SYNC_THREADS = 32
+
+EXECUTOR = None
+
+# Only used by the event loop's thread, so they don't need to be thread-safe
+PROTOCOL_LOCKS = {}
+
+def protocol_lock(protocol_hash):
+    if protocol_hash not in PROTOCOL_LOCKS:
+        PROTOCOL_LOCKS[protocol_hash] = asyncio.Lock()
+    return PROTOCOL_LOCKS[protocol_hash]
+
+def get_executor():
+    global EXECUTOR
+
+    if EXECUTOR is None:
+        max_workers = shared_config('asyncServer', {}).get('syncThreads', DEFAULT_SYNC_THREADS)
+        EXECUTOR = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sync')
+
+    return EXECUTOR
+
+async def run_sync(function, *args):
+    # Runs a blocking function in the thread pool, with the request context of the caller
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), propagate_context(function), *args)
+
+async def handle_query_suitable(protocol_hash, query):
+    # Memory updates write the memory file, so they are run in the pool as well
+    await run_sync(increment_num_conversations, protocol_hash)
+
+    if has_implementation(protocol_hash):
+        return await run_sync(server.call_implementation, protocol_hash, query)
+
+    if get_num_conversations(protocol_hash) >= server.NUM_CONVERSATIONS_FOR_ROUTINE:
+        # We've used this protocol enough times to justify writing a routine
+        if server.background_routine_synthesis():
+            server.write_routine_in_background(protocol_hash)
+        else:
+            async with protocol_lock(protocol_hash):
+                # Another request might have written it while we were waiting for the lock
+                if not has_implementation(protocol_hash):
+                    await run_sync(server.write_routine, protocol_hash)
+            return await run_sync(server.call_implementation, protocol_hash, query)
+
+    return await run_sync(server.reply_without_routine, protocol_hash, query)
+
+async def handle_query(protocol_hash, protocol_sources, query):
+    if protocol_hash is None:
+        server.count_conversation_without_protocol()
+        return await run_sync(server.reply_without_routine, None, query)
+
+    if protocol_hash == 'negotiation':
+        # Special protocol, default to human-written routine
+        return await run_sync(server.handle_negotiation, query)
+
+    if has_implementation(protocol_hash):
+        return await run_sync(server.call_implementation, protocol_hash, query)
+
+    if protocol_hash not in PROTOCOL_INFOS:
+        async with protocol_lock(protocol_hash):
+            # Another request might have downloaded it while we were waiting for the lock
+            if protocol_hash not in PROTOCOL_INFOS and not await run_sync(server.download_protocol, protocol_hash, protocol_sources):
+                return {
+                    'status': 'error',
+                    'message': 'No valid protocol source provided.'
+                }
+
+    if get_suitability(protocol_hash) == Suitability.UNKNOWN:
+        # Coalesced with the lock rather than with server.SUITABILITY_CHECKS, so that waiting doesn't take a pool thread
+        async with protocol_lock(protocol_hash):
+            await run_sync(server.check_suitability, protocol_hash)
+
+    if get_suitability(protocol_hash) == Suitability.ADEQUATE:
+        return await handle_query_suitable(protocol_hash, query)
+    else:
+        return {
+            'status': 'error',
+            'message': 'Protocol not suitable.'
+        }
+
+async def handle_query_with_cache(protocol_hash, protocol_sources, query):
+    if not server.is_cache_candidate(protocol_hash):
+        return await handle_query(protocol_hash, protocol_sources, query)
+
+    cached_response = response_cache.lookup(protocol_hash, query)
+    if cached_response is not None:
+        return cached_response
+
+    generation = response_cache.get_generation()
+    # The tool calls made in the pool see the same tracker, since run_sync copies the context
+    with response_cache.track_tool_calls() as tool_usage:
+        response = await handle_query(protocol_hash, protocol_sources, query)
+
+    await run_sync(server.cache_response, protocol_hash, query, response, tool_usage, generation)
+    return response
+
+def make_response(request, payload, status=200):
+    # Same encoding as the Flask app: dicts are JSON (or MessagePack), strings are returned as-is
+    encoded = wire_format.encode_response_body(request.headers.get('Accept', ''), payload)
+    if encoded is not None:
+        data, headers = encoded
+        return web.Response(body=data, headers=headers, status=status)
+
+    if isinstance(payload, str):
+        return web.Response(text=payload, content_type='text/html', status=status)
+
+    return web.json_response(payload, status=status)
+
+routes = web.RouteTableDef()
+
+@routes.post('/')
+async def main(request):
+    try:
+        data = wire_format.decode_request_body(request.headers, await request.read())
+    except wire_format.UnsupportedWireFormat as e:
+        return make_response(request, {
+            'status': 'error',
+            'message': str(e)
+        }, status=415)
+
+    protocol_hash = data.get('protocolHash', None)
+    protocol_sources = data.get('protocolSources', [])
+    query_id = data.get('queryId', None)
+
+    if query_id is None:
+        logger.warning('No query ID provided.')
+
+    with use_query_id(query_id):
+        response = await handle_query_with_cache(protocol_hash, protocol_sources, data['body'])
+        logger.debug('Final response: %s', response)
+    return make_response(request, response)
+
+@routes.get('/healthz')
+async def healthz(request):
+    return make_response(request, {
+        'status': 'success',
+        'httpClient': http_client.get_stats(),
+        'responseCache': response_cache.get_stats()
+    })
+
+@routes.get('/wellknown')
+async def wellknown(request):
+    return make_response(request, {
+        'status': 'success',
+        'protocols': server.get_adequate_protocols()
+    })
+
+# Note: In a real-world case, the server would already register the protocol as part of the negotiation process
+@routes.post('/registerNegotiatedProtocol')
+async def register_negotiated_protocol(request):
+    data = await request.json()
+
+    protocol_hash = data['protocolHash']
+    protocol_sources = data['protocolSources']
+
+    async with protocol_lock(protocol_hash):
+        if not await run_sync(server.download_protocol, protocol_hash, protocol_sources):
+            return make_response(request, {
+                'status': 'error',
+                'message': 'No valid protocol source provided.'
+            })
+
+        await run_sync(set_suitability, protocol_hash, Suitability.ADEQUATE)
+
+    return make_response(request, {
+        'status': 'success'
+    })
+
+# Determines if the user should start a negotiation instead of a regular conversation
+# Note: in a real-world case, this would be determined independently by the server
+@routes.get('/requiresNegotiation')
+async def requires_negotiation(request):
+    return make_response(request, {
+        'status': 'success',
+        'requiresNegotiation': server.requires_negotiation_with_users()
+    })
+
+app = web.Application()
+app.add_routes(routes)
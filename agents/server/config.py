@@ -2,15 +2,19 @@ import json
 import os
 import random
 
-import requests as request_manager
-
 import databases.mongo as mongo
 import databases.sql as sql
+import http_client
 from toolformers.base import Tool, StringParameter, EnumParameter
 
 import mocks.mock_tools as mock_tools
 
-from utils import get_query_id, shared_config
+from agent_logging import get_logger
+from agents.server.response_cache import record_tool_call, is_sql_write
+from runtime_config import get_config, on_reload
+from utils import get_query_id
+
+logger = get_logger('server.config')
 
 TOOLS = []
 ADDITIONAL_INFO = ''
@@ -38,7 +42,11 @@ def add_mongo_database(external_name, schema):
 def add_mongo_tools(server_name):
     def insert_element(collection, doc):
         doc = json.loads(doc)
-        mongo.insert_one(server_name, collection, doc)
+        try:
+            mongo.insert_one(server_name, collection, doc)
+        finally:
+            # Cached responses are dropped once the write is done
+            record_tool_call(writes=True)
         return 'Done'
 
     insert_element_tool = Tool('insert_into_database', 'Insert into a database (MongoDB).', [
@@ -47,9 +55,10 @@ def add_mongo_tools(server_name):
     ], insert_element)
 
     def query_database(collection, query):
+        record_tool_call(cacheable=True)
         query = json.loads(query)
         output = mongo.query_database(server_name, collection, query)
-        print('MongoDB query database output:', output)
+        logger.debug('MongoDB query database output: %s', output)
         return json.dumps(output)
 
     find_in_database_tool = Tool('find_in_database', 'Find in a database (MongoDB). Returns a JSON formatted string with the result.', [
@@ -60,7 +69,10 @@ def add_mongo_tools(server_name):
     def update_element(collection, query, update):
         query = json.loads(query)
         update = json.loads(update)
-        mongo.update_one(server_name, collection, query, update)
+        try:
+            mongo.update_one(server_name, collection, query, update)
+        finally:
+            record_tool_call(writes=True)
         return 'Done'
 
     update_element_tool = Tool('update_one_in_database', 'Update an element in a database (MongoDB).', [
@@ -71,7 +83,10 @@ def add_mongo_tools(server_name):
 
     def delete_element(collection, query):
         query = json.loads(query)
-        mongo.delete_one(server_name, collection, query)
+        try:
+            mongo.delete_one(server_name, collection, query)
+        finally:
+            record_tool_call(writes=True)
         return 'Done'
 
     delete_element_tool = Tool('delete_element_in_database', 'Delete an element in a database (MongoDB).', [
@@ -106,7 +121,7 @@ def add_sql_database(table_schemas, server_name):
 
         constraints = table_schema.get('constraints', [])
         if len(constraints) > 0:
-            print('Constraints:', constraints)
+            logger.debug('Constraints: %s', constraints)
             ADDITIONAL_INFO += '\n\nConstraints:\n'
             for constraint in constraints:
                 ADDITIONAL_INFO += f'\n- {constraint}'
@@ -136,9 +151,13 @@ def add_sql_tools(name_mappings):
         # Some models (especially Gemini) really struggle with escaping, adding escaping where it's not necessary
         query = query.replace("\\'", "'")
 
-        print('Running SQL query:', query)
-        response = sql.run_query(query)
-        print('SQL Response:', response)
+        logger.debug('Running SQL query: %s', query)
+        writes = is_sql_write(query)
+        try:
+            response = sql.run_query(query)
+        finally:
+            record_tool_call(cacheable=not writes, writes=writes)
+        logger.debug('SQL response: %s', response)
         return response
     
     tool_description = 'Run a Microsoft SQL Server query. Returns a list of results, where each element is a dictionary ' \
@@ -152,8 +171,7 @@ def add_sql_tools(name_mappings):
 
 
 def prepare_mock_tool(tool_schema, internal_name, schema_name):
-    print('Internal name:', internal_name)
-    print('Tool schema:', tool_schema)
+    logger.debug('Preparing mock tool %s with schema: %s', internal_name, tool_schema)
     input_schema = tool_schema['input']
 
     required_parameter_names = input_schema['required']
@@ -168,11 +186,14 @@ def prepare_mock_tool(tool_schema, internal_name, schema_name):
             raise ValueError('Unknown parameter type:', parameter_data['type'])
 
     def run_mock_tool(*args, **kwargs):
-        print('Running mock tool:', internal_name, 'Schema name:', schema_name, args, kwargs)
+        logger.debug('Running mock tool %s (schema %s): %s %s', internal_name, schema_name, args, kwargs)
         if schema_name not in mock_tools.__dict__:
             raise ValueError('Unknown mock tool schema:', schema_name)
-        response = mock_tools.__dict__[schema_name](*args, **kwargs)
-        print(f'Mock tool {internal_name} response:', response)
+        try:
+            response = mock_tools.__dict__[schema_name](*args, **kwargs)
+        finally:
+            record_tool_call(cacheable=tool_schema.get('cacheable', False), writes=tool_schema.get('writes', False))
+        logger.debug('Mock tool %s response: %s', internal_name, response)
         return response
 
     mock_tool = Tool(internal_name, tool_schema['description'], parameters, run_mock_tool, output_schema=tool_schema['output'])
@@ -203,16 +224,19 @@ def prepare_external_tool(tool_schema, internal_name, external_server_name):
 
         # TODO: Check that the parameter names are correct?
 
-        print('Running external tool:', internal_name, kwargs)
+        logger.debug('Running external tool %s: %s', internal_name, kwargs)
         query_parameters = {
             'type' : internal_name, # TODO: Use the schema name instead? Must be matched on the other side
             'data' : kwargs,
             'targetServer' : external_server_name,
             'queryId': get_query_id()
         }
-        response = request_manager.post(helper_url + '/customRun', json=query_parameters, timeout=shared_config('timeout'))
+        try:
+            response = http_client.post(helper_url + '/customRun', json=query_parameters, tier='query')
+        finally:
+            record_tool_call(cacheable=tool_schema.get('cacheable', False), writes=tool_schema.get('writes', False))
 
-        print(f'Response from external tool {internal_name}:', response.text)
+        logger.debug('Response from external tool %s: %s', internal_name, response.text)
 
         if response.status_code == 200:
             parsed_response = json.loads(response.text)
@@ -228,13 +252,11 @@ def prepare_external_tool(tool_schema, internal_name, external_server_name):
 
 def load_config(server_name):
     global ADDITIONAL_INFO
-    with open('config.json') as f:
-        config = json.load(f)
+    config = get_config()
 
-    with open('node_urls.json') as f:
-        node_urls = json.load(f)
-    for node_id, node_url in node_urls.items():
-        NODE_URLS[node_id] = node_url
+    NODE_URLS.update(config.node_urls)
+    # Nodes (e.g. the helper) can be moved without restarting the agent
+    on_reload(lambda snapshot: NODE_URLS.update(snapshot.node_urls))
     
     server_config = config['servers'][server_name]
 
@@ -270,5 +292,5 @@ def load_config(server_name):
         tool = prepare_external_tool(tool_schema, internal_name, tool_server)
         TOOLS.append(tool)
 
-    print('Final additional info:', ADDITIONAL_INFO)
-    print('Final tools:', TOOLS)
\ No newline at end of file
+    logger.info('Loaded %d tools: %s', len(TOOLS), [tool.name for tool in TOOLS])
+    logger.debug('Final additional info: %s', ADDITIONAL_INFO)
\ No newline at end of file
@@ -10,16 +10,23 @@ import os
 if os.environ.get('STORAGE_PATH') is None:
     os.environ['STORAGE_PATH'] = str(Path().parent / 'storage' / 'server')
 
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 import json
 from threading import Lock
-import traceback
+import time
 
 from flask import Flask, request
 
 
 from agents.common.core import Suitability
-from agents.server.memory import PROTOCOL_INFOS, register_new_protocol, has_implementation, get_num_conversations, increment_num_conversations, has_implementation, add_routine, load_memory, save_memory
-from utils import load_protocol_document, execute_routine, download_and_verify_protocol, use_query_id
+import agents.server.response_cache as response_cache
+from agents.server.memory import PROTOCOL_INFOS, MEMORY_LOCK, register_new_protocol, has_implementation, get_num_conversations, increment_num_conversations, add_routine, get_suitability, set_suitability, load_memory
+from agent_logging import get_logger, init_logging
+import http_client
+from single_flight import SingleFlight
+import wire_format
+from utils import load_protocol_document, execute_routine, fetch_protocol, use_query_id, shared_config
 from specialized_toolformers.responder import reply_to_query
 from specialized_toolformers.protocol_checker import check_protocol_for_tools
 from specialized_toolformers.programmer import write_routine_for_tools
@@ -30,12 +37,89 @@ from agents.server.config import TOOLS, get_additional_info, load_config
 
 app = Flask(__name__)
 
+logger = get_logger('server')
+
 NUM_CONVERSATIONS_FOR_ROUTINE = -1# 1e6
 
 NUM_CONVERSATIONS_FOR_PROTOCOL = 5 #1e6
 no_protocol_conversation_counter = 0
-
-mutex = Lock()
+counter_lock = Lock()
+
+# Queries are handled concurrently. Downloading a protocol, checking its suitability and writing its routine
+# are done once, under a lock specific to the protocol, while queries that only run a routine don't lock anything
+PROTOCOL_LOCKS = {}
+PROTOCOL_LOCKS_LOCK = Lock()
+
+def protocol_lock(protocol_hash):
+    with PROTOCOL_LOCKS_LOCK:
+        if protocol_hash not in PROTOCOL_LOCKS:
+            PROTOCOL_LOCKS[protocol_hash] = Lock()
+        return PROTOCOL_LOCKS[protocol_hash]
+
+# Concurrent queries with the same new protocol share one suitability check, keyed by protocol and tool set
+SUITABILITY_CHECKS = SingleFlight()
+
+def suitability_check_key(protocol_hash):
+    return (protocol_hash, tuple(sorted(tool.name for tool in TOOLS)))
+
+# Routines are written in the background, and queries are answered by the responder until the routine is ready.
+# Configured by the "routineSynthesis" entry of the shared config, e.g.:
+# { "background": true, "workers": 1, "retryInterval": 300 } // seconds before retrying a routine that failed
+DEFAULT_ROUTINE_SYNTHESIS_WORKERS = 1
+DEFAULT_ROUTINE_RETRY_INTERVAL = 300
+
+ROUTINE_EXECUTOR = None
+# Protocol hash -> running job, and protocol hash -> time of the last failure
+ROUTINE_JOBS = {}
+ROUTINE_FAILURES = {}
+ROUTINE_JOBS_LOCK = Lock()
+
+def background_routine_synthesis():
+    # In-process simulations read the agent's identity from the environment, so they can't use background threads
+    return shared_config('routineSynthesis', {}).get('background', True) and http_client.ALLOW_CONCURRENT_REQUESTS
+
+def get_routine_executor():
+    global ROUTINE_EXECUTOR
+
+    with ROUTINE_JOBS_LOCK:
+        if ROUTINE_EXECUTOR is None:
+            max_workers = shared_config('routineSynthesis', {}).get('workers', DEFAULT_ROUTINE_SYNTHESIS_WORKERS)
+            ROUTINE_EXECUTOR = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='routine')
+
+        return ROUTINE_EXECUTOR
+
+def write_routine_in_background(protocol_hash):
+    # Returns immediately. Only one job per protocol is queued or running at any time
+    executor = get_routine_executor()
+    retry_interval = shared_config('routineSynthesis', {}).get('retryInterval', DEFAULT_ROUTINE_RETRY_INTERVAL)
+
+    with ROUTINE_JOBS_LOCK:
+        if protocol_hash in ROUTINE_JOBS or has_implementation(protocol_hash):
+            return
+
+        if time.time() - ROUTINE_FAILURES.get(protocol_hash, 0) < retry_interval:
+            return
+
+        logger.info('Scheduling the routine for protocol %s', protocol_hash)
+        # The job outlives the request that scheduled it, so it runs in a fresh context (with its own query ID, spans
+        # and no response cache tracking) instead of a copy of the request's
+        ROUTINE_JOBS[protocol_hash] = executor.submit(contextvars.Context().run, run_routine_job, protocol_hash)
+
+def run_routine_job(protocol_hash):
+    with use_query_id(f'routine-synthesis:{protocol_hash}'):
+        try:
+            write_routine(protocol_hash)
+            logger.info('The routine for protocol %s is ready', protocol_hash)
+        except Exception as e:
+            logger.exception('Failed to write the routine for protocol %s: %s', protocol_hash, e)
+            with ROUTINE_JOBS_LOCK:
+                ROUTINE_FAILURES[protocol_hash] = time.time()
+        finally:
+            with ROUTINE_JOBS_LOCK:
+                del ROUTINE_JOBS[protocol_hash]
+
+# The individual steps of a query. They are shared with the async app (agents/server/async_main.py),
+# which only differs in how it waits for them
 
 def call_implementation(protocol_hash, query):
     base_folder = Path(os.environ.get('STORAGE_PATH')) / 'routines'
@@ -47,30 +131,53 @@ def call_implementation(protocol_hash, query):
             'body': output
         }
     except Exception as e:
-        print(traceback.print_exception(type(e), e, e.__traceback__))
-        print('Error executing routine:', e)
-        print('Falling back to responder')
+        logger.exception('Error executing routine, falling back to responder: %s', e)
         return reply_to_query(query, protocol_hash, TOOLS, get_additional_info())
 
-def handle_query_suitable(protocol_hash, query):
-    increment_num_conversations(protocol_hash)
+def reply_without_routine(protocol_hash, query):
+    logger.debug('Calling with protocol_hash %s. Using tools: %s', protocol_hash, TOOLS)
+    return reply_to_query(query, protocol_hash, TOOLS, get_additional_info())
 
-    if has_implementation(protocol_hash):
-        return call_implementation(protocol_hash, query)
-    elif get_num_conversations(protocol_hash) >= NUM_CONVERSATIONS_FOR_ROUTINE:
-        # We've used this protocol enough times to justify writing a routine
-        base_folder = Path(os.environ.get('STORAGE_PATH')) / 'protocol_documents'
-        protocol_document = load_protocol_document(base_folder, protocol_hash)
-        implementation = write_routine_for_tools(TOOLS, protocol_document, get_additional_info())
-        add_routine(protocol_hash, implementation)
-        return call_implementation(protocol_hash, query)
+def write_routine(protocol_hash):
+    base_folder = Path(os.environ.get('STORAGE_PATH')) / 'protocol_documents'
+    protocol_document = load_protocol_document(base_folder, protocol_hash)
+    implementation = write_routine_for_tools(TOOLS, protocol_document, get_additional_info())
+    # The routine file is written before the protocol is marked as implemented, so queries switch over at once
+    add_routine(protocol_hash, implementation)
+
+def download_protocol(protocol_hash, protocol_sources):
+    # Returns whether one of the sources provided the protocol
+    logger.info('Downloading protocol %s from: %s', protocol_hash, protocol_sources)
+    protocol_document, protocol_source = fetch_protocol(protocol_hash, protocol_sources)
+
+    if protocol_document is None:
+        return False
+
+    register_new_protocol(protocol_hash, protocol_source, protocol_document)
+    return True
+
+def check_suitability(protocol_hash):
+    # Determine if we can support this protocol. A query that arrives right after another one finished the check
+    # starts a new call, which finds the verdict
+    if get_suitability(protocol_hash) != Suitability.UNKNOWN:
+        return
+
+    base_folder = Path(os.environ.get('STORAGE_PATH')) / 'protocol_documents'
+    protocol_document = load_protocol_document(base_folder, protocol_hash)
+    if check_protocol_for_tools(protocol_document, TOOLS):
+        set_suitability(protocol_hash, Suitability.ADEQUATE)
     else:
-        print('Calling with protocol_hash. Using tools:', TOOLS)
-        return reply_to_query(query, protocol_hash, TOOLS, get_additional_info())
+        set_suitability(protocol_hash, Suitability.INADEQUATE)
+
+def count_conversation_without_protocol():
+    global no_protocol_conversation_counter
+    with counter_lock:
+        no_protocol_conversation_counter += 1
 
 def handle_negotiation(raw_query):
     global no_protocol_conversation_counter
-    no_protocol_conversation_counter = 0
+    with counter_lock:
+        no_protocol_conversation_counter = 0
 
     raw_query = json.loads(raw_query)
     conversation_id = raw_query.get('conversationId', None)
@@ -88,14 +195,29 @@ def handle_negotiation(raw_query):
         'body': json.dumps(raw_reply)
     }
 
+def handle_query_suitable(protocol_hash, query):
+    increment_num_conversations(protocol_hash)
 
-def handle_query(protocol_hash, protocol_sources, query):
-    if protocol_hash is None:
-        print('No protocol hash provided. Using TOOLS:', TOOLS)
+    if has_implementation(protocol_hash):
+        return call_implementation(protocol_hash, query)
 
-        global no_protocol_conversation_counter
-        no_protocol_conversation_counter += 1
+    if get_num_conversations(protocol_hash) >= NUM_CONVERSATIONS_FOR_ROUTINE:
+        # We've used this protocol enough times to justify writing a routine
+        if background_routine_synthesis():
+            write_routine_in_background(protocol_hash)
+        else:
+            with protocol_lock(protocol_hash):
+                # Another request might have written it while we were waiting for the lock
+                if not has_implementation(protocol_hash):
+                    write_routine(protocol_hash)
+            return call_implementation(protocol_hash, query)
 
+    return reply_without_routine(protocol_hash, query)
+
+def handle_query(protocol_hash, protocol_sources, query):
+    if protocol_hash is None:
+        logger.debug('No protocol hash provided. Using tools: %s', TOOLS)
+        count_conversation_without_protocol()
         return reply_to_query(query, None, TOOLS, get_additional_info())
     
     if protocol_hash == 'negotiation':
@@ -105,70 +227,97 @@ def handle_query(protocol_hash, protocol_sources, query):
     if has_implementation(protocol_hash):
         return call_implementation(protocol_hash, query)
 
-    if protocol_hash in PROTOCOL_INFOS:
-        if PROTOCOL_INFOS[protocol_hash]['suitability'] == Suitability.UNKNOWN:
-            # Determine if we can support this protocol
-            base_folder = Path(os.environ.get('STORAGE_PATH')) / 'protocol_documents'
-            protocol_document = load_protocol_document(base_folder, protocol_hash)
-            if check_protocol_for_tools(protocol_document, TOOLS):
-                PROTOCOL_INFOS[protocol_hash]['suitability'] = Suitability.ADEQUATE
-            else:
-                PROTOCOL_INFOS[protocol_hash]['suitability'] = Suitability.INADEQUATE
-            save_memory()
-
-        if PROTOCOL_INFOS[protocol_hash]['suitability'] == Suitability.ADEQUATE:
-            return handle_query_suitable(protocol_hash, query)
-        else:
-            return {
-                'status': 'error',
-                'message': 'Protocol not suitable.'
-            }
+    if protocol_hash not in PROTOCOL_INFOS:
+        with protocol_lock(protocol_hash):
+            # Another request might have downloaded it while we were waiting for the lock
+            if protocol_hash not in PROTOCOL_INFOS and not download_protocol(protocol_hash, protocol_sources):
+                return {
+                    'status': 'error',
+                    'message': 'No valid protocol source provided.'
+                }
+
+    if get_suitability(protocol_hash) == Suitability.UNKNOWN:
+        SUITABILITY_CHECKS.do(suitability_check_key(protocol_hash), check_suitability, protocol_hash)
+
+    if get_suitability(protocol_hash) == Suitability.ADEQUATE:
+        return handle_query_suitable(protocol_hash, query)
     else:
-        print('Protocol sources:', protocol_sources)
-        for protocol_source in protocol_sources:
-            protocol_document = download_and_verify_protocol(protocol_hash, protocol_source)
-            if protocol_document is not None:
-                register_new_protocol(protocol_hash, protocol_source, protocol_document)
-                is_suitable = check_protocol_for_tools(protocol_document, TOOLS)
-
-                if is_suitable:
-                    PROTOCOL_INFOS[protocol_hash]['suitability'] = Suitability.ADEQUATE
-                else:
-                    PROTOCOL_INFOS[protocol_hash]['suitability'] = Suitability.INADEQUATE
-                save_memory()
-
-                if is_suitable:
-                    return handle_query_suitable(protocol_hash, query)
         return {
             'status': 'error',
-            'message': 'No valid protocol source provided.'
+            'message': 'Protocol not suitable.'
         }
 
+def is_cache_candidate(protocol_hash):
+    return response_cache.enabled() and protocol_hash is not None and protocol_hash != 'negotiation'
+
+def cache_response(protocol_hash, query, response, tool_usage, generation):
+    if not response_cache.is_successful(response):
+        return
+
+    base_folder = Path(os.environ.get('STORAGE_PATH')) / 'protocol_documents'
+    ttl = response_cache.cache_ttl(load_protocol_document(base_folder, protocol_hash), tool_usage)
+
+    if ttl is not None:
+        response_cache.store(protocol_hash, query, response, ttl, generation)
+
+def handle_query_with_cache(protocol_hash, protocol_sources, query):
+    if not is_cache_candidate(protocol_hash):
+        return handle_query(protocol_hash, protocol_sources, query)
+
+    cached_response = response_cache.lookup(protocol_hash, query)
+    if cached_response is not None:
+        return cached_response
+
+    generation = response_cache.get_generation()
+    with response_cache.track_tool_calls() as tool_usage:
+        response = handle_query(protocol_hash, protocol_sources, query)
+
+    cache_response(protocol_hash, query, response, tool_usage, generation)
+    return response
+
+def get_adequate_protocols():
+    with MEMORY_LOCK:
+        return { protocol_hash: [PROTOCOL_INFOS[protocol_hash]['source']] for protocol_hash in PROTOCOL_INFOS if PROTOCOL_INFOS[protocol_hash]['suitability'] == Suitability.ADEQUATE }
+
+def requires_negotiation_with_users():
+    return no_protocol_conversation_counter >= NUM_CONVERSATIONS_FOR_PROTOCOL
+
 @app.route("/", methods=['POST'])
 def main():
-    data = request.get_json()
+    try:
+        data = wire_format.decode_request(request)
+    except wire_format.UnsupportedWireFormat as e:
+        return {
+            'status': 'error',
+            'message': str(e)
+        }, 415
 
     protocol_hash = data.get('protocolHash', None)
     protocol_sources = data.get('protocolSources', [])
     query_id = data.get('queryId', None)
 
     if query_id is None:
-        print('No query ID provided.')
-    else:
-        print('Query ID:', query_id)
+        logger.warning('No query ID provided.')
 
-    with mutex:
-        with use_query_id(query_id):
-            response = handle_query(protocol_hash, protocol_sources, data['body'])
+    with use_query_id(query_id):
+        response = handle_query_with_cache(protocol_hash, protocol_sources, data['body'])
+        logger.debug('Final response: %s', response)
+    return wire_format.encode_response(request, response)
 
-    print('Final response:', response)
-    return response
+@app.route("/healthz", methods=['GET'])
+def healthz():
+    return {
+        'status': 'success',
+        'httpClient': http_client.get_stats(),
+        'suitabilityChecks': SUITABILITY_CHECKS.get_stats(),
+        'responseCache': response_cache.get_stats()
+    }
 
 @app.route("/wellknown", methods=['GET'])
 def wellknown():
     return {
         'status': 'success',
-        'protocols': { protocol_hash: [PROTOCOL_INFOS[protocol_hash]['source']] for protocol_hash in PROTOCOL_INFOS if PROTOCOL_INFOS[protocol_hash]['suitability'] == Suitability.ADEQUATE }
+        'protocols': get_adequate_protocols()
     }
 
 # Note: In a real-world case, the server would already register the protocol as part of the negotiation process
@@ -179,23 +328,14 @@ def register_negotiated_protocol():
     protocol_hash = data['protocolHash']
     protocol_sources = data['protocolSources']
 
-    protocol_document = None
-
-    for protocol_source in protocol_sources:
-        protocol_document = download_and_verify_protocol(protocol_hash, protocol_source)
-        if protocol_document is not None:
-            break
-    
-    if protocol_document is None:
-        return {
-            'status': 'error',
-            'message': 'No valid protocol source provided.'
-        }
-    
-    register_new_protocol(protocol_hash, protocol_source, protocol_document)
-    PROTOCOL_INFOS[protocol_hash]['suitability'] = Suitability.ADEQUATE
-
-    save_memory()
+    with protocol_lock(protocol_hash):
+        if not download_protocol(protocol_hash, protocol_sources):
+            return {
+                'status': 'error',
+                'message': 'No valid protocol source provided.'
+            }
+        
+        set_suitability(protocol_hash, Suitability.ADEQUATE)
 
     return {
         'status': 'success'
@@ -207,10 +347,11 @@ def register_negotiated_protocol():
 def requires_negotiation():
     return {
         'status': 'success',
-        'requiresNegotiation': no_protocol_conversation_counter >= NUM_CONVERSATIONS_FOR_PROTOCOL
+        'requiresNegotiation': requires_negotiation_with_users()
     }
 
 def init():
+    init_logging()
     load_config(os.environ.get('AGENT_ID'))
     load_memory()
 
@@ -1,16 +1,23 @@
 import json
 import os
 from pathlib import Path
+import threading
 
 from agents.common.core import Suitability
+from agent_logging import get_logger
 from utils import save_protocol_document, save_routine
 
+logger = get_logger('server.memory')
+
 PROTOCOL_INFOS = {}
 
+# Held while PROTOCOL_INFOS is modified or saved. Readers of single entries don't need it
+MEMORY_LOCK = threading.RLock()
+
 def load_memory():
     storage_path = Path(os.environ.get('STORAGE_PATH')) / 'memory.json'
     if not Path(storage_path).exists():
-        print('No memory found. Using default blank memory.')
+        logger.info('No memory found. Using default blank memory.')
         PROTOCOL_INFOS.clear()
         return
 
@@ -20,26 +27,38 @@ def load_memory():
         PROTOCOL_INFOS.clear()
         PROTOCOL_INFOS.update(data['protocol_infos'])
 
-        print('Loaded memory:', PROTOCOL_INFOS.keys())
+        logger.info('Loaded memory with %d protocols.', len(PROTOCOL_INFOS))
+        logger.debug('Known protocols: %s', list(PROTOCOL_INFOS.keys()))
 
 def save_memory():
     storage_path = Path(os.environ.get('STORAGE_PATH')) / 'memory.json'
     storage_path.parent.mkdir(parents=True, exist_ok=True)
-    with open(storage_path, 'w') as f:
-        json.dump({
-            'protocol_infos': PROTOCOL_INFOS
-        }, f, indent=4)
+    with MEMORY_LOCK:
+        with open(storage_path, 'w') as f:
+            json.dump({
+                'protocol_infos': PROTOCOL_INFOS
+            }, f, indent=4)
 
 def register_new_protocol(protocol_hash, protocol_source, protocol_document):
-    PROTOCOL_INFOS[protocol_hash] = {
-        'source': protocol_source,
-        'suitability': Suitability.UNKNOWN,
-        'has_implementation': False,
-        'num_conversations': 0
-    }
     base_folder = Path(os.environ.get('STORAGE_PATH')) / 'protocol_documents'
     save_protocol_document(base_folder, protocol_hash, protocol_document)
-    save_memory()
+
+    with MEMORY_LOCK:
+        PROTOCOL_INFOS[protocol_hash] = {
+            'source': protocol_source,
+            'suitability': Suitability.UNKNOWN,
+            'has_implementation': False,
+            'num_conversations': 0
+        }
+        save_memory()
+
+def get_suitability(protocol_hash):
+    return PROTOCOL_INFOS[protocol_hash]['suitability']
+
+def set_suitability(protocol_hash, suitability):
+    with MEMORY_LOCK:
+        PROTOCOL_INFOS[protocol_hash]['suitability'] = suitability
+        save_memory()
 
 def has_implementation(protocol_hash):
     if protocol_hash not in PROTOCOL_INFOS:
@@ -54,13 +73,16 @@ def get_num_conversations(protocol_hash):
     return PROTOCOL_INFOS[protocol_hash]['num_conversations']
 
 def increment_num_conversations(protocol_hash):
-    PROTOCOL_INFOS[protocol_hash]['num_conversations'] += 1
-    save_memory()
+    with MEMORY_LOCK:
+        PROTOCOL_INFOS[protocol_hash]['num_conversations'] += 1
+        save_memory()
 
 def add_routine(protocol_id, implementation):
-    PROTOCOL_INFOS[protocol_id]['has_implementation'] = True
     base_folder = Path(os.environ.get('STORAGE_PATH')) / 'routines'
 
+    # The routine is written before it is marked as available, since requests read the flag without locking
     save_routine(base_folder, protocol_id, implementation)
 
-    save_memory()
+    with MEMORY_LOCK:
+        PROTOCOL_INFOS[protocol_id]['has_implementation'] = True
+        save_memory()
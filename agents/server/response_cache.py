@@ -0,0 +1,169 @@
+# Opt-in cache of the responses to protocol queries, keyed by protocol hash and normalized query body.
+# Configured by the "responseCache" entry of the shared config, e.g.:
+# { "enabled": true, "ttl": 300, "maxEntries": 1024 } // ttl in seconds
+# A response is only cached if its query is declared cacheable:
+# - by the protocol document, with a line "Cacheable: yes" (and optionally "Cache-TTL: <seconds>"), or
+# - by the tool schemas: if every tool used to answer it has "cacheable": true in its schema
+# and if no write tool ran while answering it. Write tools (database inserts, updates and deletes, SQL statements
+# other than SELECT and tools whose schema has "writes": true) clear the whole cache.
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import contextvars
+import json
+import re
+import threading
+import time
+
+from agent_logging import get_logger
+from utils import shared_config
+
+logger = get_logger('server.response_cache')
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_ENTRIES = 1024
+
+CACHEABLE_PATTERN = re.compile(r'^\W*cacheable\W*:\W*(yes|true)\b', re.IGNORECASE | re.MULTILINE)
+CACHE_TTL_PATTERN = re.compile(r'^\W*cache-ttl\W*:\W*(\d+)', re.IGNORECASE | re.MULTILINE)
+
+# String literals, quoted identifiers and comments, which can contain keywords without being statements
+SQL_QUOTED_PATTERN = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?\*/", re.DOTALL)
+SQL_READ_PATTERN = re.compile(r'^\s*(select|with)\b', re.IGNORECASE)
+SQL_WRITE_PATTERN = re.compile(r'\b(insert|update|delete|merge|create|alter|drop|truncate|exec|execute|grant|revoke|into)\b', re.IGNORECASE)
+
+CACHE = OrderedDict()
+CACHE_LOCK = threading.Lock()
+# Incremented by every invalidation, so that responses computed before a write are not stored after it
+GENERATION = 0
+STATS = {
+    'hits': 0,
+    'misses': 0,
+    'stores': 0,
+    'invalidations': 0
+}
+
+class ToolUsage:
+    def __init__(self):
+        self.num_calls = 0
+        self.all_cacheable = True
+        self.wrote = False
+
+_TOOL_USAGE = contextvars.ContextVar('tool_usage', default=None)
+
+def enabled():
+    return shared_config('responseCache', {}).get('enabled', False)
+
+def normalize_body(body):
+    # JSON bodies are compared by value, other bodies up to whitespace
+    try:
+        return json.dumps(json.loads(body), sort_keys=True, separators=(',', ':'))
+    except (TypeError, ValueError):
+        return ' '.join(str(body).split())
+
+def is_sql_write(query):
+    query = SQL_QUOTED_PATTERN.sub(' ', query)
+    return SQL_READ_PATTERN.match(query) is None or SQL_WRITE_PATTERN.search(query) is not None
+
+def declared_ttl(protocol_document):
+    # Returns the TTL declared by the protocol document, or None if its queries are not declared cacheable
+    if protocol_document is None or CACHEABLE_PATTERN.search(protocol_document) is None:
+        return None
+
+    ttl_match = CACHE_TTL_PATTERN.search(protocol_document)
+    if ttl_match is not None:
+        return int(ttl_match.group(1))
+    return shared_config('responseCache', {}).get('ttl', DEFAULT_TTL)
+
+def record_tool_call(cacheable=False, writes=False):
+    # Called by the server's tools. Tools that write invalidate the cache even outside of a tracked query
+    if writes:
+        invalidate()
+
+    usage = _TOOL_USAGE.get()
+    if usage is not None:
+        usage.num_calls += 1
+        usage.all_cacheable = usage.all_cacheable and cacheable
+        usage.wrote = usage.wrote or writes
+
+@contextmanager
+def track_tool_calls():
+    usage = ToolUsage()
+    token = _TOOL_USAGE.set(usage)
+    try:
+        yield usage
+    finally:
+        _TOOL_USAGE.reset(token)
+
+def invalidate():
+    global GENERATION
+
+    with CACHE_LOCK:
+        GENERATION += 1
+        STATS['invalidations'] += 1
+        CACHE.clear()
+
+    logger.debug('Response cache invalidated (generation %d).', GENERATION)
+
+def get_generation():
+    return GENERATION
+
+def lookup(protocol_hash, body):
+    key = (protocol_hash, normalize_body(body))
+
+    with CACHE_LOCK:
+        entry = CACHE.get(key)
+        if entry is not None and entry['expiry'] < time.time():
+            del CACHE[key]
+            entry = None
+
+        if entry is None:
+            STATS['misses'] += 1
+            return None
+
+        STATS['hits'] += 1
+        CACHE.move_to_end(key)
+        return entry['response']
+
+def store(protocol_hash, body, response, ttl, generation):
+    max_entries = shared_config('responseCache', {}).get('maxEntries', DEFAULT_MAX_ENTRIES)
+    key = (protocol_hash, normalize_body(body))
+
+    with CACHE_LOCK:
+        if generation != GENERATION:
+            # A write happened while the response was computed
+            return
+
+        CACHE[key] = {
+            'expiry': time.time() + ttl,
+            'response': response
+        }
+        CACHE.move_to_end(key)
+        STATS['stores'] += 1
+
+        while len(CACHE) > max_entries:
+            CACHE.popitem(last=False)
+
+def cache_ttl(protocol_document, usage):
+    # Returns the TTL of a response computed with the given tool usage, or None if it can't be cached
+    if usage.wrote:
+        return None
+
+    ttl = declared_ttl(protocol_document)
+    if ttl is None and usage.num_calls > 0 and usage.all_cacheable:
+        ttl = shared_config('responseCache', {}).get('ttl', DEFAULT_TTL)
+
+    return ttl
+
+def is_successful(response):
+    if isinstance(response, str):
+        try:
+            response = json.loads(response)
+        except ValueError:
+            return False
+    return isinstance(response, dict) and response.get('status') == 'success'
+
+def get_stats():
+    with CACHE_LOCK:
+        stats = dict(STATS)
+        stats['entries'] = len(CACHE)
+    return stats
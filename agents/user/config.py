@@ -1,6 +1,10 @@
-import json
 import random
 
+from agent_logging import get_logger
+from runtime_config import get_config, on_reload, thaw
+
+logger = get_logger('user.config')
+
 TASK_CONFIGS = []
 TASK_SCHEMAS = {}
 NODE_URLS = {}
@@ -11,9 +15,8 @@ def get_protocol_db_url():
     return _PROTOCOL_DB_URL
 
 def load_standard_config(user_name):
-    print(f'Running in standalone mode as {user_name}.')
-    with open('config.json') as f:
-        config = json.load(f)
+    logger.info('Running in standalone mode as %s.', user_name)
+    config = get_config()
     
     for task_name, task_schema in config['taskSchemas'].items():
         TASK_SCHEMAS[task_name] = task_schema
@@ -23,27 +26,21 @@ def load_standard_config(user_name):
     for task_config in user_config['tasks']:
         TASK_CONFIGS.append(task_config)
 
-    with open('node_urls.json') as f:
-        node_urls = json.load(f)
-    
-    for node_id, node_url in node_urls.items():
-        NODE_URLS[node_id] = node_url
+    def update_node_urls(snapshot):
+        global _PROTOCOL_DB_URL
+        NODE_URLS.update(snapshot.node_urls)
+        _PROTOCOL_DB_URL = NODE_URLS[snapshot['users'][user_name]['protocolDb']]
 
-    global _PROTOCOL_DB_URL
-    _PROTOCOL_DB_URL = NODE_URLS[user_config['protocolDb']]
+    update_node_urls(config)
+    # Nodes can be moved without restarting the agent
+    on_reload(update_node_urls)
 
 def load_helper_config(master_server_name):
     # A helper user agent is a user agent that is used to access the external tools of a server
 
-    print(f'Running in helper mode for {master_server_name}.')
+    logger.info('Running in helper mode for %s.', master_server_name)
 
-    with open('config.json') as f:
-        config = json.load(f)
-    
-    with open('node_urls.json') as f:
-        node_urls = json.load(f)
-    for node_id, node_url in node_urls.items():
-        NODE_URLS[node_id] = node_url
+    config = get_config()
 
     server_config = config['servers'][master_server_name]
     
@@ -51,10 +48,14 @@ def load_helper_config(master_server_name):
         schema_name = external_tool_config['schema']
         task_schema = config['toolSchemas'][schema_name]
         TASK_SCHEMAS[external_tool_name] = task_schema
-    
-    global _PROTOCOL_DB_URL
-    _PROTOCOL_DB_URL = NODE_URLS[server_config['protocolDb']]
 
+    def update_node_urls(snapshot):
+        global _PROTOCOL_DB_URL
+        NODE_URLS.update(snapshot.node_urls)
+        _PROTOCOL_DB_URL = NODE_URLS[snapshot['servers'][master_server_name]['protocolDb']]
+
+    update_node_urls(config)
+    on_reload(update_node_urls)
 
 def load_config(user_name):
     if user_name.endswith('_helper'):
@@ -67,7 +68,8 @@ def get_task():
     # Pick a random task
     task_config = random.choice(TASK_CONFIGS)
     task_type = task_config['schema']
-    task_data = random.choice(task_config['choices'])
+    # The configuration is frozen, but routines and toolformers may modify their input
+    task_data = thaw(random.choice(task_config['choices']))
     target_server = random.choice(task_config['servers'])
 
     return task_type, task_data, target_server
@@ -7,7 +7,6 @@ dotenv.load_dotenv()
 import json
 import os
 from pathlib import Path
-import traceback
 from threading import Lock
 
 if os.environ.get('STORAGE_PATH') is None:
@@ -25,6 +24,9 @@ from toolformers.base import Tool, StringParameter
 from agents.user.protocol_management import decide_protocol, has_implementation
 from agents.user.config import get_task, load_config, TASK_SCHEMAS, NODE_URLS
 
+from agent_logging import get_logger, init_logging
+import http_client
+import wire_format
 from utils import load_protocol_document, execute_routine, send_raw_query, use_query_id
     
 NUM_CONVERSATIONS_FOR_PROTOCOL = -1
@@ -34,15 +36,17 @@ from flask import Flask, request
 
 app = Flask(__name__)
 
+logger = get_logger('user')
+
 mutex = Lock()
 
 def call_using_implementation(task_type, task_schema, protocol_id, task_data, target_node):
     def send_to_server(query):
-        print('Sending query:', query)
+        logger.debug('Sending query: %s', query)
         response = send_raw_query(query, protocol_id, target_node, PROTOCOL_INFOS[protocol_id]['source'])
 
         if response.status_code == 200:
-            parsed_response = json.loads(response.text)
+            parsed_response = wire_format.decode_response(target_node, response)
 
             if parsed_response['status'] == 'success':
                 body = parsed_response['body']
@@ -67,9 +71,7 @@ def call_using_implementation(task_type, task_schema, protocol_id, task_data, ta
 
         return parsed_response
     except Exception as e:
-        print(traceback.print_exception(type(e), e, e.__traceback__))
-        print('Error executing routine:', e)
-        print('Falling back to querier')
+        logger.exception('Error executing routine, falling back to querier: %s', e)
         response = send_query_with_protocol(task_schema, task_data, target_node, protocol_id, PROTOCOL_INFOS[protocol_id]['source'])
         return response
 
@@ -85,15 +87,13 @@ def main():
     query_id = data['queryId']
 
     if query_id is None:
-        print('No query ID provided.')
-    else:
-        print('Query ID:', query_id)
+        logger.warning('No query ID provided.')
 
     with mutex:
         with use_query_id(query_id):
             response = run_random_task()
+            logger.debug('Response: %s', response)
 
-    print('Response:', response, flush=True)
     save_memory()
     return response
 
@@ -125,7 +125,7 @@ def run_task(task_type, task_data, target_server):
     increment_num_conversations(task_type, target_node)
 
     if protocol_id is not None:
-        print('Using protocol:', protocol_id)
+        logger.debug('Using protocol: %s', protocol_id)
         increment_num_protocol_uses(protocol_id)
 
         # Check if we have an implementation
@@ -144,7 +144,7 @@ def run_task(task_type, task_data, target_server):
             return response
     else:
         # Use the querier without any protocol
-        print('Using the querier without any protocol')
+        logger.debug('Using the querier without any protocol')
         response = send_query_without_protocol(task_schema, task_data, target_node)
         return response
 
@@ -153,6 +153,14 @@ def run_random_task():
     task_type, task_data, target_server = get_task()
     return run_task(task_type, task_data, target_server)
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    # Does not acquire the mutex, so that the agent also answers while a query is running
+    return json.dumps({
+        'status': 'success',
+        'httpClient': http_client.get_stats()
+    })
+
 @app.route('/customRun', methods=['POST'])
 def custom_run():
     data = request.get_json()
@@ -162,19 +170,18 @@ def custom_run():
     query_id = data['queryId']
 
     if query_id is None:
-        print('No query ID provided.')
-    else:
-        print('Query ID:', query_id)
+        logger.warning('No query ID provided.')
 
-    print('Custom run:', task_type, task_data, target_server)
+    logger.debug('Custom run: %s %s %s', task_type, task_data, target_server)
 
     with mutex:
         with use_query_id(query_id):
             return run_task(task_type, task_data, target_server)
 
 def init():
+    init_logging()
     load_config(os.environ.get('AGENT_ID'))
     load_memory()
-    print('Agent initialized')
+    logger.info('Agent initialized')
 
 init()
\ No newline at end of file
@@ -2,8 +2,11 @@ import json
 import os
 from pathlib import Path
 
+from agent_logging import get_logger
 from utils import save_routine
 
+logger = get_logger('user.memory')
+
 # Stores for each protocol
 # - The id
 # - Whether it is suitable for each task
@@ -17,7 +20,7 @@ NUM_CONVERSATIONS = {}
 def load_memory():
     storage_path = Path(os.environ.get('STORAGE_PATH')) / 'memory.json'
     if not Path(storage_path).exists():
-        print('No memory found. Using default blank memory.')
+        logger.info('No memory found. Using default blank memory.')
         PROTOCOL_INFOS.clear()
         NUM_CONVERSATIONS.clear()
         return
@@ -31,7 +34,8 @@ def load_memory():
         NUM_CONVERSATIONS.clear()
         NUM_CONVERSATIONS.update(data['num_conversations'])
 
-        print('Loaded memory:', PROTOCOL_INFOS.keys())
+        logger.info('Loaded memory with %d protocols.', len(PROTOCOL_INFOS))
+        logger.debug('Known protocols: %s', list(PROTOCOL_INFOS.keys()))
 
 def save_memory():
     storage_path = Path(os.environ.get('STORAGE_PATH')) / 'memory.json'
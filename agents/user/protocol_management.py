@@ -2,10 +2,11 @@ import urllib
 
 import os
 from pathlib import Path
-import requests as request_manager
 
-
-from utils import load_protocol_document, save_protocol_document, compute_hash, shared_config
+from agent_logging import get_logger
+import http_client
+from single_flight import SingleFlight
+from utils import load_protocol_document, save_protocol_document, compute_hash, fetch_protocol
 from agents.user.config import TASK_SCHEMAS
 from agents.user.memory import get_num_conversations, PROTOCOL_INFOS, save_memory
 
@@ -15,8 +16,13 @@ from agents.common.core import Suitability
 
 from agents.user.config import get_protocol_db_url
 
+logger = get_logger('user.protocol_management')
+
+# Concurrent categorizations of a protocol for the same task type share one check
+CATEGORIZATIONS = SingleFlight()
+
 def query_protocols(target_node):
-    response = request_manager.get(f'{target_node}/wellknown', timeout=shared_config('timeout'))
+    response = http_client.get(f'{target_node}/wellknown')
     response = response.json()
 
     if response['status'] == 'success':
@@ -58,7 +64,7 @@ def get_an_adequate_protocol(task_type, eligible_protocols):
     protocols_with_implementations = [ protocol_id for protocol_id in eligible_protocols if is_adequate(task_type, protocol_id) and has_implementation(task_type, protocol_id) ]
 
     if len(protocols_with_implementations) > 0:
-        print('Found protocol with implementation:', protocols_with_implementations[0])
+        logger.debug('Found protocol with implementation: %s', protocols_with_implementations[0])
         return protocols_with_implementations[0]
 
     # If there is no matching implementation, try with protocols that have been categorized and have been deemed adequate
@@ -82,7 +88,15 @@ def get_an_adequate_protocol(task_type, eligible_protocols):
     return None
 
 def categorize_protocol(protocol_id, task_type):
-    print('Categorizing protocol:', protocol_id)
+    return CATEGORIZATIONS.do((protocol_id, task_type), _categorize_protocol, protocol_id, task_type)
+
+def _categorize_protocol(protocol_id, task_type):
+    # A call that starts right after another one finished finds its verdict
+    suitability = PROTOCOL_INFOS[protocol_id]['suitability_info'].get(task_type)
+    if suitability in [Suitability.ADEQUATE, Suitability.INADEQUATE]:
+        return suitability == Suitability.ADEQUATE
+
+    logger.info('Categorizing protocol %s for task type %s', protocol_id, task_type)
     base_folder = Path(os.environ.get('STORAGE_PATH')) / 'protocol_documents'
     protocol_document = load_protocol_document(base_folder, protocol_id)
 
@@ -98,7 +112,7 @@ def categorize_protocol(protocol_id, task_type):
     return suitable
 
 def prefilter_protocols(protocol_ids, task_type):
-    print('Prefiltering protocols:', protocol_ids, 'for task type:', task_type)
+    logger.debug('Prefiltering protocols %s for task type %s', protocol_ids, task_type)
 
     if len(protocol_ids) <= 1:
         # No point in prefiltering if there's only one protocol
@@ -107,7 +121,6 @@ def prefilter_protocols(protocol_ids, task_type):
     protocol_metadatas = []
 
     for protocol_id in protocol_ids:
-        print('Checking suitability for protocol:', protocol_id)
         if task_type not in PROTOCOL_INFOS[protocol_id]['suitability_info'] or \
           PROTOCOL_INFOS[protocol_id]['suitability_info'][task_type] == Suitability.UNKNOWN:
             protocol_metadatas.append({ 'id' : protocol_id, **PROTOCOL_INFOS[protocol_id]['metadata']})
@@ -122,7 +135,7 @@ def prefilter_protocols(protocol_ids, task_type):
 
     filtered_ids = [protocol['id'] for protocol in filtered_protocols]
 
-    print('Filtered protocols:', filtered_ids)
+    logger.debug('Filtered protocols: %s', filtered_ids)
 
     return filtered_ids
 
@@ -142,16 +155,16 @@ def register_new_protocol(protocol_id, source, protocol_data):
     save_memory()
 
 def submit_protocol_to_public_db(protocol_id, protocol_data):
-    response = request_manager.post(get_protocol_db_url(), json={
+    response = http_client.post(get_protocol_db_url(), json={
         'name': protocol_data['name'],
         'description': protocol_data['description'],
         'protocol': protocol_data['protocol']
-    }, timeout=shared_config('timeout'))
+    })
 
     source_url = f'{get_protocol_db_url()}/protocol?' + urllib.parse.urlencode({
             'id': protocol_id
         })
-    print('Submitted protocol to public database. URL:', source_url)
+    logger.info('Submitted protocol to public database. URL: %s', source_url)
 
     return source_url if response.status_code == 200 else None
 
@@ -169,10 +182,11 @@ def negotiate_protocol(task_type, target_node):
         raise Exception('Failed to submit protocol to public database')
 
     # Share the protocol with the target
-    response = request_manager.post(f'{target_node}/registerNegotiatedProtocol', json={
+    # The target checks the protocol before replying
+    response = http_client.post(f'{target_node}/registerNegotiatedProtocol', json={
         'protocolHash': protocol_id,
         'protocolSources': [source_url]
-    }, timeout=shared_config('timeout'))
+    }, tier='query')
 
     if response.status_code != 200:
         raise Exception('Failed to share the protocol with the target:', response.text)
@@ -181,37 +195,39 @@ def negotiate_protocol(task_type, target_node):
 
 def decide_protocol(task_type, target_node, num_conversations_for_protocol, num_conversations_for_negotiated_protocol):
     target_protocols = query_protocols(target_node)
-    print('Target protocols:', target_protocols)
+    logger.debug('Target protocols: %s', target_protocols)
 
     protocol_id = get_an_adequate_protocol(task_type, list(target_protocols.keys()))
 
     if protocol_id is not None:
-        print('Found adequate protocol from storage:', protocol_id)
+        logger.debug('Found adequate protocol from storage: %s', protocol_id)
         return protocol_id
 
     # If there are none, categorize the remaining target protocols, and try again
     for protocol_id, sources in target_protocols.items():
         if protocol_id not in PROTOCOL_INFOS:
-            for source in sources:
-                response = request_manager.get(source, timeout=shared_config('timeout'))
-                protocol_document = response.text
+            protocol_document, source = fetch_protocol(protocol_id, sources)
 
-                metadata = request_manager.get(source.replace('protocol', 'metadata'), timeout=shared_config('timeout')).json()
+            if protocol_document is None:
+                logger.warning('Failed to retrieve protocol: %s', protocol_id)
+                continue
 
-                if metadata['status'] != 'success':
-                    print('Failed to retrieve metadata:', metadata)
-                    continue
+            metadata = http_client.get(source.replace('protocol', 'metadata')).json()
 
-                metadata = metadata['metadata']
+            if metadata['status'] != 'success':
+                logger.warning('Failed to retrieve metadata: %s', metadata)
+                continue
 
+            metadata = metadata['metadata']
 
-                protocol_data = {
-                    'name': metadata['name'],
-                    'description': metadata['description'],
-                    'protocol': protocol_document
-                }
 
-                register_new_protocol(protocol_id, source, protocol_data)
+            protocol_data = {
+                'name': metadata['name'],
+                'description': metadata['description'],
+                'protocol': protocol_document
+            }
+
+            register_new_protocol(protocol_id, source, protocol_data)
 
     for protocol_id in prefilter_protocols(list(target_protocols.keys()), task_type):
         # Categorize the protocol
@@ -235,31 +251,27 @@ def decide_protocol(task_type, target_node, num_conversations_for_protocol, num_
     # Note: in a real system, we wouldn't get all protocols from the database, but rather
     # only the ones likely to be suitable for the task
 
-    public_protocols_response = request_manager.get(get_protocol_db_url(), timeout=shared_config('timeout')).json()
+    public_protocols_response = http_client.get(get_protocol_db_url()).json()
 
     if public_protocols_response['status'] == 'success':
         public_protocols = [x for x in public_protocols_response['protocols']]
     else:
         public_protocols = []
 
-    print('Stored protocols:', PROTOCOL_INFOS.keys())
-    print('Public protocols:', public_protocols)
+    logger.debug('Stored protocols: %s', list(PROTOCOL_INFOS.keys()))
+    logger.debug('Public protocols: %s', public_protocols)
 
     for protocol_metadata in public_protocols:
         protocol_id = protocol_metadata['id']
         # Retrieve the protocol
-        
-        print('Protocol ID:', urllib.parse.quote_plus(protocol_id))
 
         uri = f'{get_protocol_db_url()}/protocol?' + urllib.parse.urlencode({
             'id': protocol_id
         })
-        print('URI:', uri)
 
-        protocol_document_response = request_manager.get(uri, timeout=shared_config('timeout'))
+        protocol_document, _ = fetch_protocol(protocol_id, [uri])
 
-        if protocol_document_response.status_code == 200:
-            protocol_document = protocol_document_response.text
+        if protocol_document is not None:
             protocol_data = {
                 'name': protocol_metadata['name'],
                 'description': protocol_metadata['description'],
@@ -278,7 +290,7 @@ def decide_protocol(task_type, target_node, num_conversations_for_protocol, num_
 
     
     # If there are still none, check if we have talked enough times with the target to warrant a new protocol
-    requires_negotiation_response = request_manager.get(f'{target_node}/requiresNegotiation', timeout=shared_config('timeout'))
+    requires_negotiation_response = http_client.get(f'{target_node}/requiresNegotiation')
 
     requires_negotiation = requires_negotiation_response.json()['requiresNegotiation']
 
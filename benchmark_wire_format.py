@@ -0,0 +1,89 @@
+# Measures the size and the encoding/decoding time of agent-to-agent messages for each wire format.
+# Usage: python benchmark_wire_format.py [--iterations 1000] [--output wire_format_benchmark.json]
+
+import argparse
+import json
+import random
+import string
+import time
+
+import wire_format
+
+def random_text(rng, length):
+    return ''.join(rng.choice(string.ascii_letters + ' ') for _ in range(length))
+
+def make_task_data(rng, num_fields, field_length):
+    return { f'field{i}': random_text(rng, field_length) for i in range(num_fields) }
+
+def make_messages(rng):
+    # (name, message) pairs shaped like the queries and replies of send_raw_query
+    messages = []
+
+    for size_name, num_fields, field_length in [('small', 3, 10), ('medium', 20, 50), ('large', 100, 200)]:
+        for num_sources in [1, 10]:
+            messages.append((f'query-{size_name}-{num_sources}sources', {
+                'protocolHash': 'S4kbWZ7i0BH2sQJDSKr0Z1Uy+dQ=',
+                'body': json.dumps(make_task_data(rng, num_fields, field_length)),
+                'protocolSources': [f'http://localhost:{5000 + i}/protocol?id=S4kbWZ7i0BH2sQJDSKr0Z1Uy%2BdQ%3D' for i in range(num_sources)],
+                'queryId': 'geminitest_42'
+            }))
+
+        # Replies wrap a JSON-encoded body
+        messages.append((f'reply-{size_name}', {
+            'status': 'success',
+            'body': json.dumps(make_task_data(rng, num_fields, field_length))
+        }))
+
+    return messages
+
+def measure(payload, content_type, threshold, iterations):
+    start_time = time.perf_counter()
+    for _ in range(iterations):
+        data, compressed = wire_format.encode(payload, content_type, threshold)
+    encode_time = (time.perf_counter() - start_time) / iterations
+
+    start_time = time.perf_counter()
+    for _ in range(iterations):
+        decoded = wire_format.decode(data, content_type, compressed)
+    decode_time = (time.perf_counter() - start_time) / iterations
+
+    assert decoded == payload
+
+    return {
+        'bytes': len(data),
+        'encodeMicroseconds': encode_time * 1e6,
+        'decodeMicroseconds': decode_time * 1e6
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the wire formats used between agents.')
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--compression-threshold', type=int, default=wire_format.DEFAULT_COMPRESSION_THRESHOLD)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default=None)
+    args = parser.parse_args()
+
+    formats = [('json', wire_format.JSON_CONTENT_TYPE, None), ('json+deflate', wire_format.JSON_CONTENT_TYPE, args.compression_threshold)]
+    if wire_format.msgpack is not None:
+        formats += [('msgpack', wire_format.MSGPACK_CONTENT_TYPE, None), ('msgpack+deflate', wire_format.MSGPACK_CONTENT_TYPE, args.compression_threshold)]
+    else:
+        print('msgpack is not installed, only JSON is measured.')
+
+    results = []
+
+    print('Message                   | Format          |    Bytes | Encode (us) | Decode (us)')
+    for message_name, payload in make_messages(random.Random(args.seed)):
+        for format_name, content_type, threshold in formats:
+            result = measure(payload, content_type, threshold, args.iterations)
+            result['message'] = message_name
+            result['format'] = format_name
+            results.append(result)
+
+            print(f'{message_name:25} | {format_name:15} | {result["bytes"]:8} | {result["encodeMicroseconds"]:11.1f} | {result["decodeMicroseconds"]:11.1f}')
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,10 @@ COSTS = {
     'gpt-4o-mini' : {
         'prompt_tokens' : 0.15e-6,
         'completion_tokens' : 0.6e-6
+    },
+    'mock' : {
+        'prompt_tokens' : 0,
+        'completion_tokens' : 0
     }
 }
 
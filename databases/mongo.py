@@ -3,6 +3,10 @@ import os
 
 import pymongo
 
+from agent_logging import get_logger
+
+logger = get_logger('databases.mongo')
+
 client = pymongo.MongoClient(os.environ.get('MONGODB_URI'))
 
 def create_database_from_schema(name, schema):
@@ -11,7 +15,7 @@ def create_database_from_schema(name, schema):
     for collection_name, collection_schema in schema['collections'].items():
         db.create_collection(collection_name)
         collection = db[collection_name]
-        print('Collection schema:', collection_schema)
+        logger.debug('Collection schema: %s', collection_schema)
         for doc in collection_schema.get('initialValues', []):
             collection.insert_one(dict(doc))
 
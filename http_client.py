@@ -0,0 +1,121 @@
+# Shared HTTP client for the traffic between agents. Connections are kept alive and pooled per host,
+# instead of opening a new TCP connection for every call. Configured by the "httpClient" entry of the shared config, e.g.:
+# {
+#   "poolConnections": 64, // number of hosts with a pool
+#   "poolMaxSize": 16, // connections kept per host
+#   "connectTimeout": 5,
+#   "readTimeouts": { "control": 30, "download": 60, "query": 1200 }
+# }
+# Read timeouts are set per tier: "control" for discovery, metadata and synchronization calls, "download" for
+# protocol documents and "query" for calls that wait for another agent to run a task. Tiers that are not configured
+# use the "timeout" entry of the shared config.
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from request_context import span
+
+DEFAULT_POOL_CONNECTIONS = 64
+DEFAULT_POOL_MAX_SIZE = 16
+DEFAULT_CONNECT_TIMEOUT = 5
+
+TIERS = ['control', 'download', 'query']
+
+# Whether callers may send several requests at once from different threads
+ALLOW_CONCURRENT_REQUESTS = True
+
+STATS = {
+    'requests': 0,
+    'newConnections': 0
+}
+STATS_LOCK = threading.Lock()
+
+SESSION = None
+SESSION_LOCK = threading.Lock()
+CONFIG = None
+
+def _count(key):
+    with STATS_LOCK:
+        STATS[key] += 1
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        _count('newConnections')
+        return super()._new_conn()
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        _count('newConnections')
+        return super()._new_conn()
+
+class CountingHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool
+        }
+
+def _get_config():
+    global CONFIG
+
+    if CONFIG is None:
+        from utils import shared_config
+
+        config = dict(shared_config('httpClient', {}))
+        read_timeouts = config.get('readTimeouts', {})
+        config['readTimeouts'] = { tier: read_timeouts.get(tier, shared_config('timeout', None)) for tier in TIERS }
+        CONFIG = config
+
+    return CONFIG
+
+def get_session():
+    global SESSION
+
+    with SESSION_LOCK:
+        if SESSION is None:
+            config = _get_config()
+            adapter = CountingHTTPAdapter(
+                pool_connections=config.get('poolConnections', DEFAULT_POOL_CONNECTIONS),
+                pool_maxsize=config.get('poolMaxSize', DEFAULT_POOL_MAX_SIZE)
+            )
+
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            SESSION = session
+
+    return SESSION
+
+def get_timeout(tier):
+    config = _get_config()
+
+    if tier not in config['readTimeouts']:
+        raise ValueError(f'Unknown timeout tier: {tier}')
+
+    return (config.get('connectTimeout', DEFAULT_CONNECT_TIMEOUT), config['readTimeouts'][tier])
+
+def request(method, url, tier='control', **kwargs):
+    if 'timeout' not in kwargs:
+        kwargs['timeout'] = get_timeout(tier)
+
+    _count('requests')
+    with span(f'{method} {url}'):
+        return get_session().request(method, url, **kwargs)
+
+def get(url, params=None, tier='control', **kwargs):
+    return request('GET', url, tier=tier, params=params, **kwargs)
+
+def post(url, data=None, json=None, tier='control', **kwargs):
+    return request('POST', url, tier=tier, data=data, json=json, **kwargs)
+
+def get_stats():
+    with STATS_LOCK:
+        stats = dict(STATS)
+
+    stats['reusedConnections'] = max(0, stats['requests'] - stats['newConnections'])
+    stats['reuseRate'] = stats['reusedConnections'] / stats['requests'] if stats['requests'] > 0 else None
+    return stats
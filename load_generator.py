@@ -0,0 +1,182 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import aiohttp
+
+SAMPLE_INTERVAL = 1 # seconds
+TIMEOUT = 1200 # 20 minutes
+
+def compute_percentile(values, percentile):
+    if len(values) == 0:
+        return None
+
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percentile / 100 * (len(values) - 1))))
+    return values[index]
+
+def parse_rates(value):
+    # argparse type for a comma-separated list of arrival rates (requests/s)
+    try:
+        rates = [float(rate) for rate in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid rates: {value}')
+
+    for rate in rates:
+        if rate <= 0:
+            raise argparse.ArgumentTypeError(f'Arrival rates must be positive, got {rate}')
+
+    return rates
+
+def next_interarrival_time(rate, arrival):
+    if arrival == 'poisson':
+        return random.expovariate(rate)
+    elif arrival == 'constant':
+        return 1 / rate
+    else:
+        raise ValueError(f'Unknown arrival process: {arrival}')
+
+async def send_custom_run(session, user_url, payload, state):
+    # Returns the latency of the request and whether it succeeded
+    state['in_flight'] += 1
+    state['max_in_flight'] = max(state['max_in_flight'], state['in_flight'])
+    start_time = time.time()
+
+    try:
+        async with session.post(user_url + '/customRun', json=payload) as response:
+            await response.read()
+            success = response.status == 200
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f'{payload["queryId"]}: Request failed:', e)
+        success = False
+    finally:
+        state['in_flight'] -= 1
+
+    latency = time.time() - start_time
+
+    if success:
+        state['completed'] += 1
+    else:
+        state['errors'] += 1
+
+    return {
+        'queryId': payload['queryId'],
+        'sentAt': start_time,
+        'latency': latency,
+        'success': success
+    }
+
+async def sample_state(state, start_time, samples):
+    while True:
+        samples.append({
+            'time': time.time() - start_time,
+            'inFlight': state['in_flight'],
+            'completed': state['completed'],
+            'errors': state['errors']
+        })
+        await asyncio.sleep(SAMPLE_INTERVAL)
+
+async def run_load_level(session, task_list, rate, duration, arrival):
+    # Open loop: requests are sent according to the arrival schedule, regardless of how many are still in flight
+    state = {
+        'in_flight': 0,
+        'max_in_flight': 0,
+        'completed': 0,
+        'errors': 0
+    }
+    samples = []
+    requests = []
+
+    start_time = time.time()
+    sampler = asyncio.create_task(sample_state(state, start_time, samples))
+
+    next_send_time = start_time
+    counter = 0
+
+    while next_send_time - start_time < duration:
+        await asyncio.sleep(max(0, next_send_time - time.time()))
+
+        _, user_id, user_url, target, task, data = task_list[counter % len(task_list)]
+        payload = {
+            'queryId': f'loadtest_{rate}_{counter}',
+            'targetServer': target,
+            'type': task,
+            'data': data
+        }
+        requests.append(asyncio.create_task(send_custom_run(session, user_url, payload, state)))
+
+        counter += 1
+        next_send_time += next_interarrival_time(rate, arrival)
+
+    records = await asyncio.gather(*requests)
+    end_time = time.time()
+
+    sampler.cancel()
+
+    latencies = [record['latency'] for record in records if record['success']]
+
+    return {
+        'offeredRate': rate,
+        'arrival': arrival,
+        'numRequests': len(records),
+        'throughput': len(latencies) / (end_time - start_time),
+        'errorRate': state['errors'] / len(records) if len(records) > 0 else 0,
+        'latencyP50': compute_percentile(latencies, 50),
+        'latencyP90': compute_percentile(latencies, 90),
+        'latencyP99': compute_percentile(latencies, 99),
+        'maxInFlight': state['max_in_flight'],
+        'samples': samples,
+        'records': records
+    }
+
+async def run_load_test_async(task_list, rates, duration, arrival, max_connections):
+    connector = aiohttp.TCPConnector(limit=max_connections)
+    timeout = aiohttp.ClientTimeout(total=TIMEOUT)
+    results = []
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        for rate in rates:
+            print(f'Running load level: {rate} requests/s ({arrival} arrivals) for {duration} seconds...')
+            results.append(await run_load_level(session, task_list, rate, duration, arrival))
+
+    return results
+
+def format_seconds(value):
+    return 'n/a' if value is None else f'{value:.2f}'
+
+def save_latency_plot(results, path):
+    import matplotlib.pyplot as plt
+
+    throughputs = [result['throughput'] for result in results]
+
+    plt.figure()
+    for key in ['latencyP50', 'latencyP90', 'latencyP99']:
+        plt.plot(throughputs, [result[key] for result in results], marker='o', label=key[len('latency'):])
+    plt.xlabel('Throughput (requests/s)')
+    plt.ylabel('Latency (s)')
+    plt.legend()
+    plt.savefig(path)
+    plt.close()
+
+def run_load_test(task_list, rates, duration, arrival, max_connections, output_path='load_test.json'):
+    # Only /customRun actions can be replayed: synchronizations are not part of the load
+    task_list = [task for task in task_list if task[4] != 'synchronization']
+
+    results = asyncio.run(run_load_test_async(task_list, rates, duration, arrival, max_connections))
+
+    print('Offered rate | Throughput | P50 latency | P90 latency | P99 latency | Error rate | Max in flight')
+    for result in results:
+        print(
+            f'{result["offeredRate"]:12.2f} | {result["throughput"]:10.2f} | {format_seconds(result["latencyP50"]):>11} | '
+            f'{format_seconds(result["latencyP90"]):>11} | {format_seconds(result["latencyP99"]):>11} | '
+            f'{result["errorRate"]:10.2%} | {result["maxInFlight"]:13}'
+        )
+
+    with open(output_path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    save_latency_plot(results, output_path.replace('.json', '.png'))
+
+    return results
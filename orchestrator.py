@@ -4,20 +4,81 @@ sys.path.append('.')
 import dotenv
 dotenv.load_dotenv()
 
-import concurrent.futures
+import argparse
+import asyncio
+import heapq
 import json
+import os
 from pathlib import Path
-import queue
 import time
 
-import libtmux
-import requests as request_manager
+import aiohttp
 
 import databases.mongo as mongo
 import databases.sql as sql
+from load_generator import parse_rates, run_load_test
+from simulation import Simulation
+from supervisor import Supervisor, get_agent_launch_phases
 
-NUM_WORKERS = 20
+MAX_CONCURRENT_QUERIES = 1000
 TIMEOUT = 1200 # 20 minutes
+STARTUP_TIMEOUT = 300 # 5 minutes
+HEALTH_CHECK_INTERVAL = 0.1
+RESULTS_STREAM_PATH = 'results.jsonl'
+
+class ResultStream:
+    # Appends every result to a JSONL file as soon as it is available, so that an interrupted
+    # run can be resumed without repeating the queries that already completed
+    def __init__(self, path, resume):
+        self.path = Path(path)
+        self.completed = {}
+
+        if resume and self.path.exists():
+            self._load()
+            self.file = open(self.path, 'a')
+            if not self._ends_with_newline():
+                # The previous run was interrupted in the middle of a write
+                self.file.write('\n')
+        else:
+            self.file = open(self.path, 'w')
+
+    def _load(self):
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    print('Skipping truncated result:', line)
+                    continue
+                self.completed[record['queryId']] = record['result']
+
+        print(f'Resuming: found {len(self.completed)} completed queries in {self.path}.')
+
+    def _ends_with_newline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                return True
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def get_result(self, task):
+        # Synchronizations are cheap and do not have unique query IDs, so they are always repeated
+        query_id, _, _, _, task_type, _ = task
+        if task_type == 'synchronization':
+            return None
+        return self.completed.get(query_id)
+
+    def write(self, task, result):
+        self.file.write(json.dumps({
+            'queryId': task[0],
+            'result': result
+        }) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
 
 def create_id_to_url_mappings(config):
     mapping = {}
@@ -49,134 +110,162 @@ def create_id_to_url_mappings(config):
 
     return mapping
 
-def launch_instance(tmux_server, instance_type, model_type, agent_id, base_log_path, base_storage_path, id_to_url_mappings):
-    session = tmux_server.new_session(session_name=agent_id, kill_session=True)
-    pane = session.active_window.active_pane
-    port = id_to_url_mappings[agent_id].split(':')[-1]
+async def wait_until_healthy(session, agent_id, agent_url, start_time):
+    while True:
+        try:
+            async with session.get(agent_url + '/healthz') as response:
+                if response.status == 200:
+                    return time.time() - start_time
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            # The agent is not listening yet
+            pass
+
+        if time.time() - start_time > STARTUP_TIMEOUT:
+            raise TimeoutError(f'Agent {agent_id} did not become ready within {STARTUP_TIMEOUT} seconds.')
+
+        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
 
-    storage_instance_type = 'helper' if 'helper' in agent_id else instance_type
+async def wait_for_agents_async(agent_ids, id_to_url_mappings, start_time):
+    timeout = aiohttp.ClientTimeout(total=1)
 
-    storage_path = base_storage_path / storage_instance_type / agent_id
-    log_path = base_log_path / storage_instance_type / (agent_id + '.log')
-    log_path.parent.mkdir(parents=True, exist_ok=True)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        times_to_ready = await asyncio.gather(*[
+            wait_until_healthy(session, agent_id, id_to_url_mappings[agent_id], start_time)
+            for agent_id in agent_ids
+        ])
 
-    model_type_info = f'MODEL_TYPE={model_type}' if model_type is not None else ''
+    for agent_id, time_to_ready in zip(agent_ids, times_to_ready):
+        print(f'{agent_id} ready after {time_to_ready:.2f} seconds.')
 
-    pane.send_keys(f'PYTHONUNBUFFERED=1 STORAGE_PATH={storage_path} {model_type_info} AGENT_ID={agent_id} flask --app agents/{instance_type}/main.py run --port {port} 2>&1 | tee {log_path}')
+def wait_for_agents(agent_ids, id_to_url_mappings, start_time):
+    # Polls the /healthz endpoint of all the agents concurrently and returns once all of them answer
+    asyncio.run(wait_for_agents_async(list(agent_ids), id_to_url_mappings, start_time))
 
-def run_query(query_id, user_id, user_url, target, task, data):
+async def run_query(session, query_id, user_id, user_url, target, task, data):
     if task == 'synchronization':
         print('Synchronizing', user_id)
-        response = request_manager.post(user_url + '/synchronize', timeout=TIMEOUT)
+        response = await session.post(user_url + '/synchronize')
     else:
         print(f'{query_id}: Sending task {task} to {target} for user {user_id} with data {data}')
-        response = request_manager.post(user_url +'/customRun', json={
+        response = await session.post(user_url + '/customRun', json={
             'queryId': query_id,
             'targetServer': target,
             'type': task,
             'data': data
-        }, timeout=TIMEOUT)
-    print('Response from', user_id, ':', response.text)
-    return response.text
+        })
 
-def process_task(worker_id, task):
-    result = run_query(*task)
-    return result
+    async with response:
+        text = await response.text()
+    print('Response from', user_id, ':', text)
+    return text
 
-def worker(worker_id, task_queue, result_list):
-    while not task_queue.empty():
-        try:
-            index, task = task_queue.get_nowait()
-            result = process_task(worker_id, task)
-            result_list[index] = result  # Store the result at the original index
-            task_queue.task_done()
-        except queue.Empty:
-            break
-
-def fifo_task_processor(task_list, num_workers):
-    # Create a queue and add tasks with their indices to it
-    task_queue = queue.Queue()
-    result_list = [None] * len(task_list)  # Placeholder for results in original order
+def split_into_phases(task_list):
+    # Synchronization actions are barriers: they only start once every action before them has completed,
+    # and no action after them starts before they are done. Consecutive synchronizations form a single barrier
+    phases = []
 
     for index, task in enumerate(task_list):
-        task_queue.put((index, task))
-
-    # Create a thread pool with the specified number of workers
-    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
-        # Start the worker threads
-        futures = [executor.submit(worker, i, task_queue, result_list) for i in range(num_workers)]
-        
-        # Wait for all tasks to be processed
-        for future in concurrent.futures.as_completed(futures):
-            future.result()
-
-    return result_list
-
-def run_asynchronous(actions):
-    return fifo_task_processor(actions, NUM_WORKERS)
-
-def main():
-    # 1. Reset the databases and the memory (optional)
-    mongo.reset_databases()
-
-    sql.wait_for_sql_server()
-
-    sql.reset_database()
-    # TODO: Reset the memory
-
-    # 2. Create the id-to-url mappings
-    with open('config.json') as f:
-        config = json.load(f)
-    
-    id_to_url_mappings = create_id_to_url_mappings(config)
-
-    with open('node_urls.json', 'w') as f:
-        json.dump(id_to_url_mappings, f, indent=2)
+        is_barrier = task[4] == 'synchronization'
+        if len(phases) == 0 or phases[-1][0] != is_barrier:
+            phases.append((is_barrier, []))
+        phases[-1][1].append((index, task))
+
+    return phases
+
+def group_by_user(indexed_tasks):
+    # One queue per user, in order of first appearance. Each queue keeps the original order of the user's actions
+    user_queues = {}
+
+    for index, task in indexed_tasks:
+        user_id = task[1]
+        user_queues.setdefault(user_id, []).append((index, task))
+
+    return user_queues
+
+async def run_user_queue(session, semaphore, user_queue, result_list, result_stream):
+    # User agents serve one query at a time (see the mutex in agents/user/main.py), so a user's
+    # next action is only dispatched once the previous one is done. An idle user never holds a slot
+    for index, task in user_queue:
+        result_list[index] = result_stream.get_result(task)
+        if result_list[index] is not None:
+            continue
+
+        async with semaphore:
+            result_list[index] = await run_query(session, *task)
+        result_stream.write(task, result_list[index])
+
+async def run_phase(session, semaphore, indexed_tasks, result_list, result_stream):
+    await asyncio.gather(*[
+        run_user_queue(session, semaphore, user_queue, result_list, result_stream)
+        for user_queue in group_by_user(indexed_tasks).values()
+    ])
+
+async def async_task_processor(task_list, max_concurrency, result_stream):
+    # At most max_concurrency actions are in flight at once, and at most one per user
+    result_list = [None] * len(task_list)  # Placeholder for results in original order
+    semaphore = asyncio.Semaphore(max_concurrency)
 
-    # 3. Launch the protocol DB servers
+    connector = aiohttp.TCPConnector(limit=max_concurrency)
+    timeout = aiohttp.ClientTimeout(total=TIMEOUT)
 
-    base_storage_path = Path('storage')
-    base_log_path = Path('logs')
-    tmux_server = libtmux.Server()
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        for is_barrier, indexed_tasks in split_into_phases(task_list):
+            if is_barrier:
+                print('Reached synchronization barrier. Synchronizing', len(indexed_tasks), 'protocol DB(s).')
+            await run_phase(session, semaphore, indexed_tasks, result_list, result_stream)
 
-    for protocol_db_id in config['protocolDbs']:
-        launch_instance(tmux_server, 'protocol_db', None, protocol_db_id, base_log_path, base_storage_path, id_to_url_mappings)
+    return result_list
 
-    time.sleep(1)
+def simulate_fifo_makespan(task_list, num_workers):
+    # Each worker picks the next action in order and blocks (on the user's mutex) until the user is free.
+    # Every action is assumed to take one time unit
+    worker_free_times = [0] * num_workers
+    user_free_times = {}
 
-    print('Launching server agents...')
+    for task in task_list:
+        user_id = task[1]
+        worker_free_time = heapq.heappop(worker_free_times)
+        end_time = max(worker_free_time, user_free_times.get(user_id, 0)) + 1
+        user_free_times[user_id] = end_time
+        heapq.heappush(worker_free_times, end_time)
 
-    # 4. Launch the server agents
-    for server_id, server_config in config['servers'].items():
-        launch_instance(tmux_server, 'server', server_config['modelType'], server_id, base_log_path, base_storage_path, id_to_url_mappings)
+    return max(worker_free_times, default=0)
 
-        external_tools_config = server_config.get('externalTools', {})
+def simulate_per_user_makespan(task_list, num_workers):
+    # Phases are separated by synchronization barriers. Within a phase, at every time step, up to
+    # num_workers users with pending actions are dispatched (in order of first appearance)
+    makespan = 0
 
-        if len(external_tools_config) > 0:
-            # Build a helper user agent
-            helper_user_id = server_id + '_helper'
-            launch_instance(tmux_server, 'user', server_config['modelType'], helper_user_id, base_log_path, base_storage_path, id_to_url_mappings)
+    for _, indexed_tasks in split_into_phases(task_list):
+        remaining = [len(user_queue) for user_queue in group_by_user(indexed_tasks).values()]
 
-    time.sleep(2)
+        while any(remaining):
+            dispatched = 0
+            for i in range(len(remaining)):
+                if dispatched == num_workers:
+                    break
+                if remaining[i] > 0:
+                    remaining[i] -= 1
+                    dispatched += 1
+            makespan += 1
 
-    print('Launching user agents...')
+    return makespan
 
-    # 5. Launch the user agents
-    for user_id, user_config in config['users'].items():
-        launch_instance(tmux_server, 'user', user_config['modelType'], user_id, base_log_path, base_storage_path, id_to_url_mappings)
+def report_scheduling_speedup(task_list, max_concurrency):
+    fifo_makespan = simulate_fifo_makespan(task_list, max_concurrency)
+    per_user_makespan = simulate_per_user_makespan(task_list, max_concurrency)
 
-    # 6. Wait for the agents to be ready
-    
-    print('Waiting for the agents to be ready...', end='', flush=True)
-    for i in range(3):
-        time.sleep(1)
-        print('.', end='', flush=True)
-    print('')
+    print(f'Estimated makespan (in units of one action) with {max_concurrency} slots:')
+    print('- FIFO scheduling:', fifo_makespan)
+    print('- Per-user scheduling (with synchronization barriers):', per_user_makespan)
 
-    print('Sending sample ping.')
+    if per_user_makespan > 0:
+        print(f'Estimated speedup: {fifo_makespan / per_user_makespan:.2f}x')
 
-    # 7. Execute the screenplay
+def run_asynchronous(actions, result_stream, max_concurrency=MAX_CONCURRENT_QUERIES):
+    return asyncio.run(async_task_processor(actions, max_concurrency, result_stream))
 
+def load_actions(id_to_url_mappings):
     with open('actions.json', 'r') as f:
         actions = json.load(f)
 
@@ -194,10 +283,119 @@ def main():
         if task != 'synchronization':
             query_id_counter += 1
 
-    results = run_asynchronous(parsed_actions)
+    return parsed_actions
+
+def execute_screenplay(config, id_to_url_mappings, simulation=None, resume=False):
+    parsed_actions = load_actions(id_to_url_mappings)
+    result_stream = ResultStream(RESULTS_STREAM_PATH, resume)
+
+    try:
+        if simulation is not None:
+            # In-process agents handle one request at a time, so the screenplay is run in order
+            start_time = time.time()
+            results = simulation.run_screenplay(parsed_actions, result_stream)
+        else:
+            max_concurrency = config['orchestration'].get('maxConcurrentQueries', MAX_CONCURRENT_QUERIES)
+            report_scheduling_speedup(parsed_actions, max_concurrency)
+
+            start_time = time.time()
+            results = run_asynchronous(parsed_actions, result_stream, max_concurrency)
+    finally:
+        result_stream.close()
+
+    print(f'Screenplay executed in {time.time() - start_time:.2f} seconds.')
 
     with open('results.json', 'w') as f:
         json.dump(results, f, indent=2)
 
+def run_with_supervisor(config, id_to_url_mappings, args):
+    supervisor = Supervisor(config, id_to_url_mappings, Path('logs'), Path('storage'))
+    protocol_dbs, servers, users = get_agent_launch_phases(config)
+
+    try:
+        # 3. Launch the protocol DB servers
+        start_time = time.time()
+        supervisor.launch_all(protocol_dbs)
+
+        print('Waiting for the protocol DBs to be ready...')
+        wait_for_agents([agent_id for _, _, agent_id in protocol_dbs], id_to_url_mappings, start_time)
+
+        print('Launching server agents...')
+
+        # 4. Launch the server agents (and their helpers)
+        start_time = time.time()
+        supervisor.launch_all(servers)
+
+        print('Waiting for the server agents to be ready...')
+        wait_for_agents([agent_id for _, _, agent_id in servers], id_to_url_mappings, start_time)
+
+        print('Launching user agents...')
+
+        # 5. Launch the user agents
+        start_time = time.time()
+        supervisor.launch_all(users)
+
+        # 6. Wait for the agents to be ready
+
+        print('Waiting for the user agents to be ready...')
+        wait_for_agents([agent_id for _, _, agent_id in users], id_to_url_mappings, start_time)
+
+        if args.load_test:
+            # 7. Replay the screenplay's actions at the requested arrival rates
+            max_connections = config['orchestration'].get('maxConcurrentQueries', MAX_CONCURRENT_QUERIES)
+            run_load_test(load_actions(id_to_url_mappings), args.rates, args.duration, args.arrival, max_connections)
+        else:
+            # 7. Execute the screenplay
+            execute_screenplay(config, id_to_url_mappings, resume=args.resume)
+    finally:
+        supervisor.shutdown()
+
+def run_in_process(config, id_to_url_mappings, args):
+    simulation = Simulation(id_to_url_mappings, Path('storage'))
+
+    with simulation.activate():
+        start_time = time.time()
+        for phase in get_agent_launch_phases(config):
+            simulation.load_all(phase)
+        print(f'Loaded {len(simulation.agents)} agents in {time.time() - start_time:.2f} seconds.')
+
+        execute_screenplay(config, id_to_url_mappings, simulation, resume=args.resume)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--in-process', action='store_true', help='Run all the agents in this process, routing inter-agent calls in memory instead of over HTTP')
+    parser.add_argument('--load-test', action='store_true', help='Instead of running the screenplay, send its actions to the user agents at fixed arrival rates')
+    parser.add_argument('--rates', type=parse_rates, default='0.1,0.5,1,2', help='Comma-separated arrival rates (requests/s) for the load test')
+    parser.add_argument('--duration', type=float, default=60, help='Duration (in seconds) of each load level')
+    parser.add_argument('--arrival', choices=['poisson', 'constant'], default='poisson', help='Arrival process for the load test')
+    # The databases are not reset when resuming, so that the resumed queries see the writes of the completed ones
+    parser.add_argument('--resume', action='store_true', help=f'Skip the queries that already have a result in {RESULTS_STREAM_PATH} (keeps the current database state)')
+    args = parser.parse_args()
+
+    if args.in_process and args.load_test:
+        parser.error('--load-test requires agents running as separate processes')
+
+    # 1. Reset the databases and the memory (optional)
+    sql.wait_for_sql_server()
+
+    if not args.resume:
+        mongo.reset_databases()
+        sql.reset_database()
+    # TODO: Reset the memory
+
+    # 2. Create the id-to-url mappings
+    with open('config.json') as f:
+        config = json.load(f)
+    
+    id_to_url_mappings = create_id_to_url_mappings(config)
+
+    with open('node_urls.json', 'w') as f:
+        json.dump(id_to_url_mappings, f, indent=2)
+
+    if args.in_process:
+        run_in_process(config, id_to_url_mappings, args)
+    else:
+        run_with_supervisor(config, id_to_url_mappings, args)
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
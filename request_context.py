@@ -0,0 +1,109 @@
+# Per-request state (query ID, token usage and trace spans), stored in context variables so that several requests
+# can be handled at the same time by the same process. Asyncio tasks inherit the context automatically,
+# while functions that run in other threads must be wrapped with propagate_context.
+
+from contextlib import contextmanager
+import contextvars
+import threading
+import time
+
+class RequestContext:
+    def __init__(self, query_id):
+        self.query_id = query_id
+        self.start_time = time.time()
+        self.usage = []
+        self.spans = []
+        # Threads started by the request share this object
+        self.lock = threading.Lock()
+
+    def record_usage(self, usage):
+        with self.lock:
+            self.usage.append(usage)
+
+    def record_span(self, name, start_time, duration):
+        with self.lock:
+            self.spans.append({
+                'name': name,
+                'start': start_time - self.start_time,
+                'duration': duration
+            })
+
+    def summary(self):
+        with self.lock:
+            return {
+                'queryId': self.query_id,
+                'duration': time.time() - self.start_time,
+                'usage': sum_usage(self.usage),
+                'spans': list(self.spans)
+            }
+
+_REQUEST_CONTEXT = contextvars.ContextVar('request_context', default=None)
+_USAGE_SCOPE = contextvars.ContextVar('usage_scope', default=None)
+
+def sum_usage(usages):
+    return {
+        'prompt_tokens': sum(usage['prompt_tokens'] for usage in usages),
+        'completion_tokens': sum(usage['completion_tokens'] for usage in usages)
+    }
+
+@contextmanager
+def request_context(query_id):
+    # Contexts can be nested (e.g. when agents run in the same process), the outer one is restored on exit
+    context = RequestContext(query_id)
+    token = _REQUEST_CONTEXT.set(context)
+    try:
+        yield context
+    finally:
+        _REQUEST_CONTEXT.reset(token)
+
+def get_request_context():
+    return _REQUEST_CONTEXT.get()
+
+def get_query_id():
+    context = _REQUEST_CONTEXT.get()
+    return context.query_id if context is not None else None
+
+@contextmanager
+def usage_scope():
+    # Collects the usage of the individual model calls inside the scope (e.g. the streamed completions of a single chat)
+    usages = []
+    token = _USAGE_SCOPE.set(usages)
+    try:
+        yield usages
+    finally:
+        _USAGE_SCOPE.reset(token)
+
+def record_scope_usage(usage):
+    usages = _USAGE_SCOPE.get()
+    if usages is not None:
+        usages.append(usage)
+
+def get_scope_usage():
+    # Zero outside of a usage scope
+    return sum_usage(_USAGE_SCOPE.get() or [])
+
+def record_usage(usage):
+    # Adds the usage of a chat to the current request
+    context = _REQUEST_CONTEXT.get()
+    if context is not None:
+        context.record_usage(usage)
+
+@contextmanager
+def span(name):
+    context = _REQUEST_CONTEXT.get()
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        if context is not None:
+            context.record_span(name, start_time, time.time() - start_time)
+
+def propagate_context(function):
+    # Runs the function in a copy of the caller's context, e.g. for threading.Thread(target=propagate_context(f))
+    context = contextvars.copy_context()
+
+    def wrapped(*args, **kwargs):
+        # A context can't be entered by two threads at once, so every call gets its own copy
+        return context.copy().run(function, *args, **kwargs)
+
+    return wrapped
@@ -0,0 +1,139 @@
+# Runs routines in a pool of warm worker processes, so that a slow, hanging or memory-hungry routine cannot stall the agent.
+# Tools are not sent to the workers: when a routine calls a tool, the call is proxied back to the agent process,
+# which runs it and sends back the result.
+
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+
+DEFAULT_NUM_WORKERS = 4
+DEFAULT_TIMEOUT = 60 # seconds, not counting the time spent running tools in the agent process
+DEFAULT_MEMORY_LIMIT = 1024 * 1024 * 1024 # 1 GB of address space per worker
+
+class RoutineError(Exception):
+    pass
+
+class RoutineTimeoutError(RoutineError):
+    pass
+
+class RemoteToolError(Exception):
+    pass
+
+def _worker_main(connection, memory_limit):
+    import resource
+
+    # Routines are loaded with the same cache as in-process execution (keyed by the routine file, i.e. the protocol
+    # hash, and its version), so a long-lived worker runs each routine's module code once
+    from utils import _load_routine, _bind_tools
+
+    if memory_limit is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    class ProxyTool:
+        def __init__(self, name):
+            self.name = name
+
+        def as_executable_function(self):
+            def f(*args, **kwargs):
+                connection.send(('tool_call', self.name, args, kwargs))
+                status, value = connection.recv()
+                if status == 'tool_error':
+                    raise RemoteToolError(value)
+                return value
+            return f
+
+    while True:
+        try:
+            module_name, path, task_data, tool_names = connection.recv()
+        except EOFError:
+            # The agent process is gone
+            return
+
+        try:
+            namespace = _load_routine(module_name, path)
+            with _bind_tools(namespace, [ProxyTool(name) for name in tool_names]) as run:
+                output = run(task_data)
+            connection.send(('result', output))
+        except Exception as e:
+            connection.send(('error', ''.join(traceback.format_exception(type(e), e, e.__traceback__))))
+
+class RoutineWorker:
+    def __init__(self, context, memory_limit):
+        self.connection, worker_connection = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(worker_connection, memory_limit), daemon=True)
+        self.process.start()
+        worker_connection.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+class RoutinePool:
+    def __init__(self, num_workers=DEFAULT_NUM_WORKERS, timeout=DEFAULT_TIMEOUT, memory_limit=DEFAULT_MEMORY_LIMIT):
+        # Workers are forked from a fresh server process instead of the agent, so that they are small
+        # (which makes the memory limit meaningful) and do not inherit the agent's threads and connections
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self.context = multiprocessing.get_context(method)
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+
+        self.idle_workers = queue.Queue()
+        for _ in range(num_workers):
+            self.idle_workers.put(RoutineWorker(self.context, memory_limit))
+
+    def execute(self, module_name, path, task_data, tools):
+        tools_by_name = { tool.name: tool for tool in tools }
+        worker = self.idle_workers.get()
+
+        try:
+            worker.connection.send((module_name, str(path), task_data, list(tools_by_name.keys())))
+
+            remaining_time = self.timeout
+
+            while True:
+                wait_start = time.time()
+                if not worker.connection.poll(remaining_time):
+                    raise RoutineTimeoutError(f'Routine {path} did not complete within {self.timeout} seconds.')
+                message = worker.connection.recv()
+                remaining_time -= time.time() - wait_start
+
+                if message[0] == 'tool_call':
+                    _, tool_name, args, kwargs = message
+                    try:
+                        tool_output = tools_by_name[tool_name].as_executable_function()(*args, **kwargs)
+                        worker.connection.send(('tool_result', tool_output))
+                    except Exception as e:
+                        worker.connection.send(('tool_error', str(e)))
+                elif message[0] == 'result':
+                    return message[1]
+                else:
+                    raise RoutineError(f'Routine {path} failed:\n{message[1]}')
+        except (RoutineTimeoutError, EOFError, OSError) as e:
+            # The worker is stuck or dead (e.g. because it ran out of memory): replace it
+            worker.kill()
+            worker = RoutineWorker(self.context, self.memory_limit)
+
+            if isinstance(e, RoutineTimeoutError):
+                raise
+            raise RoutineError(f'Routine worker crashed while running {path}.') from e
+        finally:
+            self.idle_workers.put(worker)
+
+ROUTINE_POOL = None
+ROUTINE_POOL_LOCK = threading.Lock()
+
+def get_routine_pool(pool_config):
+    global ROUTINE_POOL
+
+    with ROUTINE_POOL_LOCK:
+        if ROUTINE_POOL is None:
+            ROUTINE_POOL = RoutinePool(
+                num_workers=pool_config.get('numWorkers', DEFAULT_NUM_WORKERS),
+                timeout=pool_config.get('timeout', DEFAULT_TIMEOUT),
+                memory_limit=pool_config.get('memoryLimit', DEFAULT_MEMORY_LIMIT)
+            )
+
+    return ROUTINE_POOL
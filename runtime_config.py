@@ -0,0 +1,217 @@
+# Validated, read-only snapshot of config.json and node_urls.json, shared by all the modules of an agent.
+# The files are checked for changes at most every RELOAD_CHECK_INTERVAL seconds, and a new snapshot is swapped in
+# (after validation) when they change, so that e.g. node URLs can be changed without restarting the agents.
+# The launcher can also publish a pickled snapshot (publish_snapshot) and point the agents to it with the
+# CONFIG_SNAPSHOT_PATH environment variable: agents then map it read-only instead of parsing and validating the JSON files.
+
+import json
+import logging
+import mmap
+import os
+import pickle
+import threading
+import time
+
+CONFIG_PATH = 'config.json'
+NODE_URLS_PATH = 'node_urls.json'
+RELOAD_CHECK_INTERVAL = 1 # seconds
+
+# Part of the agents' logger hierarchy (see agent_logging), which can't be imported here since it depends on this module
+logger = logging.getLogger('agent.runtime_config')
+
+class ConfigError(Exception):
+    pass
+
+class FrozenDict(dict):
+    # A dict that can't be modified. Being a dict, it can still be passed to json.dumps and to the LLM APIs
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('The configuration is read-only.')
+
+    __setitem__ = _readonly
+    __delitem__ = _readonly
+    __ior__ = _readonly
+    clear = _readonly
+    pop = _readonly
+    popitem = _readonly
+    setdefault = _readonly
+    update = _readonly
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+def freeze(value):
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+def thaw(value):
+    # Mutable copy of a frozen value
+    if isinstance(value, dict):
+        return { key: thaw(item) for key, item in value.items() }
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+class ConfigSnapshot:
+    def __init__(self, config, node_urls, fingerprint):
+        self.config = config
+        self.node_urls = node_urls
+        self.fingerprint = fingerprint
+
+    def __getitem__(self, key):
+        return self.config[key]
+
+    def get(self, key, fallback=None):
+        return self.config.get(key, fallback)
+
+def _fingerprint():
+    fingerprint = {}
+    for path in [CONFIG_PATH, NODE_URLS_PATH]:
+        try:
+            stat = os.stat(path)
+            fingerprint[path] = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            fingerprint[path] = None
+    return fingerprint
+
+def _check(condition, message):
+    if not condition:
+        raise ConfigError(message)
+
+def validate(config, node_urls):
+    _check(isinstance(config, dict), 'The configuration must be a JSON object.')
+    _check(isinstance(config.get('shared'), dict), 'Missing "shared" section.')
+
+    for section in ['users', 'servers', 'protocolDbs', 'taskSchemas', 'toolSchemas', 'dbSchemas']:
+        _check(isinstance(config.get(section, {}), dict), f'Section "{section}" must be a JSON object.')
+
+    users = config.get('users', {})
+    servers = config.get('servers', {})
+    protocol_dbs = config.get('protocolDbs', {})
+    task_schemas = config.get('taskSchemas', {})
+    tool_schemas = config.get('toolSchemas', {})
+    db_schemas = config.get('dbSchemas', {})
+
+    for user_id, user_config in users.items():
+        _check('modelType' in user_config, f'User {user_id} has no modelType.')
+        _check(user_config.get('protocolDb') in protocol_dbs, f'User {user_id} refers to an unknown protocol DB: {user_config.get("protocolDb")}')
+
+        for task_config in user_config.get('tasks', []):
+            _check(task_config.get('schema') in task_schemas, f'User {user_id} refers to an unknown task schema: {task_config.get("schema")}')
+            for server_id in task_config.get('servers', []):
+                _check(server_id in servers, f'User {user_id} refers to an unknown server: {server_id}')
+
+    for server_id, server_config in servers.items():
+        _check('modelType' in server_config, f'Server {server_id} has no modelType.')
+        _check(server_config.get('internalDbSchema') is None or server_config['internalDbSchema'] in db_schemas,
+               f'Server {server_id} refers to an unknown database schema: {server_config.get("internalDbSchema")}')
+
+        for internal_name, schema_name in server_config.get('mockTools', {}).items():
+            _check(schema_name in tool_schemas, f'Mock tool {internal_name} of server {server_id} refers to an unknown tool schema: {schema_name}')
+
+        external_tools = server_config.get('externalTools', {})
+        for internal_name, external_tool_config in external_tools.items():
+            _check(external_tool_config.get('schema') in tool_schemas, f'External tool {internal_name} of server {server_id} refers to an unknown tool schema: {external_tool_config.get("schema")}')
+            _check(external_tool_config.get('server') in servers, f'External tool {internal_name} of server {server_id} refers to an unknown server: {external_tool_config.get("server")}')
+
+        if len(external_tools) > 0:
+            # Used by the helper user agent
+            _check(server_config.get('protocolDb') in protocol_dbs, f'Server {server_id} refers to an unknown protocol DB: {server_config.get("protocolDb")}')
+
+    for protocol_db_id, protocol_db_config in protocol_dbs.items():
+        for peer_id in protocol_db_config.get('peers', []):
+            _check(peer_id in protocol_dbs, f'Protocol DB {protocol_db_id} refers to an unknown peer: {peer_id}')
+
+    logging_config = config['shared'].get('logging', {})
+    for name, level in [('the default level', logging_config.get('level', 'INFO'))] + list(logging_config.get('levels', {}).items()):
+        _check(isinstance(logging.getLevelName(str(level).upper()), int), f'Unknown log level for {name}: {level}')
+
+    _check(isinstance(node_urls, dict) and all(isinstance(url, str) for url in node_urls.values()), 'node_urls.json must map node IDs to URLs.')
+
+def build_snapshot():
+    fingerprint = _fingerprint()
+
+    with open(CONFIG_PATH) as f:
+        config = json.load(f)
+
+    # node_urls.json is written by the orchestrator, and might not exist yet (e.g. when generating configurations)
+    if fingerprint[NODE_URLS_PATH] is not None:
+        with open(NODE_URLS_PATH) as f:
+            node_urls = json.load(f)
+    else:
+        node_urls = {}
+
+    validate(config, node_urls)
+
+    return ConfigSnapshot(freeze(config), freeze(node_urls), fingerprint)
+
+def publish_snapshot(path):
+    # Writes the current snapshot for the agents that will be launched with CONFIG_SNAPSHOT_PATH=path
+    snapshot = build_snapshot()
+    temp_path = f'{path}.{os.getpid()}.tmp'
+
+    with open(temp_path, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    os.replace(temp_path, path)
+    return snapshot
+
+def _load_published_snapshot(path):
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            return pickle.loads(mapped_file)
+
+SNAPSHOT = None
+LAST_CHECK = 0
+# Fingerprint of files that failed to load, so that they are not retried (and reported) until they change again
+REJECTED_FINGERPRINT = None
+RELOAD_LOCK = threading.Lock()
+RELOAD_CALLBACKS = []
+
+def _initial_snapshot():
+    snapshot_path = os.environ.get('CONFIG_SNAPSHOT_PATH')
+
+    if snapshot_path is not None and os.path.exists(snapshot_path):
+        snapshot = _load_published_snapshot(snapshot_path)
+        # Only valid if the files haven't changed since it was published
+        if snapshot.fingerprint == _fingerprint():
+            return snapshot
+
+    return build_snapshot()
+
+def on_reload(callback):
+    # The callback receives the new snapshot every time the configuration is reloaded
+    RELOAD_CALLBACKS.append(callback)
+
+def get_config():
+    global SNAPSHOT, LAST_CHECK, REJECTED_FINGERPRINT
+
+    snapshot = SNAPSHOT
+    if snapshot is not None and time.time() - LAST_CHECK < RELOAD_CHECK_INTERVAL:
+        return snapshot
+
+    with RELOAD_LOCK:
+        if SNAPSHOT is None:
+            SNAPSHOT = _initial_snapshot()
+        elif time.time() - LAST_CHECK >= RELOAD_CHECK_INTERVAL and _fingerprint() not in [SNAPSHOT.fingerprint, REJECTED_FINGERPRINT]:
+            fingerprint = _fingerprint()
+            try:
+                new_snapshot = build_snapshot()
+            except (OSError, ValueError, ConfigError) as e:
+                # Keep the previous configuration (e.g. the file is being written, or is invalid)
+                logger.error('Could not reload the configuration: %s', e)
+                REJECTED_FINGERPRINT = fingerprint
+            else:
+                SNAPSHOT = new_snapshot
+                logger.info('Configuration reloaded.')
+                for callback in RELOAD_CALLBACKS:
+                    # A failing callback must not fail the request that happened to trigger the reload
+                    try:
+                        callback(new_snapshot)
+                    except Exception:
+                        logger.exception('Error in configuration reload callback %s', callback)
+
+        LAST_CHECK = time.time()
+        return SNAPSHOT
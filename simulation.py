@@ -0,0 +1,189 @@
+import sys
+sys.path.append('.')
+
+import dotenv
+dotenv.load_dotenv()
+
+from contextlib import contextmanager
+import importlib
+import json
+import os
+from pathlib import Path
+import traceback
+import urllib.parse
+
+from werkzeug.exceptions import HTTPException
+
+import http_client
+
+# Modules that hold per-agent state (memory, tools, query IDs, active negotiations...).
+# Every in-process agent gets its own copy of them, everything else is shared
+ISOLATED_MODULES = ['agents', 'specialized_toolformers', 'toolformers', 'utils']
+
+def _is_isolated(module_name):
+    return any(module_name == prefix or module_name.startswith(prefix + '.') for prefix in ISOLATED_MODULES)
+
+@contextmanager
+def isolated_modules():
+    # Imports inside this context get fresh copies of the isolated modules. The copies stay alive
+    # through the references held by the imported code, but are removed from sys.modules afterwards
+    saved_modules = {name: module for name, module in sys.modules.items() if _is_isolated(name)}
+    for name in saved_modules:
+        del sys.modules[name]
+
+    try:
+        yield
+    finally:
+        for name in [name for name in sys.modules if _is_isolated(name)]:
+            del sys.modules[name]
+        sys.modules.update(saved_modules)
+
+@contextmanager
+def agent_environment(env):
+    # Agents read AGENT_ID, STORAGE_PATH and MODEL_TYPE from the environment when handling a request.
+    # Calls between agents are nested (e.g. user -> server -> helper), so the previous values are restored on exit
+    previous_values = {key: os.environ.get(key) for key in env}
+    os.environ.update(env)
+
+    try:
+        yield
+    finally:
+        for key, value in previous_values.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+class InMemoryResponse:
+    # Implements the subset of requests.Response used by the agents. The body is kept as returned
+    # by the view, and is only encoded if the caller asks for the text
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self._body = body
+
+    @property
+    def text(self):
+        if isinstance(self._body, str):
+            return self._body
+        return json.dumps(self._body)
+
+    def json(self):
+        if isinstance(self._body, str):
+            return json.loads(self._body)
+        return self._body
+
+class InProcessAgent:
+    def __init__(self, agent_id, env, app):
+        self.agent_id = agent_id
+        self.env = env
+        self.app = app
+
+    def request(self, method, path, query_string, json_data):
+        with agent_environment(self.env):
+            with self.app.test_request_context(path, method=method, query_string=query_string, json=json_data):
+                try:
+                    output = self.app.dispatch_request()
+                except HTTPException as e:
+                    return InMemoryResponse(e.code, e.description)
+                except Exception as e:
+                    traceback.print_exception(type(e), e, e.__traceback__)
+                    return InMemoryResponse(500, f'Internal error in {self.agent_id}: {e}')
+
+                if isinstance(output, (str, dict, list)):
+                    return InMemoryResponse(200, output)
+
+                response = self.app.make_response(output)
+                return InMemoryResponse(response.status_code, response.get_data(as_text=True))
+
+class Simulation:
+    # Runs every agent in the current process. Inter-agent HTTP calls (made through http_client)
+    # are routed to the target agent's Flask app without going through the network.
+    # Since agents read their identity from the environment, requests must be handled one at a time
+    def __init__(self, id_to_url_mappings, base_storage_path):
+        self.id_to_url_mappings = id_to_url_mappings
+        self.base_storage_path = Path(base_storage_path)
+        self.agents = {}
+
+    def load(self, instance_type, model_type, agent_id):
+        storage_instance_type = 'helper' if 'helper' in agent_id else instance_type
+
+        env = {
+            'STORAGE_PATH': str(self.base_storage_path / storage_instance_type / agent_id),
+            'AGENT_ID': agent_id
+        }
+        if model_type is not None:
+            env['MODEL_TYPE'] = model_type
+
+        with agent_environment(env), isolated_modules():
+            module = importlib.import_module(f'agents.{instance_type}.main')
+
+        self.agents[self.id_to_url_mappings[agent_id]] = InProcessAgent(agent_id, env, module.app)
+
+    def load_all(self, agents):
+        for instance_type, model_type, agent_id in agents:
+            self.load(instance_type, model_type, agent_id)
+
+    def _route(self, method, url, params, json_data, fallback, data=None, **kwargs):
+        parsed_url = urllib.parse.urlsplit(url)
+        base_url = f'{parsed_url.scheme}://{parsed_url.netloc}'
+
+        if base_url not in self.agents:
+            # Not an agent (e.g. an LLM API), use the network
+            return fallback(url, params=params, data=data, json=json_data, **kwargs)
+
+        query_string = parsed_url.query
+        if params:
+            query_string = '&'.join(x for x in [query_string, urllib.parse.urlencode(params)] if x)
+
+        return self.agents[base_url].request(method, parsed_url.path or '/', query_string, json_data)
+
+    def get(self, url, params=None, **kwargs):
+        return self._route('GET', url, params, kwargs.pop('json', None), self._original_get, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self._route('POST', url, kwargs.pop('params', None), json, self._original_post, data=data, **kwargs)
+
+    @contextmanager
+    def activate(self):
+        self._original_get = http_client.get
+        self._original_post = http_client.post
+
+        http_client.get = self.get
+        http_client.post = self.post
+        # In-process agents read their identity from the environment, so their requests can't overlap
+        http_client.ALLOW_CONCURRENT_REQUESTS = False
+
+        try:
+            yield self
+        finally:
+            http_client.get = self._original_get
+            http_client.post = self._original_post
+            http_client.ALLOW_CONCURRENT_REQUESTS = True
+
+    def run_screenplay(self, task_list, result_stream):
+        result_list = []
+
+        for task_info in task_list:
+            result = result_stream.get_result(task_info)
+            if result is not None:
+                result_list.append(result)
+                continue
+
+            query_id, user_id, user_url, target, task, data = task_info
+            if task == 'synchronization':
+                print('Synchronizing', user_id)
+                response = self.post(user_url + '/synchronize')
+            else:
+                print(f'{query_id}: Sending task {task} to {target} for user {user_id} with data {data}')
+                response = self.post(user_url + '/customRun', json={
+                    'queryId': query_id,
+                    'targetServer': target,
+                    'type': task,
+                    'data': data
+                })
+
+            print('Response from', user_id, ':', response.text)
+            result_list.append(response.text)
+            result_stream.write(task_info, response.text)
+
+        return result_list
@@ -0,0 +1,54 @@
+# Coalesces concurrent calls with the same key: the first caller runs the function, and the callers that arrive
+# while it is running wait for it and get the same result (or exception) instead of running it again.
+# Used for expensive, idempotent steps such as the LLM suitability checks of a new protocol.
+
+import threading
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.stats = {
+            'executed': 0,
+            'coalesced': 0
+        }
+
+    def do(self, key, function, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                self.stats['coalesced'] += 1
+                leader = False
+            else:
+                call = _Call()
+                self.calls[key] = call
+                self.stats['executed'] += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            # Callers arriving from now on start a new call, which sees the effects of this one
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
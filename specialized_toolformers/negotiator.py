@@ -3,10 +3,14 @@
 import json
 import uuid
 
+from agent_logging import get_logger
 from utils import send_raw_query, extract
+import wire_format
 
 from toolformers.unified import make_default_toolformer
 
+logger = get_logger('specialized_toolformers.negotiator')
+
 
 NEGOTIATION_RULES = '''
 Here are some rules (that should also be explained to the other GPT):
@@ -50,9 +54,9 @@ def chat(message, conversation_id, target_node):
     if conversation_id is not None:
         data['conversationId'] = conversation_id
 
-    raw_reply = send_raw_query(json.dumps(data), 'negotiation', target_node, None).json()
+    raw_reply = wire_format.decode_response(target_node, send_raw_query(json.dumps(data), 'negotiation', target_node, None))
 
-    print('Raw reply:', raw_reply)
+    logger.debug('Raw reply: %s', raw_reply)
 
     wrapped_reply = json.loads(raw_reply['body'])
 
@@ -71,20 +75,14 @@ def negotiate_protocol_for_task(task_schema, target_node):
     conversation_id = None
 
     for i in range(10):
-        print('===NegotiatorGPT===')
-        message = conversation.chat(other_message, print_output=True)
+        message = conversation.chat(other_message, print_output=True, stop_tag='</FINALPROTOCOL>')
 
-        print('Checking if we can extract from:', message)
-        print('---------')
         protocol = extract(message, '<FINALPROTOCOL>', '</FINALPROTOCOL>')
 
         if protocol is None:
-            print('Could not extract')
+            logger.debug('No final protocol yet, continuing the negotiation')
             other_message, conversation_id = chat(message, conversation_id, target_node)
-            print()
-            print('===Other GPT===')
-            print(other_message)
-            print()
+            logger.info('Other party: %s', other_message)
         else:
             name = extract(protocol, '<NAME>', '</NAME>')
             description = extract(protocol, '<DESCRIPTION>', '</DESCRIPTION>')
@@ -120,7 +118,7 @@ def create_negotiation_conversation(tools, additional_info):
         for tool in tools:
             prompt += tool.as_documented_python() + '\n\n'
 
-    print('Prompt:', prompt)
+    logger.debug('Prompt: %s', prompt)
 
     toolformer = make_default_toolformer(prompt, tools)
 
@@ -136,7 +134,7 @@ def handle_negotiation_for_tools(message, conversation_id, tools, additional_inf
     
     conversation = ACTIVE_CONVERSATIONS[conversation_id]
 
-    print('Message:', message)
+    logger.info('Other party: %s', message)
 
     reply = conversation.chat(message, print_output=True)
 
@@ -68,7 +68,7 @@ def write_routine_for_task(task_schema, protocol_document):
     message = 'JSON schema:\n\n' + json.dumps(task_schema) + '\n\n' + 'Protocol document:\n\n' + protocol_document
 
     for i in range(5):
-        reply = conversation.chat(message, print_output=True)
+        reply = conversation.chat(message, print_output=True, stop_tag='</IMPLEMENTATION>')
 
         implementation = extract(reply, '<IMPLEMENTATION>', '</IMPLEMENTATION>')
 
@@ -101,7 +101,7 @@ def write_routine_for_tools(tools, protocol_document, additional_info):
     conversation = toolformer.new_conversation(category='programming')
 
     for i in range(5):
-        reply = conversation.chat(message, print_output=True)
+        reply = conversation.chat(message, print_output=True, stop_tag='</IMPLEMENTATION>')
 
         implementation = extract(reply, '<IMPLEMENTATION>', '</IMPLEMENTATION>')
 
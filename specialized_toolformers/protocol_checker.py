@@ -8,9 +8,12 @@ dotenv.load_dotenv()
 
 import json
 
+from agent_logging import get_logger
 from toolformers.base import Tool, ArrayParameter
 from toolformers.unified import make_default_toolformer
 
+logger = get_logger('specialized_toolformers.protocol_checker')
+
 CHECKER_TASK_PROMPT = 'You are ProtocolCheckerGPT. Your task is to look at the provided protocol and determine if it is expressive ' \
     'enough to fullfill the required task (of which you\'ll receive a JSON schema). A protocol is sufficiently expressive if you could write code that, given the input data, sends ' \
     'the query according to the protocol\'s specification and parses the reply. Think about it and at the end of the reply write "YES" if the' \
@@ -108,9 +111,8 @@ def check_protocol_for_tools(protocol_document, tools):
 
     reply = conversation.chat(message, print_output=True)
 
-    print('Reply:', reply)
-    print(reply.lower().strip()[-10:])
-    print('Parsed decision:', 'yes' in reply.lower().strip()[-10:])
+    decision = 'yes' in reply.lower().strip()[-10:]
+    logger.debug('Parsed decision: %s', decision)
 
-    return 'yes' in reply.lower().strip()[-10:]
+    return decision
 
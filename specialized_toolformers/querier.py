@@ -13,10 +13,14 @@ from pathlib import Path
 
 import sys
 
+from agent_logging import get_logger
 from toolformers.base import Tool, StringParameter, parameter_from_openai_api
 from toolformers.unified import make_default_toolformer
 
 from utils import load_protocol_document, send_raw_query, serialize_gemini_data
+import wire_format
+
+logger = get_logger('specialized_toolformers.querier')
 
 PROTOCOL_QUERIER_PROMPT = 'You are QuerierGPT. You will receive a protocol document detailing how to query a service. Reply with a structured query which can be sent to the service.' \
     'Only reply with the query itself, with no additional information or escaping. Similarly, do not add any additional whitespace or formatting.'
@@ -48,7 +52,7 @@ NL_QUERIER_PROMPT = 'You are NaturalLanguageQuerierGPT. You act as an intermedia
 def parse_and_handle_query(query, target_node, protocol_id, source):
     response = send_raw_query(query, protocol_id, target_node, source)
     if response.status_code == 200:
-        parsed_response = json.loads(response.text)
+        parsed_response = wire_format.decode_response(target_node, response)
 
         if parsed_response['status'] == 'success':
             return parsed_response['body']
@@ -71,7 +75,7 @@ def handle_conversation(prompt, message, target_node, protocol_id, source, outpu
     sent_query_counter = 0
     
     def send_query_internal(query):
-        print('Sending query:', query)
+        logger.debug('Sending query: %s', query)
         nonlocal sent_query_counter
 
         if sent_query_counter > 50:
@@ -96,7 +100,7 @@ def handle_conversation(prompt, message, target_node, protocol_id, source, outpu
     registered_output_counter = 0
 
     def register_output(**kwargs):
-        print('Registering output:', kwargs)
+        logger.debug('Registering output: %s', kwargs)
 
         nonlocal found_output
         nonlocal registered_output_counter
@@ -7,14 +7,16 @@ sys.path.append('.')
 import dotenv
 dotenv.load_dotenv()
 
-import json
 import os
 from pathlib import Path
 
+from agent_logging import get_logger
 from toolformers.unified import make_default_toolformer
 
 from utils import load_protocol_document
 
+logger = get_logger('specialized_toolformers.responder')
+
 # TODO: A tool to declare an error?
 
 
@@ -24,7 +26,7 @@ PROTOCOL_RESPONDER_PROMPT = 'You are ResponderGPT. You will receive a protocol d
    # 'If you do not have enough information to reply, or if you cannot execute the request, reply with "ERROR" (without quotes).'
 
 def reply_with_protocol_document(query, protocol_document, tools, additional_info):
-    print('===NL RESPONDER (WITH PROTOCOL)===')
+    logger.debug('Replying with protocol document')
     toolformer = make_default_toolformer(PROTOCOL_RESPONDER_PROMPT + additional_info, tools)
 
     conversation = toolformer.new_conversation(category='conversation')
@@ -33,17 +35,15 @@ def reply_with_protocol_document(query, protocol_document, tools, additional_inf
 
     reply = conversation.chat(prompt, print_output=True)
 
-    print('======')
-
     if 'error' in reply.lower().strip()[-10:]:
-        return json.dumps({
+        return {
             'status': 'error',
-        })
+        }
 
-    return json.dumps({
+    return {
         'status': 'success',
         'body': reply
-    })
+    }
 
 NL_RESPONDER_PROMPT = 'You are NaturalLanguageResponderGPT. You will receive a query from a user. ' \
     'Use the provided functions to execute what is requested and reply with a response (in natural language). ' \
@@ -51,28 +51,25 @@ NL_RESPONDER_PROMPT = 'You are NaturalLanguageResponderGPT. You will receive a q
     #'If you do not have enough information to reply, if you cannot execute the request, or if the request is invalid, reply with "ERROR" (without quotes).' \
 
 def reply_to_nl_query(query, tools, additional_info):
-    print('===NL RESPONDER (NO PROTOCOL)===')
-    print(NL_RESPONDER_PROMPT + additional_info)
+    logger.debug('Replying without protocol')
     toolformer = make_default_toolformer(NL_RESPONDER_PROMPT + additional_info, tools)
 
     conversation = toolformer.new_conversation(category='conversation')
 
     reply = conversation.chat(query, print_output=True)
-    print('======')
 
     if 'error' in reply.lower().strip()[-10:]:
-        return json.dumps({
+        return {
             'status': 'error',
-        })
+        }
 
-    return json.dumps({
+    return {
         'status': 'success',
         'body': reply
-    })
+    }
 
 
 def reply_to_query(query, protocol_id, tools, additional_info):
-    print('Additional info:', additional_info)
     if protocol_id is None:
         return reply_to_nl_query(query, tools, additional_info)
     else:
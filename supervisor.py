@@ -0,0 +1,262 @@
+import sys
+sys.path.append('.')
+
+import dotenv
+dotenv.load_dotenv()
+
+import json
+import logging
+import logging.handlers
+import os
+from pathlib import Path
+import signal
+import subprocess
+import threading
+import time
+
+from runtime_config import publish_snapshot
+
+# Each agent is a separate gunicorn instance. Note that agents keep their state (memory, active negotiations)
+# in module-level variables, so workers of the same agent do not share it: only use more than one worker
+# per agent for stateless benchmarks
+DEFAULT_NUM_WORKERS = 1
+DEFAULT_NUM_THREADS = 8
+
+MIN_RESTART_BACKOFF = 1
+MAX_RESTART_BACKOFF = 60
+# If an agent stays up for this long, its backoff is reset
+STABLE_UPTIME = 60
+
+SHUTDOWN_GRACE_PERIOD = 10
+MONITOR_INTERVAL = 0.5
+
+DEFAULT_LOG_MAX_BYTES = 10 * 1024 * 1024 # 10 MB
+DEFAULT_LOG_BACKUP_COUNT = 5
+
+def get_agent_launch_phases(config):
+    # Agents are launched in phases: protocol DBs, then servers (with their helpers), then users.
+    # Each agent is described by a tuple (instance_type, model_type, agent_id)
+    protocol_dbs = [('protocol_db', None, protocol_db_id) for protocol_db_id in config['protocolDbs']]
+
+    servers = []
+    for server_id, server_config in config['servers'].items():
+        servers.append(('server', server_config['modelType'], server_id))
+
+        external_tools_config = server_config.get('externalTools', {})
+        if len(external_tools_config) > 0:
+            # Build a helper user agent
+            servers.append(('user', server_config['modelType'], server_id + '_helper'))
+
+    users = [('user', user_config['modelType'], user_id) for user_id, user_config in config['users'].items()]
+
+    return [protocol_dbs, servers, users]
+
+class AgentProcess:
+    def __init__(self, instance_type, model_type, agent_id, command, env, logger):
+        self.instance_type = instance_type
+        self.model_type = model_type
+        self.agent_id = agent_id
+        self.command = command
+        self.env = env
+        self.logger = logger
+
+        self.process = None
+        self.start_time = None
+        self.restart_time = None
+        self.backoff = MIN_RESTART_BACKOFF
+        self.num_restarts = 0
+
+    def start(self):
+        self.process = subprocess.Popen(
+            self.command,
+            env=self.env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            # Own process group, so that Ctrl-C in the terminal is handled by the supervisor only
+            start_new_session=True
+        )
+        self.start_time = time.time()
+        self.restart_time = None
+
+        threading.Thread(target=self._forward_output, args=(self.process,), daemon=True).start()
+
+    def _forward_output(self, process):
+        for line in process.stdout:
+            self.logger.info(line.rstrip('\n'))
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+class Supervisor:
+    def __init__(self, config, id_to_url_mappings, base_log_path, base_storage_path):
+        orchestration_config = config['orchestration']
+
+        self.config = config
+        self.id_to_url_mappings = id_to_url_mappings
+        self.base_log_path = Path(base_log_path)
+        self.base_storage_path = Path(base_storage_path)
+        self.num_workers = orchestration_config.get('workersPerAgent', DEFAULT_NUM_WORKERS)
+        self.num_threads = orchestration_config.get('threadsPerWorker', DEFAULT_NUM_THREADS)
+        # Servers run the aiohttp app (agents/server/async_main.py) instead of the Flask one
+        self.async_servers = orchestration_config.get('asyncServers', False)
+        self.log_max_bytes = orchestration_config.get('logMaxBytes', DEFAULT_LOG_MAX_BYTES)
+        self.log_backup_count = orchestration_config.get('logBackupCount', DEFAULT_LOG_BACKUP_COUNT)
+
+        self.agents = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.monitor_thread = None
+
+        # Agents load this snapshot instead of parsing and validating the configuration files themselves.
+        # This also validates the configuration before anything is launched
+        self.snapshot_path = self.base_storage_path / 'config.snapshot'
+        self.snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+        publish_snapshot(str(self.snapshot_path))
+
+    def _make_logger(self, storage_instance_type, agent_id):
+        log_path = self.base_log_path / storage_instance_type / (agent_id + '.log')
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+
+        logger = logging.getLogger(f'supervisor.{agent_id}')
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        logger.handlers.clear()
+
+        handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=self.log_max_bytes, backupCount=self.log_backup_count)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+
+        return logger
+
+    def launch(self, instance_type, model_type, agent_id):
+        port = self.id_to_url_mappings[agent_id].split(':')[-1]
+
+        storage_instance_type = 'helper' if 'helper' in agent_id else instance_type
+        storage_path = self.base_storage_path / storage_instance_type / agent_id
+
+        env = dict(os.environ)
+        env['PYTHONUNBUFFERED'] = '1'
+        env['STORAGE_PATH'] = str(storage_path)
+        env['AGENT_ID'] = agent_id
+        env['CONFIG_SNAPSHOT_PATH'] = str(self.snapshot_path)
+        if model_type is not None:
+            env['MODEL_TYPE'] = model_type
+
+        if instance_type == 'server' and self.async_servers:
+            worker_options = ['--worker-class', 'aiohttp.GunicornWebWorker']
+            app_path = 'agents.server.async_main:app'
+        else:
+            worker_options = ['--threads', str(self.num_threads)]
+            app_path = f'agents.{instance_type}.main:app'
+
+        command = [
+            sys.executable, '-m', 'gunicorn',
+            '--bind', f'127.0.0.1:{port}',
+            '--workers', str(self.num_workers),
+            *worker_options,
+            # LLM-backed requests can take minutes, so gunicorn must not kill "silent" workers
+            '--timeout', '0',
+            # Agents initialize (and create their databases) at import time, which must happen only once
+            '--preload',
+            app_path
+        ]
+
+        agent = AgentProcess(instance_type, model_type, agent_id, command, env, self._make_logger(storage_instance_type, agent_id))
+
+        with self.lock:
+            self.agents[agent_id] = agent
+            agent.start()
+
+        if self.monitor_thread is None:
+            self.monitor_thread = threading.Thread(target=self._monitor, daemon=True)
+            self.monitor_thread.start()
+
+    def launch_all(self, agents):
+        for instance_type, model_type, agent_id in agents:
+            self.launch(instance_type, model_type, agent_id)
+
+    def _monitor(self):
+        while not self.stopping.wait(MONITOR_INTERVAL):
+            with self.lock:
+                for agent in self.agents.values():
+                    self._check_agent(agent)
+
+    def _check_agent(self, agent):
+        now = time.time()
+
+        if agent.restart_time is not None:
+            if now >= agent.restart_time:
+                print(f'Restarting {agent.agent_id} (restart #{agent.num_restarts}).')
+                agent.start()
+            return
+
+        if agent.is_running():
+            if now - agent.start_time > STABLE_UPTIME:
+                agent.backoff = MIN_RESTART_BACKOFF
+            return
+
+        print(f'Agent {agent.agent_id} exited with code {agent.process.returncode}. Restarting in {agent.backoff} seconds.')
+        agent.restart_time = now + agent.backoff
+        agent.backoff = min(agent.backoff * 2, MAX_RESTART_BACKOFF)
+        agent.num_restarts += 1
+
+    def shutdown(self):
+        self.stopping.set()
+
+        if self.monitor_thread is not None:
+            self.monitor_thread.join()
+
+        with self.lock:
+            agents = list(self.agents.values())
+
+        for agent in agents:
+            if agent.is_running():
+                agent.process.terminate()
+
+        deadline = time.time() + SHUTDOWN_GRACE_PERIOD
+        for agent in agents:
+            if agent.process is None:
+                continue
+            try:
+                agent.process.wait(timeout=max(0, deadline - time.time()))
+            except subprocess.TimeoutExpired:
+                print(f'Agent {agent.agent_id} did not shut down in time. Killing it.')
+                agent.process.kill()
+                agent.process.wait()
+
+        print('All agents stopped.')
+
+def main():
+    from orchestrator import create_id_to_url_mappings, wait_for_agents
+
+    with open('config.json') as f:
+        config = json.load(f)
+
+    id_to_url_mappings = create_id_to_url_mappings(config)
+
+    with open('node_urls.json', 'w') as f:
+        json.dump(id_to_url_mappings, f, indent=2)
+
+    supervisor = Supervisor(config, id_to_url_mappings, 'logs', 'storage')
+
+    # Turn SIGTERM into a clean shutdown, like Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        for phase in get_agent_launch_phases(config):
+            start_time = time.time()
+            supervisor.launch_all(phase)
+            wait_for_agents([agent_id for _, _, agent_id in phase], id_to_url_mappings, start_time)
+
+        print('All agents are ready. Press Ctrl-C to stop them.')
+
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+import pytest
+
+from agents.server.response_cache import is_sql_write
+
+@pytest.mark.parametrize('query', [
+    "SELECT name FROM t WHERE status = 'update'",
+    "SELECT name FROM t WHERE note = 'it''s deleted; drop it'",
+    'SELECT "insert" FROM t',
+    'SELECT name FROM t -- update the cache later',
+    '/* delete */ SELECT name FROM t',
+    'WITH x AS (SELECT 1) SELECT * FROM x'
+])
+def test_reads_with_write_keywords_in_literals(query):
+    assert not is_sql_write(query)
+
+@pytest.mark.parametrize('query', [
+    "UPDATE t SET status = 'select'",
+    "INSERT INTO t VALUES ('a')",
+    "-- select\nDELETE FROM t",
+    'WITH x AS (SELECT 1) DELETE FROM t',
+    'SELECT a INTO b FROM t',
+    "SELECT 1; DROP TABLE t"
+])
+def test_writes(query):
+    assert is_sql_write(query)
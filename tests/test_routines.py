@@ -0,0 +1,107 @@
+from concurrent.futures import ThreadPoolExecutor
+import textwrap
+import threading
+
+from utils import execute_routine, save_routine
+
+class FakeTool:
+    def __init__(self, name, function):
+        self.name = name
+        self.function = function
+
+    def as_executable_function(self):
+        return self.function
+
+def run_routine(tmp_path, routine, tools):
+    save_routine(tmp_path, 'protocol', textwrap.dedent(routine))
+    return execute_routine(tmp_path, 'protocol', {'value': 2}, tools)
+
+def test_method_routine(tmp_path):
+    routine = '''
+    class Handler:
+        def handle(self, task_data):
+            return tool1(task_data['value'])
+
+    def run(task_data):
+        return Handler().handle(task_data)
+    '''
+
+    assert run_routine(tmp_path, routine, [FakeTool('tool1', lambda x: x * 10)]) == 20
+
+def test_decorated_helper_routine(tmp_path):
+    routine = '''
+    import functools
+
+    def logged(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            return function(*args, **kwargs)
+        return wrapper
+
+    @logged
+    def helper(value):
+        return tool1(value)
+
+    HANDLERS = { 'helper': lambda value: tool1(value) + 1 }
+
+    def run(task_data):
+        return helper(task_data['value']) + HANDLERS['helper'](task_data['value'])
+    '''
+
+    assert run_routine(tmp_path, routine, [FakeTool('tool1', lambda x: x * 10)]) == 41
+
+def test_tools_are_per_call(tmp_path):
+    routine = '''
+    class Handler:
+        def handle(self, task_data):
+            return tool1(task_data['value'])
+
+    HANDLER = Handler()
+
+    def run(task_data):
+        return HANDLER.handle(task_data)
+    '''
+
+    assert run_routine(tmp_path, routine, [FakeTool('tool1', lambda x: x * 10)]) == 20
+    assert run_routine(tmp_path, routine, [FakeTool('tool1', lambda x: x * 100)]) == 200
+
+def test_module_runs_once(tmp_path):
+    routine = '''
+    import itertools
+
+    LOADS = itertools.count()
+    NUM_LOADS = next(LOADS) + 1
+
+    def run(task_data):
+        return NUM_LOADS, tool1(task_data['value'])
+    '''
+
+    save_routine(tmp_path, 'protocol', textwrap.dedent(routine))
+
+    for multiplier in [10, 100, 1000]:
+        output = execute_routine(tmp_path, 'protocol', {'value': 2}, [FakeTool('tool1', lambda x, m=multiplier: x * m)])
+        assert output == (1, 2 * multiplier)
+
+def test_concurrent_calls_are_isolated(tmp_path):
+    routine = '''
+    class Handler:
+        def handle(self, task_data):
+            # All the calls are running when the tool is resolved
+            sync()
+            return tool1(task_data['value'])
+
+    def run(task_data):
+        return Handler().handle(task_data)
+    '''
+
+    save_routine(tmp_path, 'protocol', textwrap.dedent(routine))
+    barrier = threading.Barrier(4)
+
+    def call(multiplier):
+        tools = [FakeTool('sync', lambda: barrier.wait(timeout=10)), FakeTool('tool1', lambda x: x * multiplier)]
+        return execute_routine(tmp_path, 'protocol', {'value': 2}, tools)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        outputs = list(executor.map(call, range(4)))
+
+    assert outputs == [0, 2, 4, 6]
@@ -5,9 +5,12 @@ import json
 from google.generativeai.types import CallableFunctionDeclaration
 import google.generativeai.types.content_types as content_types
 
+from agent_logging import get_logger
 from databases.mongo import insert_one
 
-from utils import get_query_id
+from request_context import get_query_id, record_usage
+
+logger = get_logger('toolformers')
 
 class Parameter:
     def __init__(self, name, description, required):
@@ -179,14 +182,14 @@ class Tool:
         self.output_schema = output_schema
     
     def call_tool_for_toolformer(self, *args, **kwargs):
-        print(f'Toolformer called tool {self.name} with args {args} and kwargs {kwargs}')
+        logger.debug('Toolformer called tool %s with args %s and kwargs %s', self.name, args, kwargs)
         # Unlike a call from a routine, this call catches exceptions and returns them as strings
         try:
             tool_reply = self.function(*args, **kwargs)
-            print(f'Tool {self.name} returned: {tool_reply}')
+            logger.debug('Tool %s returned: %s', self.name, tool_reply)
             return tool_reply
         except Exception as e:
-            print(f'Tool {self.name} failed with exception: {e}')
+            logger.warning('Tool %s failed with exception: %s', self.name, e)
             return 'Tool call failed: ' + str(e)
     
     def as_openai_info(self):
@@ -233,8 +236,6 @@ class Tool:
         return schema
 
     def as_natural_language(self):
-        print('Converting to natural language')
-        print('Number of parameters:', len(self.parameters))
         nl = f'Function {self.name}: {self.description}. Parameters:\n'
         
         if len(self.parameters) == 0:
@@ -272,9 +273,9 @@ class Tool:
     def as_executable_function(self):
         # Create an actual function that can be called
         def f(*args, **kwargs):
-            print('Routine called tool', self.name, 'with args', args, 'and kwargs', kwargs)
+            logger.debug('Routine called tool %s with args %s and kwargs %s', self.name, args, kwargs)
             response = self.function(*args, **kwargs)
-            print('Tool', self.name, 'returned:', response)
+            logger.debug('Tool %s returned: %s', self.name, response)
             return response
         
         return f
@@ -307,11 +308,13 @@ def send_usage_to_db(usage, time_start, time_end, agent, category, model):
         'model': model,
         'queryId': get_query_id()
     }
+    record_usage(usage)
     insert_one('usageLogs', 'main', usage)
 
 class Conversation(ABC):
+    # If stop_tag (a closing tag such as </IMPLEMENTATION>) is provided, generation stops as soon as the tag is generated
     @abstractmethod
-    def chat(self, message, role='user', print_output=True):
+    def chat(self, message, role='user', print_output=True, stop_tag=None):
         pass
 
 class Toolformer(ABC):
@@ -3,7 +3,9 @@ import os
 from typing import List
 import warnings
 
+from agent_logging import get_logger
 from toolformers.base import Conversation, Toolformer, Tool, send_usage_to_db
+from utils import restore_stop_tag
 from camel.messages import BaseMessage
 from camel.models import ModelFactory
 from camel.types import ModelPlatformType, ModelType
@@ -12,13 +14,15 @@ from camel.agents import ChatAgent
 from camel.toolkits.openai_function import OpenAIFunction
 from camel.configs.openai_config import ChatGPTConfig
 
+logger = get_logger('toolformers.camel')
+
 class CamelConversation(Conversation):
     def __init__(self, toolformer, agent, category=None):
         self.toolformer = toolformer
         self.agent = agent
         self.category = category
     
-    def chat(self, message, role='user', print_output=True):
+    def chat(self, message, role='user', print_output=True, stop_tag=None):
         agent_id = os.environ.get('AGENT_ID', None)
 
         start_time = datetime.datetime.now()
@@ -30,9 +34,18 @@ class CamelConversation(Conversation):
         else:
             raise ValueError('Role must be either "user" or "assistant".')
         
-        response = self.agent.step(formatted_message)
+        if stop_tag is not None:
+            # Stop sequences are applied by the API, so no token is generated after the tag
+            model_config_dict = self.agent.model_backend.model_config_dict
+            previous_stop = model_config_dict.get('stop', None)
+            model_config_dict['stop'] = [stop_tag]
+            try:
+                response = self.agent.step(formatted_message)
+            finally:
+                model_config_dict['stop'] = previous_stop
+        else:
+            response = self.agent.step(formatted_message)
 
-        #print(response.info)
         if response.info.get('usage', None) is not None:
             send_usage_to_db(response.info.get('usage', None), start_time, datetime.datetime.now(), agent_id, self.category, self.toolformer.name)
         else:
@@ -40,8 +53,11 @@ class CamelConversation(Conversation):
 
         reply = response.msg.content
 
+        if stop_tag is not None:
+            reply = restore_stop_tag(reply, stop_tag)
+
         if print_output:
-            print(reply)
+            logger.info('Reply: %s', reply)
         
         return reply
 
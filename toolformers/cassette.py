@@ -0,0 +1,194 @@
+import hashlib
+import json
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import List
+import zlib
+
+from agent_logging import get_logger
+from toolformers.base import Conversation, Toolformer, Tool
+from utils import serialize_gemini_data, TagStreamExtractor
+
+# Records every Conversation.chat exchange (reply, tool calls and model latency) so that a run can be replayed
+# without calling the model. Configured by the "cassette" entry of the shared config, e.g.:
+# {
+#   "mode": "record", // or "replay"
+#   "path": "cassettes/llm.sqlite",
+#   "latency": "original" // or "zero" (replay only)
+# }
+# Exchanges are keyed by model, system prompt and message history. If the same key is recorded several times,
+# the replies are replayed in the same order.
+
+DEFAULT_CASSETTE_PATH = 'cassettes/llm.sqlite'
+
+logger = get_logger('toolformers.cassette')
+
+class Cassette:
+    def __init__(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # All the agents of a run share the same file
+        self.connection = sqlite3.connect(str(path), timeout=60, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS exchanges (key TEXT, seq INTEGER, model TEXT, record BLOB, PRIMARY KEY (key, seq))')
+        self.lock = threading.Lock()
+        self.replay_counters = {}
+
+    def append(self, key, model, record):
+        data = zlib.compress(json.dumps(record).encode())
+
+        with self.lock:
+            # Other processes might be recording the same key: take the write lock before computing the sequence number
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                self.connection.execute(
+                    'INSERT INTO exchanges (key, seq, model, record) VALUES (?, (SELECT COUNT(*) FROM exchanges WHERE key = ?), ?, ?)',
+                    (key, key, model, data)
+                )
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def next_record(self, key):
+        with self.lock:
+            seq = self.replay_counters.get(key, 0)
+            self.replay_counters[key] = seq + 1
+
+            row = self.connection.execute(
+                'SELECT record FROM exchanges WHERE key = ? AND seq <= ? ORDER BY seq DESC LIMIT 1',
+                (key, seq)
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return json.loads(zlib.decompress(row[0]).decode())
+
+CASSETTES = {}
+
+def get_cassette(path):
+    if path not in CASSETTES:
+        CASSETTES[path] = Cassette(path)
+    return CASSETTES[path]
+
+def compute_key(model, system_prompt, history):
+    return hashlib.sha256(json.dumps([model, system_prompt, history]).encode()).hexdigest()
+
+class CassetteConversation(Conversation):
+    def __init__(self, toolformer, conversation, category=None):
+        self.toolformer = toolformer
+        # The wrapped conversation (None when replaying)
+        self.conversation = conversation
+        self.category = category
+        self.history = []
+
+    def chat(self, message, role='user', print_output=True, stop_tag=None):
+        self.history.append([role, message])
+        key = compute_key(self.toolformer.name, self.toolformer.system_prompt, self.history)
+
+        if self.toolformer.mode == 'record':
+            reply = self._record(key, message, role, print_output, stop_tag)
+        else:
+            reply = self._replay(key, print_output, stop_tag)
+
+        self.history.append(['assistant', reply])
+        return reply
+
+    def _record(self, key, message, role, print_output, stop_tag):
+        self.toolformer.tool_calls = []
+        self.toolformer.tool_time = 0
+
+        start_time = time.time()
+        reply = self.conversation.chat(message, role=role, print_output=print_output, stop_tag=stop_tag)
+
+        # Only the time spent by the model, not the time spent running tools (e.g. querying other agents)
+        latency = time.time() - start_time - self.toolformer.tool_time
+
+        self.toolformer.cassette.append(key, self.toolformer.name, {
+            'reply': reply,
+            'toolCalls': self.toolformer.tool_calls,
+            'latency': latency
+        })
+
+        return reply
+
+    def _replay(self, key, print_output, stop_tag):
+        record = self.toolformer.cassette.next_record(key)
+
+        if record is None:
+            raise KeyError(f'No recorded exchange for model {self.toolformer.name} and this conversation (key {key}).')
+
+        if self.toolformer.latency == 'original':
+            time.sleep(record['latency'])
+
+        tools = { tool.name: tool for tool in self.toolformer.tools }
+        for tool_call in record['toolCalls']:
+            tools[tool_call['tool']].call_tool_for_toolformer(*tool_call['args'], **tool_call['kwargs'])
+
+        reply = record['reply']
+
+        # The exchange might have been recorded without a stop tag
+        if stop_tag is not None:
+            extractor = TagStreamExtractor(stop_tag)
+            if extractor.feed(reply):
+                reply = extractor.text
+
+        if print_output:
+            logger.info('Reply: %s', reply)
+
+        return reply
+
+class CassetteToolformer(Toolformer):
+    def __init__(self, name, system_prompt, tools, cassette, mode, latency, make_toolformer):
+        self.name = name
+        self.system_prompt = system_prompt
+        self.tools = tools
+        self.cassette = cassette
+        self.mode = mode
+        self.latency = latency
+
+        # Filled while recording a chat
+        self.tool_calls = []
+        self.tool_time = 0
+
+        if mode == 'record':
+            self.toolformer = make_toolformer(name, system_prompt, [self._recording_tool(tool) for tool in tools])
+        else:
+            self.toolformer = None
+
+    def _recording_tool(self, tool):
+        def function(*args, **kwargs):
+            self.tool_calls.append({
+                'tool': tool.name,
+                'args': serialize_gemini_data(list(args)),
+                'kwargs': serialize_gemini_data(dict(kwargs))
+            })
+
+            start_time = time.time()
+            try:
+                return tool.function(*args, **kwargs)
+            finally:
+                self.tool_time += time.time() - start_time
+
+        return Tool(tool.name, tool.description, tool.parameters, function, output_schema=tool.output_schema)
+
+    def new_conversation(self, category=None) -> Conversation:
+        conversation = self.toolformer.new_conversation(category=category) if self.toolformer is not None else None
+        return CassetteConversation(self, conversation, category)
+
+def make_cassette_toolformer(model_type_internal, system_prompt, tools : List[Tool], cassette_config, make_toolformer):
+    mode = cassette_config['mode']
+    if mode not in ['record', 'replay']:
+        raise ValueError('Cassette mode must be either "record" or "replay".')
+
+    latency = cassette_config.get('latency', 'original')
+    if latency not in ['original', 'zero']:
+        raise ValueError('Cassette latency must be either "original" or "zero".')
+
+    cassette = get_cassette(cassette_config.get('path', DEFAULT_CASSETTE_PATH))
+
+    return CassetteToolformer(model_type_internal, system_prompt, tools, cassette, mode, latency, make_toolformer)
@@ -5,23 +5,32 @@ import time
 import traceback
 from typing import List
 
+from agent_logging import get_logger
 from toolformers.base import Conversation, Tool, Toolformer, send_usage_to_db
+from utils import restore_stop_tag
 
 import google.generativeai as genai
 from google.generativeai.generative_models import ChatSession
 
 genai.configure(api_key=os.environ['GOOGLE_API_KEY'])
 
+logger = get_logger('toolformers.gemini')
+
 class GeminiConversation(Conversation):
     def __init__(self, model_name, chat_agent : ChatSession, category=None):
         self.model_name = model_name
         self.chat_agent = chat_agent
         self.category = category
 
-    def chat(self, message, role='user', print_output=True):
+    def chat(self, message, role='user', print_output=True, stop_tag=None):
         agent_id = os.environ.get('AGENT_ID', None)
         time_start = datetime.datetime.now()
 
+        generation_config = None
+        if stop_tag is not None:
+            # Automatic function calling can't be combined with streaming, so the API's stop sequences are used instead
+            generation_config = { 'stop_sequences': [stop_tag] }
+
         exponential_backoff_lower = 30
         exponential_backoff_higher = 60
         for i in range(5):
@@ -31,25 +40,24 @@ class GeminiConversation(Conversation):
                     'parts': [
                         message
                     ]
-                })
+                }, generation_config=generation_config)
                 break
             except Exception as e:
-                print(e)
+                logger.warning('Gemini call failed: %s', e)
                 if '429' in str(e):
-                    print('Rate limit exceeded. Waiting with random exponential backoff.')
+                    logger.warning('Rate limit exceeded. Waiting with random exponential backoff.')
                     if i < 4:
                         time.sleep(random() * (exponential_backoff_higher - exponential_backoff_lower) + exponential_backoff_lower)
                         exponential_backoff_lower *= 2
                         exponential_backoff_higher *= 2
                 elif 'candidates[0]' in traceback.format_exc():
                     # When Gemini has nothing to say, it raises an error with this message
-                    print('No response')
+                    logger.info('No response')
                     return 'No response'
                 elif '500' in str(e):
                     # Sometimes Gemini just decides to return a 500 error for absolutely no reason. Retry.
-                    print('500 error')
+                    logger.warning('500 error, retrying', exc_info=True)
                     time.sleep(5)
-                    traceback.print_exc()
                 else:
                     raise e
 
@@ -71,8 +79,11 @@ class GeminiConversation(Conversation):
 
         reply = response.text
 
+        if stop_tag is not None:
+            reply = restore_stop_tag(reply, stop_tag)
+
         if print_output:
-            print(reply)
+            logger.info('Reply: %s', reply)
         
         return reply
 
@@ -83,8 +94,7 @@ class GeminiToolformer(Toolformer):
         self.tools = tools
 
     def new_conversation(self, category=None) -> Conversation:
-        print('Tools:')
-        print('\n'.join([str(tool.as_openai_info()) for tool in self.tools]))
+        logger.debug('Tools: %s', [tool.as_openai_info() for tool in self.tools])
         model = genai.GenerativeModel(
             model_name=self.model_name,
             system_instruction=self.system_prompt,
@@ -12,11 +12,14 @@ from langchain_core.messages.tool import ToolMessage
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnableLambda
 
+from agent_logging import get_logger
 from toolformers.base import Tool, StringParameter
 from toolformers.llama.api_gateway import APIGateway
 
 from toolformers.llama.utils import get_total_usage, usage_tracker
 
+logger = get_logger('toolformers.llama.function_calling')
+
 
 FUNCTION_CALLING_SYSTEM_PROMPT = """You have access to the following tools:
 
@@ -141,7 +144,7 @@ class FunctionCallingLlm:
             if tool['tool'].lower() == 'invocationerror':
                 tools_msgs.append(f'Tool invocation error: {tool["tool_input"]}')
             elif tool['tool'].lower() != 'conversationalresponse':
-                print(f"\n\n---\nTool {tool['tool'].lower()} invoked with input {tool['tool_input']}\n")
+                logger.debug('Tool %s invoked with input %s', tool['tool'].lower(), tool['tool_input'])
                 
                 if tool['tool'].lower() not in tools_map:
                     tools_msgs.append(f'Tool {tool["tool"]} not found')
@@ -248,7 +251,43 @@ class FunctionCallingLlm:
                 raise ValueError(f'Invalid message type: {msg.type}')
         return json.dumps(formatted_msgs)
 
-    def function_call_llm(self, query: str, max_it: int = 5, debug: bool = False) -> str:
+    def invoke_llm(self, prompt: str, stop_tag: Optional[str] = None) -> str:
+        """
+        invocation of the LLM, retrying with exponential backoff when rate limited
+
+        Args:
+            prompt (str): The formatted prompt.
+            stop_tag (str, optional): Closing tag after which the generation is stopped. Defaults to None.
+        """
+        exponential_backoff_lower = 30
+        exponential_backoff_higher = 60
+        llm_response = None
+        for _ in range(5):
+            try:
+                llm_response = self.llm.invoke(prompt, stream_options={'include_usage': True}, stop_tag=stop_tag)
+                break
+            except Exception as e:
+                if '429' in str(e):
+                    logger.warning('Rate limit exceeded. Waiting with random exponential backoff.')
+                    time.sleep(random() * (exponential_backoff_higher - exponential_backoff_lower) + exponential_backoff_lower)
+                    exponential_backoff_lower *= 2
+                    exponential_backoff_higher *= 2
+                else:
+                    raise e
+        return llm_response
+
+    def is_truncated_tool_call(self, llm_response: Optional[str]) -> bool:
+        """
+        whether a response stopped at the stop tag is an unfinished <ToolCalls> section
+
+        Args:
+            llm_response (str): The (possibly stopped) LLM response.
+        """
+        if llm_response is None:
+            return False
+        return re.search(r'<ToolCalls?\>', llm_response, re.IGNORECASE) is not None and re.search(r'</ToolCalls?\>', llm_response, re.IGNORECASE) is None
+
+    def function_call_llm(self, query: str, max_it: int = 5, debug: bool = False, stop_tag: Optional[str] = None) -> str:
         """
         invocation method for function calling workflow
 
@@ -256,6 +295,7 @@ class FunctionCallingLlm:
             query (str): The query to execute.
             max_it (int, optional): The maximum number of iterations. Defaults to 5.
             debug (bool, optional): Whether to print debug information. Defaults to False.
+            stop_tag (str, optional): Closing tag after which the final answer is stopped. Defaults to None.
         """
         function_calling_chat_template = ChatPromptTemplate.from_messages([('system', self.system_prompt)])
         tools_schemas = [tool.as_llama_schema() for tool in self.tools]
@@ -275,23 +315,15 @@ class FunctionCallingLlm:
                     prompt = self.msgs_to_llama3_str(history)
                 # print(f'\n\n---\nCalling function calling LLM with prompt: \n{prompt}\n')
                 
-                exponential_backoff_lower = 30
-                exponential_backoff_higher = 60
-                llm_response = None
-                for _ in range(5):
-                    try:
-                        llm_response = self.llm.invoke(prompt, stream_options={'include_usage': True})
-                        break
-                    except Exception as e:
-                        if '429' in str(e):
-                            print('Rate limit exceeded. Waiting with random exponential backoff.')
-                            time.sleep(random() * (exponential_backoff_higher - exponential_backoff_lower) + exponential_backoff_lower)
-                            exponential_backoff_lower *= 2
-                            exponential_backoff_higher *= 2
-                        else:
-                            raise e
-
-                print('LLM response:', llm_response)
+                llm_response = self.invoke_llm(prompt, stop_tag)
+
+                if stop_tag is not None and self.is_truncated_tool_call(llm_response):
+                    # The stop tag was generated inside the arguments of a tool call, not in the final answer:
+                    # generate again without stopping
+                    logger.debug('Stop tag found in a tool call, generating again without it')
+                    llm_response = self.invoke_llm(prompt, None)
+
+                logger.debug('LLM response: %s', llm_response)
 
                 # print(f'\nFunction calling LLM response: \n{llm_response}\n---\n')
                 parsed_tools_llm_response = json_parsing_chain.invoke(llm_response)
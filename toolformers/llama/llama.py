@@ -2,8 +2,12 @@ import datetime
 import os
 from typing import List
 
+from agent_logging import get_logger
 from toolformers.base import Conversation, Toolformer, Tool, send_usage_to_db
 from toolformers.llama.function_calling import FunctionCallingLlm
+from utils import restore_stop_tag
+
+logger = get_logger('toolformers.llama')
 
 class LlamaConversation(Conversation):
     def __init__(self, model_name, function_calling_llm : FunctionCallingLlm, category=None):
@@ -11,7 +15,7 @@ class LlamaConversation(Conversation):
         self.function_calling_llm = function_calling_llm
         self.category = category
     
-    def chat(self, message, role='user', print_output=True):
+    def chat(self, message, role='user', print_output=True, stop_tag=None):
         if role != 'user':
             raise ValueError('Role must be "user"')
 
@@ -19,13 +23,16 @@ class LlamaConversation(Conversation):
         
         start_time = datetime.datetime.now()
 
-        response, usage_data = self.function_calling_llm.function_call_llm(message)
+        response, usage_data = self.function_calling_llm.function_call_llm(message, stop_tag=stop_tag)
+
+        if stop_tag is not None:
+            response = restore_stop_tag(response, stop_tag)
 
         end_time = datetime.datetime.now()
 
-        print('Usage data:', usage_data)
+        logger.debug('Usage data: %s', usage_data)
         if print_output:
-            print(response)
+            logger.info('Reply: %s', response)
         
         send_usage_to_db(usage_data, start_time, end_time, agent_id, self.category, self.model_name)
         
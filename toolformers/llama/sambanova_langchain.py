@@ -13,7 +13,8 @@ from langchain_core.runnables import RunnableConfig, ensure_config
 from langchain_core.language_models.base import (
     LanguageModelInput,
 )
-from toolformers.llama.utils import append_to_usage_tracker
+from toolformers.llama.utils import append_to_usage_tracker, estimate_usage
+from utils import TagStreamExtractor
 
 
 class SSEndpointHandler:
@@ -658,6 +659,7 @@ class SambaNovaCloud(LLM):
         self,
         prompt: Union[List[str], str],
         stop: List[str],
+        stop_tag: Optional[str] = None,
     ) -> Iterator[GenerationChunk]:
         """
         Perform a streaming request to the LLM.
@@ -665,6 +667,7 @@ class SambaNovaCloud(LLM):
         Args:
             prompt: The prompt to use for the prediction.
             stop: list of stop tokens
+            stop_tag: closing tag after which the generation can stop
 
         Returns:
             An iterator of GenerationChunks.
@@ -681,6 +684,8 @@ class SambaNovaCloud(LLM):
         http_session = requests.Session()
         if not stop:
             stop = self.stop_tokens
+        if stop_tag is not None:
+            stop = list(stop) + [stop_tag]
         data = {
             'messages': formatted_prompt,
             'max_tokens': self.max_tokens,
@@ -702,53 +707,67 @@ class SambaNovaCloud(LLM):
 
         client = sseclient.SSEClient(response)
         close_conn = False
+        # Text yielded so far, to estimate the usage if the caller stops before the usage event
+        generated_text = []
+        usage_recorded = False
 
         if response.status_code != 200:
             raise RuntimeError(
                 f'Sambanova /complete call failed with status code ' f'{response.status_code}.' f'{response.text}.'
             )
 
-        for event in client.events():
-            if event.event == 'error_event':
-                close_conn = True
-            #print('Event:', event.data)
-            chunk = {
-                'event': event.event,
-                'data': event.data,
-                'status_code': response.status_code,
-            }
-
-            if chunk.get('error'):
-                raise RuntimeError(
-                    f"Sambanova /complete call failed with status code " f"{chunk['status_code']}." f"{chunk}."
-                )
+        try:
+            for event in client.events():
+                if event.event == 'error_event':
+                    close_conn = True
+                #print('Event:', event.data)
+                chunk = {
+                    'event': event.event,
+                    'data': event.data,
+                    'status_code': response.status_code,
+                }
 
-            try:
-                # check if the response is a final event in that case event data response is '[DONE]'
-                #if 'usage' in chunk['data']:
-                #    usage = json.loads(chunk['data'])
-                #    print('Usage:', usage)
-                if chunk['data'] != '[DONE]':
-                    data = json.loads(chunk['data'])
-                    if data.get('error'):
-                        raise RuntimeError(
-                            f"Sambanova /complete call failed with status code " f"{chunk['status_code']}." f"{chunk}."
-                        )
-                    # check if the response is a final response with usage stats (not includes content)
-                    if data.get('usage') is None:
-                        # check is not "end of text" response
-                        if data['choices'][0]['finish_reason'] is None:
-                            text = data['choices'][0]['delta']['content']
-                            generated_chunk = GenerationChunk(text=text)
-                            yield generated_chunk
-                    else:
-                        #if data['id'] not in USAGE_TRACKER:
-                        #    USAGE_TRACKER[data['id']] = []
-                        #USAGE_TRACKER[data['id']].append(data['usage'])
-                        append_to_usage_tracker(data['usage'])
-                        #print(f'Usage for id {data["id"]}:', data['usage'])
-            except Exception as e:
-                raise Exception(f'Error getting content chunk raw streamed response: {chunk}')
+                if chunk.get('error'):
+                    raise RuntimeError(
+                        f"Sambanova /complete call failed with status code " f"{chunk['status_code']}." f"{chunk}."
+                    )
+
+                try:
+                    # check if the response is a final event in that case event data response is '[DONE]'
+                    #if 'usage' in chunk['data']:
+                    #    usage = json.loads(chunk['data'])
+                    #    print('Usage:', usage)
+                    if chunk['data'] != '[DONE]':
+                        data = json.loads(chunk['data'])
+                        if data.get('error'):
+                            raise RuntimeError(
+                                f"Sambanova /complete call failed with status code " f"{chunk['status_code']}." f"{chunk}."
+                            )
+                        # check if the response is a final response with usage stats (not includes content)
+                        if data.get('usage') is None:
+                            # check is not "end of text" response
+                            if data['choices'][0]['finish_reason'] is None:
+                                text = data['choices'][0]['delta']['content']
+                                generated_text.append(text)
+                                generated_chunk = GenerationChunk(text=text)
+                                yield generated_chunk
+                        else:
+                            #if data['id'] not in USAGE_TRACKER:
+                            #    USAGE_TRACKER[data['id']] = []
+                            #USAGE_TRACKER[data['id']].append(data['usage'])
+                            append_to_usage_tracker(data['usage'])
+                            usage_recorded = True
+                            #print(f'Usage for id {data["id"]}:', data['usage'])
+                except Exception as e:
+                    raise Exception(f'Error getting content chunk raw streamed response: {chunk}')
+        except GeneratorExit:
+            # The caller stopped at the stop tag: the usage event won't arrive, but the tokens were still used
+            if not usage_recorded:
+                append_to_usage_tracker(estimate_usage(formatted_prompt, ''.join(generated_text)))
+            raise
+        finally:
+            # Also reached when the caller stops iterating early, which drops the connection and cancels the generation
+            response.close()
 
     def _stream(
         self,
@@ -766,14 +785,27 @@ class SambaNovaCloud(LLM):
         Returns:
             The string generated by the model.
         """
+        stop_tag = kwargs.get('stop_tag', None)
+        # The API stop sequences are case-sensitive, the extractor also catches the tag in any case
+        extractor = TagStreamExtractor(stop_tag) if stop_tag is not None else None
+
+        chunks = self._handle_nlp_predict_stream(prompt, stop, stop_tag)
         try:
-            for chunk in self._handle_nlp_predict_stream(prompt, stop):
+            for chunk in chunks:
+                if extractor is not None and extractor.feed(chunk.text):
+                    chunk = GenerationChunk(text=extractor.chunks[-1])
+                    if run_manager:
+                        run_manager.on_llm_new_token(chunk.text)
+                    yield chunk
+                    break
                 if run_manager:
                     run_manager.on_llm_new_token(chunk.text)
                 yield chunk
         except Exception as e:
             # Handle any errors raised by the inference endpoint
             raise ValueError(f'Error raised by the inference endpoint: {e}') from e
+        finally:
+            chunks.close()
 
     def _handle_stream_request(
         self,
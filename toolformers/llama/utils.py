@@ -1,32 +1,18 @@
-from contextlib import contextmanager
+from request_context import usage_scope, get_scope_usage, record_scope_usage
 
-USAGE_TRACKER = None
-
-@contextmanager
+# Usage is tracked in a context variable, so that concurrent chats don't mix their usage
 def usage_tracker():
-    global USAGE_TRACKER
-    assert USAGE_TRACKER is None
-    USAGE_TRACKER = []
-    try:
-        yield
-    finally:
-        USAGE_TRACKER = None
+    return usage_scope()
 
 def get_total_usage():
-    global USAGE_TRACKER
-
-    prompt_tokens = 0
-    completion_tokens = 0
+    return get_scope_usage()
 
-    for usage in USAGE_TRACKER:
-        prompt_tokens += usage['prompt_tokens']
-        completion_tokens += usage['completion_tokens']
+def append_to_usage_tracker(usage):
+    record_scope_usage(usage)
 
+def estimate_usage(messages, completion):
+    # For completions whose stream was closed before the usage event (roughly 4 characters per token)
     return {
-        'prompt_tokens': prompt_tokens,
-        'completion_tokens': completion_tokens
+        'prompt_tokens': sum(max(1, len(str(message.get('content', ''))) // 4) for message in messages),
+        'completion_tokens': len(completion) // 4
     }
-
-def append_to_usage_tracker(usage):
-    global USAGE_TRACKER
-    USAGE_TRACKER.append(usage)
\ No newline at end of file
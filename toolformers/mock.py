@@ -0,0 +1,219 @@
+import datetime
+import json
+import os
+import random
+import re
+import time
+from typing import List
+
+from agent_logging import get_logger
+from toolformers.base import Conversation, Toolformer, Tool, StringParameter, EnumParameter, NumberParameter, ArrayParameter, send_usage_to_db
+from utils import shared_config, TagStreamExtractor
+
+logger = get_logger('toolformers.mock')
+
+# The mock model is configured through the "mockModel" entry of the shared config, e.g.:
+# {
+#   "seed": 42,
+#   "latency": { "distribution": "lognormal", "mean": 0.5, "sigma": 0.3 },
+#   "completionTokens": { "distribution": "uniform", "low": 50, "high": 500 },
+#   "logUsage": false,
+#   "rules": [
+#     {
+#       "systemPrompt": "ProtocolCheckerGPT",
+#       "message": "weather",
+#       "reply": "This protocol is not suitable. NO",
+#       "toolCalls": [{ "tool": "someTool", "arguments": { "argument": "value" } }]
+#     }
+#   ]
+# }
+# Rules are matched (as regular expressions) in order against the system prompt and the latest message.
+# If no rule matches, a built-in behaviour for the specialized toolformer (querier, responder, checker...) is used.
+
+DEFAULT_CONFIG = {
+    'seed': 0,
+    'latency': {
+        'distribution': 'constant',
+        'value': 0
+    },
+    'completionTokens': None,
+    'logUsage': True,
+    'rules': []
+}
+
+MOCK_TASK_ROUTINE = '''
+import json
+
+def send_query(task_data):
+    response = send_to_server(json.dumps(task_data))
+    try:
+        return json.loads(response)
+    except ValueError:
+        return {'response': response}
+'''
+
+MOCK_TOOL_ROUTINE = '''
+import json
+
+def reply(query):
+    return json.dumps({'status': 'success', 'query': query})
+'''
+
+def sample(distribution_config, rng):
+    distribution = distribution_config['distribution']
+
+    if distribution == 'constant':
+        return distribution_config['value']
+    elif distribution == 'uniform':
+        return rng.uniform(distribution_config['low'], distribution_config['high'])
+    elif distribution == 'normal':
+        return max(0, rng.gauss(distribution_config['mean'], distribution_config['std']))
+    elif distribution == 'exponential':
+        return rng.expovariate(1 / distribution_config['mean'])
+    elif distribution == 'lognormal':
+        return rng.lognormvariate(distribution_config['mean'], distribution_config['sigma'])
+    else:
+        raise ValueError(f'Unknown distribution: {distribution}')
+
+def estimate_num_tokens(text):
+    # Roughly 4 characters per token
+    return max(1, len(text) // 4)
+
+def mock_argument(parameter, response):
+    if isinstance(parameter, EnumParameter):
+        return parameter.values[0]
+    elif isinstance(parameter, NumberParameter):
+        return 0
+    elif isinstance(parameter, ArrayParameter):
+        return []
+    elif isinstance(parameter, StringParameter):
+        return response if response is not None else 'mock'
+    else:
+        raise ValueError(f'Unknown parameter type: {type(parameter)}')
+
+def extract_section(message, header):
+    # Returns the JSON block that follows the header (as formatted by the specialized toolformers)
+    if header not in message:
+        return None
+    return message.split(header, 1)[1].strip().split('\n\n')[0]
+
+class MockConversation(Conversation):
+    def __init__(self, toolformer, category=None):
+        self.toolformer = toolformer
+        self.category = category
+        self.messages = []
+
+    def _find_rule(self, message):
+        for rule in self.toolformer.config['rules']:
+            if 'systemPrompt' in rule and re.search(rule['systemPrompt'], self.toolformer.system_prompt, re.DOTALL) is None:
+                continue
+            if 'message' in rule and re.search(rule['message'], message, re.DOTALL) is None:
+                continue
+            return rule
+        return None
+
+    def _call_tool(self, tool_name, arguments):
+        for tool in self.toolformer.tools:
+            if tool.name == tool_name:
+                return tool.call_tool_for_toolformer(**arguments)
+        raise ValueError(f'Mock rule refers to unknown tool: {tool_name}')
+
+    def _builtin_reply(self, message):
+        system_prompt = self.toolformer.system_prompt
+        tool_names = [tool.name for tool in self.toolformer.tools]
+
+        if 'sendQuery' in tool_names and 'deliverStructuredOutput' in tool_names:
+            # Querier (with or without protocol): send the task data as-is, then deliver a placeholder output
+            if len(self.messages) > 1:
+                return 'Done.'
+            query = extract_section(message, 'JSON data of the task:') or message
+            response = self._call_tool('sendQuery', { 'query': query })
+
+            output_tool = [tool for tool in self.toolformer.tools if tool.name == 'deliverStructuredOutput'][0]
+            self._call_tool('deliverStructuredOutput', {
+                parameter.name: mock_argument(parameter, None) for parameter in output_tool.parameters
+            })
+            return 'Done.'
+        elif 'pickProtocols' in tool_names:
+            # Protocol filter: every listed protocol might be suitable
+            protocol_ids = [int(x) for x in re.findall(r'^(\d+)\. ', message, re.MULTILINE)]
+            self._call_tool('pickProtocols', { 'protocolIds': protocol_ids })
+            return 'Done.'
+        elif 'ProtocolCheckerGPT' in system_prompt:
+            return 'The protocol is adequate.\nYES'
+        elif 'ProtocolProgrammerGPT' in system_prompt:
+            routine = MOCK_TASK_ROUTINE if 'def send_query(' in system_prompt else MOCK_TOOL_ROUTINE
+            return f'```python\n<IMPLEMENTATION>\n{routine}\n</IMPLEMENTATION>\n```'
+        elif 'ProtocolNegotiatorGPT' in system_prompt and 'JSON schema of the task is the following' in system_prompt:
+            task_schema = system_prompt.split('JSON schema of the task is the following:', 1)[1].strip()
+            return '<FINALPROTOCOL>\n<NAME>Mock protocol</NAME>\n<DESCRIPTION>A protocol that sends the task data as JSON.</DESCRIPTION>\n' \
+                'The sender sends the task data as a JSON object following this schema:\n' + task_schema + '\n' \
+                'The receiver replies with a JSON object following the output schema.\n</FINALPROTOCOL>'
+        elif 'ProtocolNegotiatorGPT' in system_prompt:
+            return 'The protocol works for me. I am done.'
+        else:
+            # Responders and anything else
+            return 'Mock reply.'
+
+    def chat(self, message, role='user', print_output=True, stop_tag=None):
+        agent_id = os.environ.get('AGENT_ID', None)
+        start_time = datetime.datetime.now()
+
+        self.messages.append({ 'role': role, 'content': message })
+
+        # The same conversation state always produces the same latency and token counts
+        rng = random.Random(f'{self.toolformer.config["seed"]}:{self.toolformer.system_prompt}:{json.dumps(self.messages)}')
+
+        rule = self._find_rule(message)
+
+        if rule is not None:
+            for tool_call in rule.get('toolCalls', []):
+                self._call_tool(tool_call['tool'], tool_call.get('arguments', {}))
+            reply = rule.get('reply', '')
+        else:
+            reply = self._builtin_reply(message)
+
+        if stop_tag is not None:
+            extractor = TagStreamExtractor(stop_tag)
+            if extractor.feed(reply):
+                reply = extractor.text
+
+        time.sleep(sample(self.toolformer.config['latency'], rng))
+
+        self.messages.append({ 'role': 'assistant', 'content': reply })
+
+        if self.toolformer.config['logUsage']:
+            if self.toolformer.config['completionTokens'] is not None:
+                completion_tokens = int(sample(self.toolformer.config['completionTokens'], rng))
+            else:
+                completion_tokens = estimate_num_tokens(reply)
+
+            usage = {
+                'prompt_tokens': estimate_num_tokens(self.toolformer.system_prompt) + sum(estimate_num_tokens(x['content']) for x in self.messages[:-1]),
+                'completion_tokens': completion_tokens
+            }
+            send_usage_to_db(usage, start_time, datetime.datetime.now(), agent_id, self.category, self.toolformer.name)
+
+        if print_output:
+            logger.info('Reply: %s', reply)
+
+        return reply
+
+class MockToolformer(Toolformer):
+    def __init__(self, name, system_prompt, tools, config):
+        self.name = name
+        self.system_prompt = system_prompt
+        self.tools = tools
+        self.config = config
+
+    def new_conversation(self, category=None) -> Conversation:
+        return MockConversation(self, category)
+
+def make_mock_toolformer(model_type_internal, system_prompt, tools : List[Tool]):
+    if model_type_internal != 'mock':
+        raise ValueError('Model type must be "mock".')
+
+    config = dict(DEFAULT_CONFIG)
+    config.update(shared_config('mockModel', {}))
+
+    return MockToolformer(model_type_internal, system_prompt, tools, config)
@@ -1,20 +1,33 @@
 import os
 
 from toolformers.camel import make_openai_toolformer
+from toolformers.cassette import make_cassette_toolformer
 from toolformers.gemini import make_gemini_toolformer
 from toolformers.llama import make_llama_toolformer
+from toolformers.mock import make_mock_toolformer
+from utils import shared_config
 
 
-def make_toolformer(model_type_internal, system_prompt, tools):
+def make_backend_toolformer(model_type_internal, system_prompt, tools):
     if model_type_internal in ['gpt-4o', 'gpt-4o-mini']:
         return make_openai_toolformer(model_type_internal, system_prompt, tools)
     elif model_type_internal in ['gemini-1.5-flash', 'gemini-1.5-pro']:
         return make_gemini_toolformer(model_type_internal, system_prompt, tools)
     elif model_type_internal in ['llama3-8b', 'llama3-70b', 'llama3-405b']:
         return make_llama_toolformer(model_type_internal, system_prompt, tools)
+    elif model_type_internal == 'mock':
+        return make_mock_toolformer(model_type_internal, system_prompt, tools)
     else:
         raise ValueError(f'Unsupported model type: {model_type_internal}')
 
+def make_toolformer(model_type_internal, system_prompt, tools):
+    cassette_config = shared_config('cassette', None)
+
+    if cassette_config is not None and cassette_config.get('mode') is not None:
+        return make_cassette_toolformer(model_type_internal, system_prompt, tools, cassette_config, make_backend_toolformer)
+
+    return make_backend_toolformer(model_type_internal, system_prompt, tools)
+
 def make_default_toolformer(system_prompt, tools):
     model_type_internal = os.environ.get('MODEL_TYPE', 'gpt-4o-mini')
     return make_toolformer(model_type_internal, system_prompt, tools)
\ No newline at end of file
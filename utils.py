@@ -1,15 +1,28 @@
 import base64
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import contextmanager
+import contextvars
 import hashlib
-import importlib
+import importlib.util
 import json
+import os
 from pathlib import Path
-import urllib
+import threading
+import urllib.parse
 
-import requests as request_manager
 from proto.marshal.collections.repeated import RepeatedComposite
 from proto.marshal.collections.maps import MapComposite
 
+from agent_logging import get_logger
+import http_client
+from request_context import request_context, get_query_id, span, propagate_context
+from routine_workers import get_routine_pool
+from runtime_config import get_config
+import wire_format
+
+logger = get_logger('utils')
+
 def compute_hash(s):
     # Hash a string using SHA-1 and return the base64 encoded result
 
@@ -20,7 +33,72 @@ def compute_hash(s):
 
     return base64.b64encode(b).decode('ascii')
 
+# Protocol documents are content-addressed: a document whose ID is its hash is stored once in a blob directory
+# shared by all the agents of the host, and the most recently used ones are kept in memory.
+# Configured by the "protocolStore" entry of the shared config, e.g. { "path": "storage/protocol_blobs", "cacheSize": 256 }
+DEFAULT_PROTOCOL_BLOB_PATH = 'storage/protocol_blobs'
+DEFAULT_PROTOCOL_CACHE_SIZE = 256
+
+PROTOCOL_CACHE = OrderedDict()
+PROTOCOL_CACHE_LOCK = threading.Lock()
+
+def _protocol_blob_path(protocol_hash):
+    blob_folder = Path(shared_config('protocolStore', {}).get('path', DEFAULT_PROTOCOL_BLOB_PATH))
+    return blob_folder / (urllib.parse.quote_plus(protocol_hash) + '.txt')
+
+def _cache_protocol_document(protocol_hash, protocol_document):
+    cache_size = shared_config('protocolStore', {}).get('cacheSize', DEFAULT_PROTOCOL_CACHE_SIZE)
+
+    with PROTOCOL_CACHE_LOCK:
+        PROTOCOL_CACHE[protocol_hash] = protocol_document
+        PROTOCOL_CACHE.move_to_end(protocol_hash)
+
+        while len(PROTOCOL_CACHE) > cache_size:
+            PROTOCOL_CACHE.popitem(last=False)
+
+def _write_atomically(path, content):
+    # Other agents might be reading the file, so it is written to a temporary file which is then renamed
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+
+    with open(str(temp_path), 'w') as f:
+        f.write(content)
+
+    os.replace(temp_path, path)
+
+def _store_protocol_blob(protocol_hash, protocol_document):
+    path = _protocol_blob_path(protocol_hash)
+
+    # Documents are immutable, so a document that is already stored doesn't need to be written again
+    if not path.exists():
+        _write_atomically(path, protocol_document)
+
+    _cache_protocol_document(protocol_hash, protocol_document)
+
+def _load_protocol_blob(protocol_hash):
+    with PROTOCOL_CACHE_LOCK:
+        if protocol_hash in PROTOCOL_CACHE:
+            PROTOCOL_CACHE.move_to_end(protocol_hash)
+            return PROTOCOL_CACHE[protocol_hash]
+
+    blob_path = _protocol_blob_path(protocol_hash)
+
+    try:
+        with open(str(blob_path), 'r') as f:
+            protocol_document = f.read()
+    except FileNotFoundError:
+        return None
+
+    _cache_protocol_document(protocol_hash, protocol_document)
+    return protocol_document
+
 def save_protocol_document(base_folder, protocol_id, protocol_document):
+    if compute_hash(protocol_document) == protocol_id:
+        _store_protocol_blob(protocol_id, protocol_document)
+        return
+
+    # The document can't be verified against its ID (e.g. it was downloaded from an untrusted source),
+    # so it is only stored for this agent
     if isinstance(base_folder, str):
         base_folder = Path(base_folder)
 
@@ -33,6 +111,10 @@ def save_protocol_document(base_folder, protocol_id, protocol_document):
         f.write(protocol_document)
 
 def load_protocol_document(base_folder, protocol_id):
+    protocol_document = _load_protocol_blob(protocol_id)
+    if protocol_document is not None:
+        return protocol_document
+
     if isinstance(base_folder, str):
         base_folder = Path(base_folder)
 
@@ -43,61 +125,178 @@ def load_protocol_document(base_folder, protocol_id):
     with open(str(path), 'r') as f:
         return f.read()
 
-def execute_routine(base_folder, protocol_id, task_data, tools):
+ROUTINE_CACHE = {}
+ROUTINE_CACHE_LOCK = threading.Lock()
+# One lock per routine file, so that loading a routine doesn't block the calls to the others
+ROUTINE_LOAD_LOCKS = {}
+
+# The tools of the routine call running in the current context
+_ROUTINE_TOOLS = contextvars.ContextVar('routine_tools', default=None)
+
+class _ToolProxy:
+    # Stands for a tool in the namespace of a loaded routine, which is shared by all the calls.
+    # Calls are forwarded to the tool of the same name of the current call
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, *args, **kwargs):
+        tools = _ROUTINE_TOOLS.get()
+        if tools is None or self.name not in tools:
+            raise NameError(f'Tool {self.name} is not available outside of a routine call.')
+        return tools[self.name](*args, **kwargs)
+
+def _routine_path(base_folder, protocol_id):
     if isinstance(base_folder, str):
         base_folder = Path(base_folder)
 
     protocol_id = urllib.parse.quote_plus(protocol_id)
     protocol_id = protocol_id.replace('%', '_')
-    path = base_folder / f'{protocol_id}.py'
+    return protocol_id, base_folder / f'{protocol_id}.py'
+
+def _load_routine(module_name, path):
+    # The module is run once per version of the routine file, the tools are bound for each call (see _bind_tools)
+    stat = os.stat(path)
+    cache_key = str(path)
+
+    def get_cached():
+        cached = ROUTINE_CACHE.get(cache_key)
+        if cached is not None and cached['mtime'] == stat.st_mtime_ns and cached['size'] == stat.st_size:
+            return cached['namespace']
+        return None
+
+    with ROUTINE_CACHE_LOCK:
+        namespace = get_cached()
+        if namespace is not None:
+            return namespace
+        load_lock = ROUTINE_LOAD_LOCKS.setdefault(cache_key, threading.Lock())
+
+    with load_lock:
+        # Another call might have loaded it while we were waiting for the lock
+        with ROUTINE_CACHE_LOCK:
+            namespace = get_cached()
+        if namespace is not None:
+            return namespace
+
+        logger.debug('Loading module from: %s', path)
 
-    print('Loading module from:', path)
+        # TODO: This should be done in a safe, containerized environment
+        spec = importlib.util.spec_from_file_location(module_name, path)
+        loaded_module = importlib.util.module_from_spec(spec)
 
-    # TODO: This should be done in a safe, containerized environment
-    spec = importlib.util.spec_from_file_location(protocol_id, path)
-    loaded_module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(loaded_module)
 
-    spec.loader.exec_module(loaded_module)
+        with ROUTINE_CACHE_LOCK:
+            ROUTINE_CACHE[cache_key] = {
+                'mtime': stat.st_mtime_ns,
+                'size': stat.st_size,
+                'namespace': loaded_module.__dict__
+            }
 
+        return loaded_module.__dict__
+
+@contextmanager
+def _bind_tools(namespace, tools):
+    # The routine's globals hold proxies, so everything it defines (functions, methods, decorated helpers, lambdas)
+    # resolves the tools of the current call, and concurrent calls don't see each other's tools
     for tool in tools:
-        loaded_module.__dict__[tool.name] = tool.as_executable_function()
+        if not isinstance(namespace.get(tool.name), _ToolProxy):
+            namespace[tool.name] = _ToolProxy(tool.name)
 
-    return loaded_module.run(task_data)
+    token = _ROUTINE_TOOLS.set({ tool.name: tool.as_executable_function() for tool in tools })
+    try:
+        yield namespace['run']
+    finally:
+        _ROUTINE_TOOLS.reset(token)
 
-def save_routine(base_folder, protocol_id, routine):
-    if isinstance(base_folder, str):
-        base_folder = Path(base_folder)
+def execute_routine(base_folder, protocol_id, task_data, tools):
+    module_name, path = _routine_path(base_folder, protocol_id)
 
-    protocol_id = urllib.parse.quote_plus(protocol_id)
-    protocol_id = protocol_id.replace('%', '_')
-    path = base_folder / f'{protocol_id}.py'
+    with span('routine'):
+        # When configured (e.g. { "numWorkers": 4, "timeout": 60, "memoryLimit": 1073741824 }), routines run in a pool of worker processes
+        pool_config = shared_config('routineWorkers', None)
+        if pool_config is not None:
+            return get_routine_pool(pool_config).execute(module_name, path, task_data, tools)
 
-    path.parent.mkdir(parents=True, exist_ok=True)
+        namespace = _load_routine(module_name, path)
 
-    with open(str(path), 'w') as f:
-        f.write(routine)
+        with _bind_tools(namespace, tools) as run:
+            return run(task_data)
+
+def save_routine(base_folder, protocol_id, routine):
+    _, path = _routine_path(base_folder, protocol_id)
+
+    # Requests that are running the previous version might be loading the file
+    _write_atomically(path, routine)
+
+    # The file might be rewritten within the resolution of its modification time, so drop the cached version explicitly
+    with ROUTINE_CACHE_LOCK:
+        ROUTINE_CACHE.pop(str(path), None)
 
 def extract(text, start_tag, end_tag):
-    start_position = text.lower().find(start_tag.lower())
-    end_position = text.lower().find(end_tag.lower())
+    lower_text = text.lower()
+    start_position = lower_text.find(start_tag.lower())
+
+    if start_position == -1:
+        return None
+
+    end_position = lower_text.find(end_tag.lower(), start_position + len(start_tag))
 
-    if start_position == -1 or end_position == -1:
+    if end_position == -1:
         return None
 
     return text[start_position + len(start_tag):end_position].strip()
 
+def opening_tag(end_tag):
+    return end_tag.replace('</', '<', 1)
+
+class TagStreamExtractor:
+    # Watches a stream of text chunks and reports when the closing tag has been generated, so that the rest of
+    # the generation can be cancelled. Only the last few characters are kept for matching, since the tag might be
+    # split across chunks
+    def __init__(self, end_tag):
+        self.end_tag = end_tag.lower()
+        self.chunks = []
+        self.tail = ''
+        self.done = False
+
+    def feed(self, chunk):
+        if self.done:
+            return True
+
+        window = self.tail + chunk.lower()
+        position = window.find(self.end_tag)
+
+        if position == -1:
+            self.chunks.append(chunk)
+            self.tail = window[-(len(self.end_tag) - 1):] if len(self.end_tag) > 1 else ''
+            return False
+
+        # Keep the text up to the end of the tag
+        self.chunks.append(chunk[:position + len(self.end_tag) - len(self.tail)])
+        self.done = True
+        return True
+
+    @property
+    def text(self):
+        return ''.join(self.chunks)
+
+def restore_stop_tag(reply, stop_tag):
+    # Stop sequences are not included in the reply, put the closing tag back if the block was left open
+    lower_reply = reply.lower()
+    if opening_tag(stop_tag).lower() in lower_reply and stop_tag.lower() not in lower_reply:
+        return reply + stop_tag
+    return reply
+
 def download_and_verify_protocol(protocol_hash, protocol_source):
-    response = request_manager.get(protocol_source, timeout=shared_config('timeout'))
+    response = http_client.get(protocol_source, tier='download')
     # It's just a simple txt file
     if response.status_code == 200:
         protocol = response.text
-        print('Protocol:', protocol)
+        found_hash = compute_hash(protocol)
+        logger.debug('Downloaded protocol from %s, found hash: %s, target hash: %s', protocol_source, found_hash, protocol_hash)
 
-        print('Found hash:', compute_hash(protocol))
-        print('Target hash:', protocol_hash)
         # Check if the hash matches
-        if compute_hash(protocol) == protocol_hash:
-            print('Hashes match!')
+        if found_hash == protocol_hash:
             # Save the protocol in the known protocols
             # PROTOCOL_INFOS[protocol_hash] = {
             #     'protocol': protocol,
@@ -109,60 +308,89 @@ def download_and_verify_protocol(protocol_hash, protocol_source):
             # save_protocol_document(base_folder, protocol_hash, protocol)
 
             return protocol
-    print('Failed to download protocol from', protocol_source)
+    logger.warning('Failed to download protocol from %s', protocol_source)
     return None
 
+def fetch_protocol(protocol_hash, protocol_sources):
+    # Returns the protocol document and the source it was obtained from, or (None, None).
+    # Documents are immutable, so a document that is in the shared protocol store is never downloaded again
+    protocol_document = _load_protocol_blob(protocol_hash)
+    if protocol_document is not None:
+        return protocol_document, protocol_sources[0] if len(protocol_sources) > 0 else None
+
+    if len(protocol_sources) == 1 or not http_client.ALLOW_CONCURRENT_REQUESTS:
+        for protocol_source in protocol_sources:
+            protocol_document = download_and_verify_protocol(protocol_hash, protocol_source)
+            if protocol_document is not None:
+                _store_protocol_blob(protocol_hash, protocol_document)
+                return protocol_document, protocol_source
+        return None, None
+
+    # Download from all the sources at once, and keep the first document whose hash matches
+    executor = ThreadPoolExecutor(max_workers=len(protocol_sources))
+    futures = {
+        executor.submit(propagate_context(download_and_verify_protocol), protocol_hash, protocol_source): protocol_source
+        for protocol_source in protocol_sources
+    }
+
+    try:
+        for future in as_completed(futures):
+            try:
+                protocol_document = future.result()
+            except Exception as e:
+                logger.warning('Failed to download protocol from %s: %s', futures[future], e)
+                continue
+
+            if protocol_document is not None:
+                _store_protocol_blob(protocol_hash, protocol_document)
+                return protocol_document, futures[future]
+    finally:
+        # The remaining downloads are not waited for
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return None, None
+
 def send_raw_query(text, protocol_id, target_node, source):
-    return request_manager.post(target_node, json={
+    # The response must be parsed with wire_format.decode_response, since it might not be JSON
+    payload = {
         'protocolHash': protocol_id,
         'body': text,
         'protocolSources' : [source],
         'queryId': get_query_id()
-    }, timeout=shared_config('timeout'))
+    }
 
+    response = http_client.post(target_node, tier='query', **wire_format.encode_request(target_node, payload))
 
-_QUERY_ID = None
+    if wire_format.rejected_binary(target_node, response):
+        response = http_client.post(target_node, tier='query', **wire_format.encode_request(target_node, payload))
 
-@contextmanager
-def use_query_id(query_id):
-    global _QUERY_ID
-
-    assert _QUERY_ID is None, 'Cannot nest query IDs'
+    return response
 
-    _QUERY_ID = query_id
-    try:
-        yield
-    finally:
-        _QUERY_ID = None
 
-def get_query_id():
-    return _QUERY_ID
+@contextmanager
+def use_query_id(query_id):
+    with request_context(query_id) as context:
+        yield context
 
-SHARED_CONFIG = None
+    if shared_config('traceRequests', False):
+        logger.info('Request trace: %s', json.dumps(context.summary()))
 
 def shared_config(key, fallback='no_fallback'):
-    global SHARED_CONFIG
+    shared = get_config()['shared']
 
-    if SHARED_CONFIG is None:
-        with open('config.json') as f:
-            SHARED_CONFIG = json.load(f)['shared']
-    
     if fallback == 'no_fallback':
-        return SHARED_CONFIG[key]
+        return shared[key]
     else:
-        return SHARED_CONFIG.get(key, fallback)
+        return shared.get(key, fallback)
 
 def serialize_gemini_data(output):
     # Some Gemini objects are not JSON-serializable, so we need to serialize them manually
     if isinstance(output, RepeatedComposite):
-        print('RepeatedComposite:', output)
         parsed = []
         for i in range(len(output)):
             parsed.append(serialize_gemini_data(output[i]))
         return parsed
     elif isinstance(output, MapComposite):
-        print('MapComposite:', output)
-
         parsed = {}
         for key in output:
             parsed[key] = serialize_gemini_data(output[key])
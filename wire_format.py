@@ -0,0 +1,139 @@
+# Content negotiation for the queries between agents. Servers that can decode MessagePack say so by replying in
+# MessagePack to requests that accept it, after which the client sends them MessagePack as well. Large payloads are
+# compressed with zlib (Content-Encoding: deflate). JSON is used whenever one side does not support MessagePack.
+# Configured by the "wireFormat" entry of the shared config, e.g. { "binary": true, "compressionThreshold": 1024 }
+
+import json
+import urllib.parse
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_CONTENT_TYPE = 'application/json'
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
+DEFAULT_COMPRESSION_THRESHOLD = 1024 # bytes
+
+# Hosts that replied in MessagePack
+BINARY_HOSTS = set()
+
+class UnsupportedWireFormat(Exception):
+    pass
+
+def _wire_config():
+    from utils import shared_config
+    return shared_config('wireFormat', {})
+
+def binary_enabled():
+    return msgpack is not None and _wire_config().get('binary', True)
+
+def compression_threshold():
+    return _wire_config().get('compressionThreshold', DEFAULT_COMPRESSION_THRESHOLD)
+
+def _host(url):
+    return urllib.parse.urlsplit(url).netloc
+
+def encode(payload, content_type, threshold):
+    # Returns the encoded payload and whether it was compressed
+    if content_type == MSGPACK_CONTENT_TYPE:
+        data = msgpack.packb(payload, use_bin_type=True)
+    else:
+        data = json.dumps(payload).encode()
+
+    if threshold is not None and len(data) > threshold:
+        return zlib.compress(data), True
+    return data, False
+
+def decode(data, content_type, compressed):
+    if compressed:
+        data = zlib.decompress(data)
+
+    if content_type == MSGPACK_CONTENT_TYPE:
+        return msgpack.unpackb(data, raw=False)
+    return json.loads(data)
+
+def _content_type(headers):
+    return headers.get('Content-Type', JSON_CONTENT_TYPE).split(';')[0].strip()
+
+# Client side
+
+def encode_request(url, payload):
+    # Returns the keyword arguments for http_client.post
+    if not binary_enabled():
+        return { 'json': payload }
+
+    headers = { 'Accept': f'{MSGPACK_CONTENT_TYPE}, {JSON_CONTENT_TYPE}' }
+
+    if _host(url) not in BINARY_HOSTS:
+        # The server's support is not known yet: send JSON, and let it reply in MessagePack if it can
+        return { 'json': payload, 'headers': headers }
+
+    data, compressed = encode(payload, MSGPACK_CONTENT_TYPE, compression_threshold())
+    headers['Content-Type'] = MSGPACK_CONTENT_TYPE
+    if compressed:
+        headers['Content-Encoding'] = 'deflate'
+
+    return { 'data': data, 'headers': headers }
+
+def decode_response(url, response):
+    # Responses are decompressed by the HTTP client, and in-process responses have no headers
+    headers = getattr(response, 'headers', {})
+
+    if _content_type(headers) == MSGPACK_CONTENT_TYPE:
+        BINARY_HOSTS.add(_host(url))
+        return decode(response.content, MSGPACK_CONTENT_TYPE, False)
+
+    return response.json()
+
+def rejected_binary(url, response):
+    # The server doesn't (or no longer) accept MessagePack
+    if response.status_code == 415 and _host(url) in BINARY_HOSTS:
+        BINARY_HOSTS.discard(_host(url))
+        return True
+    return False
+
+# Server side
+
+def decode_request_body(headers, data):
+    content_type = _content_type(headers)
+    compressed = headers.get('Content-Encoding', '') == 'deflate'
+
+    if content_type == MSGPACK_CONTENT_TYPE and msgpack is None:
+        raise UnsupportedWireFormat(f'Unsupported content type: {content_type}')
+
+    return decode(data, content_type, compressed)
+
+def encode_response_body(accept, payload):
+    # Returns the body and headers of a MessagePack response, or None if the payload should be sent as-is
+    if not isinstance(payload, (dict, list)) or MSGPACK_CONTENT_TYPE not in accept or not binary_enabled():
+        return None
+
+    data, compressed = encode(payload, MSGPACK_CONTENT_TYPE, compression_threshold())
+    headers = { 'Content-Type': MSGPACK_CONTENT_TYPE }
+    if compressed:
+        headers['Content-Encoding'] = 'deflate'
+
+    return data, headers
+
+def decode_request(request):
+    # Flask request
+    content_type = _content_type(request.headers)
+    compressed = request.headers.get('Content-Encoding', '') == 'deflate'
+
+    if content_type == MSGPACK_CONTENT_TYPE or compressed:
+        return decode_request_body(request.headers, request.get_data())
+
+    return request.get_json()
+
+def encode_response(request, payload):
+    # Flask response. Flask takes care of JSON (and of in-process calls, which pass the payload as-is)
+    from flask import Response
+
+    encoded = encode_response_body(request.headers.get('Accept', ''), payload)
+    if encoded is None:
+        return payload
+
+    data, headers = encoded
+    return Response(data, headers=headers)